@@ -0,0 +1,4 @@
+mkdir -p classes
+javac -source 1.6 -target 1.6 -d classes -g ../../../BBoxTester_ToolServer_Sources/src/com/zhauniarovich/bbtester/toolserver/ToolServer.java 
+jar cfe toolserver.jar com.zhauniarovich.bbtester.toolserver.ToolServer -C classes .
+rm -rf classes
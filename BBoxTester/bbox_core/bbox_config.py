@@ -16,6 +16,12 @@ DEFAULT_CONFIG= {
             "FINAL_INSTRUMENTED_FILE_SUFFIX" : "_instr_final",
             "SIGNED_FILE_SUFFIX" : "_signed",
             "ALIGNED_FILE_SUFFIX" : "_aligned",
+            "TMP_METADATA_RELATIVE_DIR" : "metadata",
+            "DEX_PROCESSING_WORKERS" : "1", # >1 - process dex files in parallel
+            "STAGE_WORKERS" : "2", # >1 - instrument the manifest and build the apk while the dex files are processed
+            "RESUME_INSTRUMENTATION" : "True", # resume from the last completed stage
+            "PIPELINE_MODE" : "APKTOOL", # APKTOOL or ZIP_PATCH (no resource decode/rebuild)
+            "KEEP_INTERMEDIATE_APKS" : "False", # True - add resources, sign and align in separate steps (debug)
 #             "DELETE_TMP_DIR" : "False",
         },
     "AAPT" : {
@@ -42,7 +48,9 @@ DEFAULT_CONFIG= {
             "DX_JAVA_PATH" : "java",
             "DX_JAVA_OPTS" : "-Xms512m -Xmx1024m",
             "DX_PATH" : "./auxiliary/dx",
-            "DX_JAR"  : "dx.jar"
+            "DX_JAR"  : "dx.jar",
+            "DX_MULTIDEX" : "True", # split dex files that would exceed the reference limit after instrumentation
+            "DX_MULTIDEX_THRESHOLD" : "65536", # estimated method or field references of one dex file
         },
     "EMMA" : {
             "EMMA_JAVA_PATH" : "java",
@@ -52,16 +60,80 @@ DEFAULT_CONFIG= {
             "EMMA_DEVICE_JAR" : "emma_device.jar",
             "EMMA_RESOURCES_DIR" : "./auxiliary/emma/resources",
             "ANDROID_SPECIFIC_INSTRUMENTATION_CLASSES_PATH": "./auxiliary/instrument_classes/", #trailing slash is important
+            "EMMA_INCLUDE_FILTERS" : "", # comma separated packages or class patterns to instrument, e.g. com.example
+            "EMMA_EXCLUDE_FILTERS" : "", # comma separated packages or class patterns not to instrument
+            "EMMA_AUTO_FILTERS" : "False", # True - instrument only the app packages from the manifest, skip well-known libraries
+            "EMMA_SINGLE_RUN" : "True", # instrument all jar files of an apk in one Emma run
         },
     "ZIPALIGN" : {
             "ZIPALIGN_DIR" : "./auxiliary/zipalign",
             "ZIPALIGN_EXE" : "zipalign",
+            "USE_NATIVE_ZIPALIGN" : "True", # align in process instead of running zipalign
+            "ZIPALIGN_ALIGNMENT" : "4",
+        },
+    "SIGNING" : {
+            "SIGNER" : "NATIVE", # NATIVE (in process), OPENSSL or DEX2JAR (ApkSign in a JVM, separate signing step only)
+            "SIGNING_THREADS" : "4", # threads computing digests of entries (NATIVE and OPENSSL)
+            "SIGNING_KEY_FILE" : "", # PKCS#8 DER private key; empty - dex2jar test key
+            "SIGNING_CERT_FILE" : "", # DER certificate of the key
+            "SIGNING_DIGEST_ALGORITHM" : "SHA1", # SHA1 or SHA-256 (Android 4.3+)
+            "OPENSSL_EXE" : "openssl",
+        },
+    "WORKSPACE" : {
+            "USE_TMPFS" : "False", # put stage dirs into RAM-backed dir while they fit into the budget
+            "TMPFS_DIR" : "/dev/shm/bboxtester",
+            "TMPFS_BUDGET_MB" : "2048", # shared by all concurrent instrumentations
+            "RELEASE_CONSUMED_STAGES" : "True", # remove stage dirs as soon as the next stage has used them
+        },
+    "BATCH" : {
+            "BATCH_WORKERS" : "4", # apk files instrumented in parallel
+            "BATCH_APK_TIMEOUT_SEC" : "1800",
+            "BATCH_TMP_MAX_SIZE_MB" : "4096", # limit of tmp dir of one apk file
+        },
+    "TOOLSERVER" : {
+            "USE_TOOLSERVER" : "False",
+            "TOOLSERVER_JAVA_PATH" : "java",
+            "TOOLSERVER_JAVA_OPTS" : "-Xms512m -Xmx2048m",
+            "TOOLSERVER_PATH" : "./auxiliary/toolserver",
+            "TOOLSERVER_JAR" : "toolserver.jar",
+            "TOOLSERVER_MEMORY_THRESHOLD_MB" : "1536", # server is restarted when its used heap exceeds this value
+        },
+    "CACHE" : {
+            "USE_INSTR_CACHE" : "False",
+            "INSTR_CACHE_DIR" : "./cache/instrumented",
+            "INSTR_CACHE_MAX_SIZE_MB" : "10240",
+            "USE_EMMA_CLASS_CACHE" : "False", # reuse instrumented classes of known libraries across apks
+            "EMMA_CLASS_CACHE_DIR" : "./cache/classes",
+            "EMMA_CLASS_CACHE_MAX_SIZE_MB" : "4096",
+            "EMMA_CLASS_CACHE_MIN_GROUP_SIZE" : "20", # smaller library groups are instrumented with the app
+        },
+    "PRESCAN" : {
+            "USE_PRESCAN" : "True", # reject broken apks before running the tools
+            "PRESCAN_CACHE_DIR" : "./cache/prescan",
+            "PRESCAN_METHOD_LIMIT" : "65536", # 0 - no limit
+            "PRESCAN_METHODS_PER_CLASS" : "1", # methods Emma adds to each instrumented class
+        },
+    "JVM_HEAP" : {
+            "ADAPTIVE_HEAP" : "True", # size -Xmx of *_JAVA_OPTS from the input of each tool run
+            "HEAP_MODEL_FILE" : "./cache/heap_model.json", # peak memory of the previous tool runs
+            "HEAP_MIN_MB" : "256",
+            "HEAP_MAX_MB" : "4096",
+            "HEAP_HEADROOM" : "1.5", # predicted peak memory is multiplied by this factor
+            "HEAP_MEMORY_LIMIT_MB" : "0", # heap of the tools run at the same time; 0 - 3/4 of physical memory
+            "HEAP_RETRY_ON_OOM" : "True", # rerun a tool once with twice the heap after OutOfMemoryError
+        },
+    "COMMANDS" : {
+            "JVM_COMMANDS_LIMIT" : "4", # java tool subprocesses run at the same time by one process; 0 - no limit
+            "ADB_COMMANDS_LIMIT" : "4", # adb commands run at the same time on one device (logcat and monkey streams hold a slot)
+            "DISK_COMMANDS_LIMIT" : "2", # disk-heavy commands (zipalign)
+            "OTHER_COMMANDS_LIMIT" : "0", # other external commands (e.g., openssl)
         },
 }
 
 class BBoxConfig:
     def __init__(self, pathToConfigFile="./config/bbox_config.ini"):
         #TODO: May be it's worth to add check if path is None or exist
+        self.pathToConfigFile = pathToConfigFile
         self.config = ConfigParser.ConfigParser()
         read_files = self.config.read(pathToConfigFile)
         self.isRealFile = False
@@ -131,6 +203,39 @@ class BBoxConfig:
         option = "ALIGNED_FILE_SUFFIX"
         return self._getOption(section, option)
     
+    def getTmpMetadataRelativeDir(self):
+        section = "GENERAL"
+        option = "TMP_METADATA_RELATIVE_DIR"
+        return self._getOption(section, option)
+    
+    def getDexProcessingWorkers(self):
+        section = "GENERAL"
+        option = "DEX_PROCESSING_WORKERS"
+        return int(self._getOption(section, option))
+    
+    def getStageWorkers(self):
+        section = "GENERAL"
+        option = "STAGE_WORKERS"
+        return int(self._getOption(section, option))
+    
+    def resumeInstrumentation(self):
+        section = "GENERAL"
+        option = "RESUME_INSTRUMENTATION"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getPipelineMode(self):
+        section = "GENERAL"
+        option = "PIPELINE_MODE"
+        return self._getOption(section, option).upper()
+    
+    def keepIntermediateApks(self):
+        section = "GENERAL"
+        option = "KEEP_INTERMEDIATE_APKS"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getPathToConfigFile(self):
+        return self.pathToConfigFile
+    
  
     
     #AAPT
@@ -226,6 +331,16 @@ class BBoxConfig:
         option = "DX_JAR"
         return self._getOption(section, option)
     
+    def useDxMultiDex(self):
+        section = "DX"
+        option = "DX_MULTIDEX"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getDxMultiDexThreshold(self):
+        section = "DX"
+        option = "DX_MULTIDEX_THRESHOLD"
+        return int(self._getOption(section, option))
+    
     
     
     #EMMA  
@@ -254,6 +369,26 @@ class BBoxConfig:
         option = "EMMA_DEVICE_JAR"
         return self._getOption(section, option)
     
+    def getEmmaIncludeFilters(self):
+        section = "EMMA"
+        option = "EMMA_INCLUDE_FILTERS"
+        return self._getOption(section, option)
+    
+    def getEmmaExcludeFilters(self):
+        section = "EMMA"
+        option = "EMMA_EXCLUDE_FILTERS"
+        return self._getOption(section, option)
+    
+    def useEmmaAutoFilters(self):
+        section = "EMMA"
+        option = "EMMA_AUTO_FILTERS"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def instrumentJarsInOneEmmaRun(self):
+        section = "EMMA"
+        option = "EMMA_SINGLE_RUN"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
     def getEmmaResourcesDir(self):
         section = "EMMA"
         option = "EMMA_RESOURCES_DIR"
@@ -277,8 +412,242 @@ class BBoxConfig:
         option = "ZIPALIGN_EXE"
         return self._getOption(section, option)
     
+    def useNativeZipalign(self):
+        section = "ZIPALIGN"
+        option = "USE_NATIVE_ZIPALIGN"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getZipalignAlignment(self):
+        section = "ZIPALIGN"
+        option = "ZIPALIGN_ALIGNMENT"
+        return int(self._getOption(section, option))
+    
+    
+    #TOOLSERVER
+    def useToolServer(self):
+        section = "TOOLSERVER"
+        option = "USE_TOOLSERVER"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getToolServerJavaPath(self):
+        section = "TOOLSERVER"
+        option = "TOOLSERVER_JAVA_PATH"
+        return self._getOption(section, option)
+    
+    def getToolServerJavaOpts(self):
+        section = "TOOLSERVER"
+        option = "TOOLSERVER_JAVA_OPTS"
+        return self._getOption(section, option)
+    
+    def getToolServerPath(self):
+        section = "TOOLSERVER"
+        option = "TOOLSERVER_PATH"
+        return self._getOption(section, option)
+    
+    def getToolServerJar(self):
+        section = "TOOLSERVER"
+        option = "TOOLSERVER_JAR"
+        return self._getOption(section, option)
+    
+    def getToolServerMemoryThreshold(self):
+        section = "TOOLSERVER"
+        option = "TOOLSERVER_MEMORY_THRESHOLD_MB"
+        return int(self._getOption(section, option))
+    
+    
+    #SIGNING
+    def getSigner(self):
+        section = "SIGNING"
+        option = "SIGNER"
+        return self._getOption(section, option).upper()
+    
+    def getSigningThreads(self):
+        section = "SIGNING"
+        option = "SIGNING_THREADS"
+        return int(self._getOption(section, option))
+    
+    def getSigningKeyFile(self):
+        section = "SIGNING"
+        option = "SIGNING_KEY_FILE"
+        return self._getOption(section, option)
+    
+    def getSigningCertFile(self):
+        section = "SIGNING"
+        option = "SIGNING_CERT_FILE"
+        return self._getOption(section, option)
+    
+    def getSigningDigestAlgorithm(self):
+        section = "SIGNING"
+        option = "SIGNING_DIGEST_ALGORITHM"
+        return self._getOption(section, option).upper()
+    
+    def getOpensslExe(self):
+        section = "SIGNING"
+        option = "OPENSSL_EXE"
+        return self._getOption(section, option)
+    
+    
+    #WORKSPACE
+    def useTmpfsWorkspace(self):
+        section = "WORKSPACE"
+        option = "USE_TMPFS"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getTmpfsWorkspaceDir(self):
+        section = "WORKSPACE"
+        option = "TMPFS_DIR"
+        return self._getOption(section, option)
+    
+    def getTmpfsWorkspaceBudget(self):
+        section = "WORKSPACE"
+        option = "TMPFS_BUDGET_MB"
+        return int(self._getOption(section, option))
+    
+    def releaseConsumedStages(self):
+        section = "WORKSPACE"
+        option = "RELEASE_CONSUMED_STAGES"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    
+    #BATCH
+    def getBatchWorkers(self):
+        section = "BATCH"
+        option = "BATCH_WORKERS"
+        return int(self._getOption(section, option))
+    
+    def getBatchApkTimeout(self):
+        section = "BATCH"
+        option = "BATCH_APK_TIMEOUT_SEC"
+        return int(self._getOption(section, option))
+    
+    def getBatchTmpMaxSize(self):
+        section = "BATCH"
+        option = "BATCH_TMP_MAX_SIZE_MB"
+        return int(self._getOption(section, option))
+    
+    
+    #CACHE
+    def useInstrCache(self):
+        section = "CACHE"
+        option = "USE_INSTR_CACHE"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getInstrCacheDir(self):
+        section = "CACHE"
+        option = "INSTR_CACHE_DIR"
+        return self._getOption(section, option)
+    
+    def getInstrCacheMaxSize(self):
+        section = "CACHE"
+        option = "INSTR_CACHE_MAX_SIZE_MB"
+        return int(self._getOption(section, option))
+    
+    def useEmmaClassCache(self):
+        section = "CACHE"
+        option = "USE_EMMA_CLASS_CACHE"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getEmmaClassCacheDir(self):
+        section = "CACHE"
+        option = "EMMA_CLASS_CACHE_DIR"
+        return self._getOption(section, option)
+    
+    def getEmmaClassCacheMaxSize(self):
+        section = "CACHE"
+        option = "EMMA_CLASS_CACHE_MAX_SIZE_MB"
+        return int(self._getOption(section, option))
+    
+    def getEmmaClassCacheMinGroupSize(self):
+        section = "CACHE"
+        option = "EMMA_CLASS_CACHE_MIN_GROUP_SIZE"
+        return int(self._getOption(section, option))
+    
+    
+    #PRESCAN
+    def usePrescan(self):
+        section = "PRESCAN"
+        option = "USE_PRESCAN"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getPrescanCacheDir(self):
+        section = "PRESCAN"
+        option = "PRESCAN_CACHE_DIR"
+        return self._getOption(section, option)
+    
+    def getPrescanMethodLimit(self):
+        section = "PRESCAN"
+        option = "PRESCAN_METHOD_LIMIT"
+        return int(self._getOption(section, option))
+    
+    def getPrescanMethodsPerClass(self):
+        section = "PRESCAN"
+        option = "PRESCAN_METHODS_PER_CLASS"
+        return int(self._getOption(section, option))
+    
+    
+    #JVM_HEAP
+    def useAdaptiveHeap(self):
+        section = "JVM_HEAP"
+        option = "ADAPTIVE_HEAP"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    def getHeapModelFile(self):
+        section = "JVM_HEAP"
+        option = "HEAP_MODEL_FILE"
+        return self._getOption(section, option)
+    
+    def getHeapMinMb(self):
+        section = "JVM_HEAP"
+        option = "HEAP_MIN_MB"
+        return int(self._getOption(section, option))
+    
+    def getHeapMaxMb(self):
+        section = "JVM_HEAP"
+        option = "HEAP_MAX_MB"
+        return int(self._getOption(section, option))
+    
+    def getHeapHeadroom(self):
+        section = "JVM_HEAP"
+        option = "HEAP_HEADROOM"
+        return float(self._getOption(section, option))
+    
+    def getHeapMemoryLimitMb(self):
+        section = "JVM_HEAP"
+        option = "HEAP_MEMORY_LIMIT_MB"
+        return int(self._getOption(section, option))
+    
+    def retryOnOutOfMemory(self):
+        section = "JVM_HEAP"
+        option = "HEAP_RETRY_ON_OOM"
+        return auxiliary_utils.to_bool(self._getOption(section, option))
+    
+    
+    #COMMANDS
+    def getJvmCommandsLimit(self):
+        section = "COMMANDS"
+        option = "JVM_COMMANDS_LIMIT"
+        return int(self._getOption(section, option))
+    
+    def getAdbCommandsLimit(self):
+        section = "COMMANDS"
+        option = "ADB_COMMANDS_LIMIT"
+        return int(self._getOption(section, option))
+    
+    def getDiskCommandsLimit(self):
+        section = "COMMANDS"
+        option = "DISK_COMMANDS_LIMIT"
+        return int(self._getOption(section, option))
+    
+    def getOtherCommandsLimit(self):
+        section = "COMMANDS"
+        option = "OTHER_COMMANDS_LIMIT"
+        return int(self._getOption(section, option))
+    
     
     #AUXILIARY METHODS
+    def getOptionValue(self, section, option):
+        return self._getOption(section, option)
+    
     def _getOption(self, section, option):
         value = self._getOptionFromConfigFile(section, option)
         if not value:
@@ -0,0 +1,222 @@
+'''
+Content-addressed cache of instrumented apk files.
+
+An entry is keyed on the SHA-256 of the original apk file and a fingerprint of
+the toolchain (tool jars, Emma resources, instrumentation classes, signing key
+and the config options that influence the instrumentation result). An entry stores the
+final (aligned) instrumented apk, the instrumented AndroidManifest.xml and the
+Emma metadata file.
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from utils import auxiliary_utils
+from logconfig import logger
+
+
+ENTRY_INFO_FILE = "entry.json"
+ENTRY_APK_FILE = "instrumented.apk"
+ENTRY_MANIFEST_FILE = "AndroidManifest.xml"
+ENTRY_METADATA_FILE = "coverage.em"
+
+#(section, option) pairs of BBoxConfig that influence the instrumented apk
+FINGERPRINT_OPTIONS = [
+    ("GENERAL", "PIPELINE_MODE"),
+    ("GENERAL", "KEEP_INTERMEDIATE_APKS"),
+    ("APKTOOL", "APKTOOL_JAR"),
+    ("DEX2JAR", "DEX2JAR_CLASS_DEX2JAR"),
+    ("DEX2JAR", "DEX2JAR_CLASS_APKSIGN"),
+    ("DX", "DX_JAR"),
+    ("DX", "DX_MULTIDEX"),
+    ("DX", "DX_MULTIDEX_THRESHOLD"),
+    ("EMMA", "EMMA_JAR"),
+    ("EMMA", "EMMA_DEVICE_JAR"),
+    ("EMMA", "EMMA_INCLUDE_FILTERS"),
+    ("EMMA", "EMMA_EXCLUDE_FILTERS"),
+    ("EMMA", "EMMA_AUTO_FILTERS"),
+    ("ZIPALIGN", "ZIPALIGN_ALIGNMENT"),
+    ("SIGNING", "SIGNER"),
+    ("SIGNING", "SIGNING_KEY_FILE"),
+    ("SIGNING", "SIGNING_CERT_FILE"),
+    ("SIGNING", "SIGNING_DIGEST_ALGORITHM"),
+]
+
+
+class BBoxInstrCache:
+    def __init__(self, config):
+        self.config = config
+        self.cacheDir = os.path.abspath(config.getInstrCacheDir())
+        self.maxSize = config.getInstrCacheMaxSize() * 1024 * 1024
+        self._toolchainFingerprint = None
+
+    def getToolchainFingerprint(self):
+        '''
+        Computes (once per object) the fingerprint of the tools and the options
+        used for instrumentation.
+        '''
+        if self._toolchainFingerprint:
+            return self._toolchainFingerprint
+
+        paths = [
+            os.path.join(self.config.getApktoolPath(), self.config.getApktoolJar()),
+            self.config.getDex2LibsPath(),
+            os.path.join(self.config.getDxPath(), self.config.getDxJar()),
+            os.path.join(self.config.getEmmaDir(), self.config.getEmmaJar()),
+            os.path.join(self.config.getEmmaDir(), self.config.getEmmaDeviceJar()),
+            self.config.getEmmaResourcesDir(),
+            self.config.getAndroidSpecificInstrumentationClassesPath(),
+            self.config.getAaptPath(),
+            os.path.join(self.config.getZipalignDir(), self.config.getZipalingExe()),
+        ]
+        #the apk is signed with the content of the key files, not their paths
+        for path in [self.config.getSigningKeyFile(), self.config.getSigningCertFile()]:
+            if path:
+                paths.append(path)
+        h = hashlib.sha256()
+        for path in paths:
+            h.update(path)
+            if os.path.exists(path):
+                h.update(auxiliary_utils.getDirHash(path))
+        for (section, option) in FINGERPRINT_OPTIONS:
+            h.update("%s.%s=%s" % (section, option, self.config.getOptionValue(section, option)))
+
+        self._toolchainFingerprint = h.hexdigest()
+        return self._toolchainFingerprint
+
+    def computeKey(self, pathToApk, apkHash=None):
+        '''
+        Returns the cache key of the provided apk file. The hash of the apk
+        file is computed if it is not provided.
+        '''
+        if not apkHash:
+            apkHash = auxiliary_utils.getFileHash(pathToApk)
+        return hashlib.sha256("%s:%s" % (apkHash, self.getToolchainFingerprint())).hexdigest()
+
+    def lookup(self, key):
+        '''
+        Returns the path to the entry directory for the key or None if there is
+        no such entry. The access time of the entry is updated.
+        '''
+        entryDir = self._getEntryDir(key)
+        info = self._readEntryInfo(entryDir)
+        if not info:
+            return None
+        info["lastAccess"] = time.time()
+        self._writeEntryInfo(entryDir, info)
+        return entryDir
+
+    def restore(self, entryDir, apkPath, manifestPath, metadataPath):
+        '''
+        Populates the provided paths with the files of the cache entry. Hard
+        links are used when possible.
+        '''
+        auxiliary_utils.linkOrCopyFile(os.path.join(entryDir, ENTRY_APK_FILE), apkPath)
+        auxiliary_utils.linkOrCopyFile(os.path.join(entryDir, ENTRY_MANIFEST_FILE), manifestPath)
+        auxiliary_utils.linkOrCopyFile(os.path.join(entryDir, ENTRY_METADATA_FILE), metadataPath)
+
+    def store(self, key, apkPath, manifestPath, metadataPath, apkName=None):
+        '''
+        Puts the results of the instrumentation into the cache and evicts the
+        least recently used entries if the cache exceeds the size limit.
+        '''
+        entryDir = self._getEntryDir(key)
+        if os.path.isdir(entryDir):
+            return entryDir
+
+        auxiliary_utils.ensureDirExists(os.path.dirname(entryDir))
+        #the entry is prepared in a tmp dir and renamed to appear atomically
+        tmpEntryDir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entryDir))
+        try:
+            shutil.copy2(apkPath, os.path.join(tmpEntryDir, ENTRY_APK_FILE))
+            shutil.copy2(manifestPath, os.path.join(tmpEntryDir, ENTRY_MANIFEST_FILE))
+            shutil.copy2(metadataPath, os.path.join(tmpEntryDir, ENTRY_METADATA_FILE))
+            now = time.time()
+            info = {
+                "key" : key,
+                "apkName" : apkName,
+                "created" : now,
+                "lastAccess" : now,
+                "size" : auxiliary_utils.getDirSize(tmpEntryDir),
+            }
+            self._writeEntryInfo(tmpEntryDir, info)
+            os.rename(tmpEntryDir, entryDir)
+        except (OSError, IOError):
+            shutil.rmtree(tmpEntryDir, ignore_errors=True)
+            if not os.path.isdir(entryDir):
+                raise
+
+        self.evict(self.maxSize)
+        return entryDir
+
+    def listEntries(self):
+        '''
+        Returns the list of entry info dicts sorted from the least to the most
+        recently used. Each dict additionally contains the "path" of the entry.
+        '''
+        entries = []
+        if not os.path.isdir(self.cacheDir):
+            return entries
+        for prefix in os.listdir(self.cacheDir):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            if not os.path.isdir(prefixDir):
+                continue
+            for key in os.listdir(prefixDir):
+                entryDir = os.path.join(prefixDir, key)
+                info = self._readEntryInfo(entryDir)
+                if info:
+                    info["path"] = entryDir
+                    entries.append(info)
+        entries.sort(key=lambda e: e["lastAccess"])
+        return entries
+
+    def getTotalSize(self):
+        return sum(e["size"] for e in self.listEntries())
+
+    def evict(self, maxSize=None, olderThan=None):
+        '''
+        Removes the least recently used entries until the total size of the
+        cache is not larger than maxSize. Additionally, removes entries that
+        have not been accessed during the last olderThan seconds.
+
+        Returns:
+            :ret list of removed entries
+        '''
+        entries = self.listEntries()
+        totalSize = sum(e["size"] for e in entries)
+        removed = []
+        now = time.time()
+        for entry in entries:
+            expired = olderThan is not None and (now - entry["lastAccess"]) > olderThan
+            oversized = maxSize is not None and totalSize > maxSize
+            if not (expired or oversized):
+                continue
+            logger.debug("Removing instrumentation cache entry [%s]" % entry["path"])
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            totalSize -= entry["size"]
+            removed.append(entry)
+        return removed
+
+    def clear(self):
+        return self.evict(maxSize=0)
+
+
+    def _getEntryDir(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def _readEntryInfo(self, entryDir):
+        try:
+            with open(os.path.join(entryDir, ENTRY_INFO_FILE), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _writeEntryInfo(self, entryDir, info):
+        infoPath = os.path.join(entryDir, ENTRY_INFO_FILE)
+        tmpInfoPath = infoPath + ".tmp"
+        with open(tmpInfoPath, "w") as f:
+            json.dump(info, f)
+        os.rename(tmpInfoPath, infoPath)
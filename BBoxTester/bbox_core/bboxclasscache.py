@@ -0,0 +1,244 @@
+'''
+Cache of Emma-instrumented classes of common third-party libraries.
+
+Emma instruments every class independently of the others, so identical class
+files produce identical instrumented classes and metadata. The classes of a
+jar file that belong to a well-known library namespace (see
+utils.emma_filters.THIRD_PARTY_PACKAGES) form a group. A group is keyed on the
+names and the SHA-1 of the bytes of its classes and the fingerprint of Emma.
+An entry stores the instrumented classes of the group and the Emma metadata
+of exactly these classes, so the metadata of cached groups can be merged into
+the metadata of any app bundling the same library.
+
+Only the classes that are not in cached groups are sent to Emma; the
+instrumented jar file is reassembled from the output of Emma and the cached
+groups. A group seen for the first time is instrumented separately to obtain
+its own metadata.
+'''
+import os
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+from fnmatch import fnmatchcase
+
+from bbox_core.bboxcache import BBoxInstrCache
+from bbox_core.bboxinstrumenter import EmmaCannotInstrumentException, \
+    EmmaCannotMergeException
+from utils import auxiliary_utils
+from utils.emma_filters import THIRD_PARTY_PACKAGES
+from logconfig import logger
+
+
+ENTRY_CLASSES_FILE = "classes.jar"
+ENTRY_METADATA_FILE = "metadata.em"
+
+
+class BBoxEmmaClassCache(BBoxInstrCache):
+    def __init__(self, config):
+        BBoxInstrCache.__init__(self, config)
+        self.cacheDir = os.path.abspath(config.getEmmaClassCacheDir())
+        self.maxSize = config.getEmmaClassCacheMaxSize() * 1024 * 1024
+        self.minGroupSize = config.getEmmaClassCacheMinGroupSize()
+
+    def getToolchainFingerprint(self):
+        '''
+        Instrumented classes depend only on the version of Emma.
+        '''
+        if not self._toolchainFingerprint:
+            emmaJar = os.path.join(self.config.getEmmaDir(), self.config.getEmmaJar())
+            h = hashlib.sha256()
+            if os.path.exists(emmaJar):
+                h.update(auxiliary_utils.getFileHash(emmaJar))
+            self._toolchainFingerprint = h.hexdigest()
+        return self._toolchainFingerprint
+
+    def computeGroupKey(self, classes):
+        '''
+        Args:
+            :param classes: list of (class name, class file bytes)
+        '''
+        h = hashlib.sha256(self.getToolchainFingerprint())
+        for (className, data) in sorted(classes):
+            h.update("%s:%s\n" % (className, hashlib.sha1(data).hexdigest()))
+        return h.hexdigest()
+
+    def store(self, key, classesJar, metadataFile, groupName=None):
+        '''
+        Puts the instrumented classes of a group and their metadata into the
+        cache.
+        '''
+        entryDir = self._getEntryDir(key)
+        if os.path.isdir(entryDir):
+            return entryDir
+
+        auxiliary_utils.ensureDirExists(os.path.dirname(entryDir))
+        tmpEntryDir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(entryDir))
+        try:
+            shutil.copy2(classesJar, os.path.join(tmpEntryDir, ENTRY_CLASSES_FILE))
+            shutil.copy2(metadataFile, os.path.join(tmpEntryDir, ENTRY_METADATA_FILE))
+            now = time.time()
+            info = {
+                "key" : key,
+                "group" : groupName,
+                "created" : now,
+                "lastAccess" : now,
+                "size" : auxiliary_utils.getDirSize(tmpEntryDir),
+            }
+            self._writeEntryInfo(tmpEntryDir, info)
+            os.rename(tmpEntryDir, entryDir)
+        except (OSError, IOError):
+            shutil.rmtree(tmpEntryDir, ignore_errors=True)
+            if not os.path.isdir(entryDir):
+                raise
+
+        self.evict(self.maxSize)
+        return entryDir
+
+    def instrumentJar(self, instrumenter, jarFile, outputFolder, emmaMetadataFile, filters=[]):
+        '''
+        Instruments the jar file like BBoxInstrumenter.instrumentJarWithEmma
+        but takes the classes of known libraries from the cache.
+
+        Raises:
+            EmmaCannotInstrumentException: if the jar file cannot be instrumented
+        '''
+        auxiliary_utils.ensureDirExists(outputFolder)
+        workDir = tempfile.mkdtemp(prefix=".emma_", dir=outputFolder)
+        try:
+            self._instrumentJar(instrumenter, jarFile, outputFolder, emmaMetadataFile, filters, workDir)
+        except EmmaCannotMergeException as e:
+            raise EmmaCannotInstrumentException(e.msg)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError) as e:
+            raise EmmaCannotInstrumentException("Cannot instrument [%s] using class cache: %s" % (jarFile, str(e)))
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    def _instrumentJar(self, instrumenter, jarFile, outputFolder, emmaMetadataFile, filters, workDir):
+        jarName = os.path.basename(jarFile)
+        cachedEntries = []
+        cachedNames = set()
+        with zipfile.ZipFile(jarFile, "r") as jar:
+            for (groupName, zinfos) in self._groupClasses(jar, filters):
+                classes = [(zinfo.filename, jar.read(zinfo)) for zinfo in zinfos]
+                key = self.computeGroupKey(classes)
+                entryDir = self.lookup(key)
+                if not entryDir:
+                    entryDir = self._instrumentGroup(instrumenter, key, groupName, classes, workDir)
+                if entryDir:
+                    cachedEntries.append(entryDir)
+                    cachedNames.update([zinfo.filename for zinfo in zinfos])
+
+            if not cachedEntries:
+                instrumenter.instrumentJarWithEmma(jarFile, outputFolder, emmaMetadataFile, filters)
+                return
+            logger.debug("Taking %d classes of [%s] from the class cache" % (len(cachedNames), jarFile))
+
+            #the rest of the jar file goes through Emma
+            restJar = os.path.join(workDir, "rest", jarName)
+            restHasClasses = _copyJarEntries(jar, restJar, lambda name: name not in cachedNames)
+
+        restOutDir = os.path.join(workDir, "rest_out")
+        if restHasClasses:
+            instrumenter.instrumentJarWithEmma(restJar, restOutDir, emmaMetadataFile, filters)
+            restInstrJar = os.path.join(restOutDir, jarName)
+        else:
+            restInstrJar = restJar
+
+        metadataFiles = [os.path.join(entryDir, ENTRY_METADATA_FILE) for entryDir in cachedEntries]
+        if os.path.exists(emmaMetadataFile):
+            metadataFiles.insert(0, emmaMetadataFile)
+        mergedMetadataFile = os.path.join(workDir, "merged.em")
+        instrumenter.mergeEmmaMetadataFiles(metadataFiles, mergedMetadataFile)
+        shutil.move(mergedMetadataFile, emmaMetadataFile)
+
+        outputJar = os.path.join(outputFolder, jarName)
+        with zipfile.ZipFile(outputJar, "w", zipfile.ZIP_DEFLATED) as out:
+            with zipfile.ZipFile(restInstrJar, "r") as restInstr:
+                for zinfo in restInstr.infolist():
+                    out.writestr(zinfo, restInstr.read(zinfo))
+            for entryDir in cachedEntries:
+                with zipfile.ZipFile(os.path.join(entryDir, ENTRY_CLASSES_FILE), "r") as groupJar:
+                    for zinfo in groupJar.infolist():
+                        out.writestr(zinfo, groupJar.read(zinfo))
+
+    def _instrumentGroup(self, instrumenter, key, groupName, classes, workDir):
+        '''
+        Instruments the classes of a group seen for the first time and puts
+        them into the cache.
+
+        Returns:
+            :ret path to the cache entry or None if the group cannot be instrumented
+        '''
+        groupDir = os.path.join(workDir, key)
+        groupJar = os.path.join(groupDir, "group.jar")
+        auxiliary_utils.ensureDirExists(groupDir)
+        with zipfile.ZipFile(groupJar, "w", zipfile.ZIP_DEFLATED) as jar:
+            for (name, data) in classes:
+                jar.writestr(name, data)
+        groupMetadataFile = os.path.join(groupDir, "group.em")
+        groupOutDir = os.path.join(groupDir, "out")
+        try:
+            instrumenter.instrumentJarWithEmma(groupJar, groupOutDir, groupMetadataFile)
+        except EmmaCannotInstrumentException as e:
+            logger.warning("Cannot instrument classes of [%s] separately, leaving them to the jar. %s" % (groupName, e.msg))
+            return None
+        if not os.path.exists(groupMetadataFile):
+            #Emma writes no metadata if no class has code to instrument
+            return None
+        try:
+            return self.store(key, os.path.join(groupOutDir, "group.jar"), groupMetadataFile, groupName)
+        except (OSError, IOError) as e:
+            logger.warning("Cannot put classes of [%s] into the class cache! %s" % (groupName, str(e)))
+            return None
+
+    def _groupClasses(self, jar, filters):
+        '''
+        Returns the list of (library namespace, zip infos of its classes). The
+        classes excluded by the filters are not grouped: Emma copies them.
+        '''
+        groups = {}
+        for zinfo in jar.infolist():
+            if not zinfo.filename.endswith(".class"):
+                continue
+            className = zinfo.filename[:-len(".class")].replace("/", ".")
+            groupName = _getLibraryNamespace(className)
+            if groupName and _isIncludedByFilters(className, filters):
+                groups.setdefault(groupName, []).append(zinfo)
+        return [(groupName, zinfos) for (groupName, zinfos) in sorted(groups.items())
+                if len(zinfos) >= self.minGroupSize]
+
+
+def _getLibraryNamespace(className):
+    namespaces = [pkg for pkg in THIRD_PARTY_PACKAGES if className.startswith(pkg + ".")]
+    if not namespaces:
+        return None
+    return max(namespaces, key=len)
+
+def _isIncludedByFilters(className, filters):
+    '''
+    Emma instruments a class if it matches an inclusion pattern (or there is
+    none) and does not match any exclusion pattern.
+    '''
+    includes = [fltr[1:] for fltr in filters if fltr.startswith("+")]
+    excludes = [fltr[1:] for fltr in filters if fltr.startswith("-")]
+    if includes and not any(fnmatchcase(className, pattern) for pattern in includes):
+        return False
+    return not any(fnmatchcase(className, pattern) for pattern in excludes)
+
+def _copyJarEntries(jar, path, accept):
+    '''
+    Copies the accepted entries of the jar file into a new jar file.
+
+    Returns:
+        :ret True if a class file has been copied
+    '''
+    hasClasses = False
+    auxiliary_utils.ensureDirExists(os.path.dirname(path))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as out:
+        for zinfo in jar.infolist():
+            if accept(zinfo.filename):
+                out.writestr(zinfo, jar.read(zinfo))
+                hasClasses = hasClasses or zinfo.filename.endswith(".class")
+    return hasClasses
@@ -7,6 +7,8 @@ import string
 
 from bbox_core.general_exceptions import MsgException
 from interfaces.adb_interface import AdbInterface, TYPE_STRING, TYPE_BOOLEAN
+from interfaces.command_executor import RESOURCE_ADB
+from interfaces import commander
 from logconfig import logger
 import os
 
@@ -34,6 +36,7 @@ class BBoxExecutor:
         self.testStarted = False
         self.device = AdbInterface()
         self.config = config #maybe it will be required for future use
+        commander.getExecutor().setLimit(RESOURCE_ADB, self.config.getAdbCommandsLimit())
         
     def selectExecutionDevice(self):
         '''
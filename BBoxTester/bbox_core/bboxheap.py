@@ -0,0 +1,273 @@
+'''
+Sizing of the heap of the java tools.
+
+Every tool run in a separate JVM gets the maximum heap (-Xmx) predicted from
+the size of its input files. The prediction is a linear fit of the peak RSS
+of the previous runs of the tool (the peak RSS of a JVM is an upper bound of
+the heap it has used) multiplied by the headroom factor. The samples are
+kept in a json file shared by the runs. Until a tool has been run with
+inputs of at least two different sizes, the heap set in its *_JAVA_OPTS
+option is used.
+
+The heaps of the tools run at the same time by this process are limited by
+the memory limit: a tool waits until the heap it needs is available. The
+parallel worker processes (dex files, batch jobs) are limited by the heaps
+predicted for their inputs. A tool
+that has failed with an OutOfMemoryError is run once more with twice the
+heap.
+
+The tools run in the tool server share its JVM and are not sized.
+'''
+import os
+import re
+import json
+import math
+import threading
+
+from interfaces import commander
+from interfaces.command_metrics import maxRssToBytes
+from utils import auxiliary_utils
+from logconfig import logger
+
+
+TOOL_APKTOOL = "apktool"
+TOOL_DEX2JAR = "dex2jar"
+TOOL_DX = "dx"
+TOOL_EMMA = "emma"
+
+HEAP_MODEL_VERSION = 1
+MAX_SAMPLES_PER_TOOL = 50
+OUT_OF_MEMORY_MARKER = "OutOfMemoryError"
+#share of the physical memory used if the memory limit is not set
+PHYSICAL_MEMORY_SHARE = 0.75
+
+MB = 1024 * 1024
+JVM_SIZE_UNITS = {"" : 1, "k" : 1024, "m" : MB, "g" : 1024 * MB, "t" : 1024 * 1024 * MB}
+XMX_RE = re.compile(r"(?<!\S)-Xmx(\d+)([kKmMgGtT]?)(?!\S)")
+XMS_RE = re.compile(r"(?<!\S)-Xms(\d+)([kKmMgGtT]?)(?!\S)")
+
+#the heaps reserved by the tools running in this process
+_reservedHeap = [0]
+_reservedHeapCondition = threading.Condition()
+_modelLock = threading.Lock()
+
+
+class BBoxHeapManager:
+    def __init__(self, config):
+        self.config = config
+        self.adaptive = config.useAdaptiveHeap()
+        self.modelFile = config.getHeapModelFile()
+        self.minHeap = config.getHeapMinMb()
+        self.maxHeap = config.getHeapMaxMb()
+        self.headroom = config.getHeapHeadroom()
+        self.retryOnOutOfMemory = config.retryOnOutOfMemory()
+        self.memoryLimit = config.getHeapMemoryLimitMb() or _getDefaultMemoryLimit()
+        self._configuredJavaOpts = {
+            TOOL_APKTOOL : config.getApktoolJavaOpts,
+            TOOL_DEX2JAR : config.getDex2JarJavaOpts,
+            TOOL_DX : config.getDxJavaOpts,
+            TOOL_EMMA : config.getEmmaJavaOpts,
+        }
+        self._local = threading.local()
+
+    def run(self, tool, javaInterface, inputPaths, run):
+        '''
+        Runs the java tool with the heap sized for its input files.
+
+        Args:
+            :param tool: name of the tool (e.g., TOOL_DX)
+            :param javaInterface: interface of the tool; its javaOpts are set
+                for every run and restored afterwards
+            :param inputPaths: paths to the files and directories processed
+                by the tool
+            :param run: function without arguments that runs the tool and
+                returns (successfulRun, cmdOutput)
+
+        Returns:
+            :ret (successfulRun, cmdOutput) of the last run
+        '''
+        if not self.adaptive or commander.getToolServer():
+            return run()
+        configuredJavaOpts = javaInterface.javaOpts
+        inputSize = getInputSize(inputPaths)
+        heapSize = self.getHeapSize(tool, inputSize, configuredJavaOpts)
+        retried = False
+        try:
+            while True:
+                javaInterface.javaOpts = setHeapSize(configuredJavaOpts, heapSize)
+                (successfulRun, cmdOutput, peakRss) = self._runWithReservedHeap(heapSize, run)
+                if successfulRun:
+                    self._addSample(tool, inputSize, peakRss)
+                    break
+                outOfMemory = cmdOutput is not None and OUT_OF_MEMORY_MARKER in cmdOutput
+                if not outOfMemory or not self.retryOnOutOfMemory or retried or heapSize >= self.maxHeap:
+                    break
+                retryHeapSize = min(2 * heapSize, self.maxHeap)
+                logger.warning("[%s] has run out of memory with %dm heap. Retrying with %dm..." % (tool, heapSize, retryHeapSize))
+                heapSize = retryHeapSize
+                retried = True
+        finally:
+            javaInterface.javaOpts = configuredJavaOpts
+        return (successfulRun, cmdOutput)
+
+    def getHeapSize(self, tool, inputSize, javaOpts=None):
+        '''
+        Returns the heap (in MB) predicted for the run of the tool with the
+        input of the given size (in bytes).
+
+        Args:
+            :param javaOpts: options of the tool; the heap set there is used
+                if there is no prediction (default: the *_JAVA_OPTS option
+                of the tool)
+        '''
+        predicted = _predictPeakRss(self._loadModel().get(tool, []), inputSize)
+        if predicted is None:
+            if javaOpts is None:
+                javaOpts = self._configuredJavaOpts[tool]()
+            heapSize = getHeapSize(javaOpts) or self.maxHeap
+        else:
+            heapSize = int(math.ceil(predicted * self.headroom / MB))
+        return max(self.minHeap, min(self.maxHeap, heapSize))
+
+    def getMaxHeapSize(self, tools, inputSize):
+        '''
+        Returns the largest heap (in MB) predicted for the tools with the
+        input of the given size.
+        '''
+        return max([self.getHeapSize(tool, inputSize) for tool in tools])
+
+    def getMaxConcurrency(self, tools, inputSize):
+        '''
+        Returns the number of the runs of the tools (e.g., in parallel worker
+        processes) with the input of the given size which fit into the
+        memory limit at the same time or None if there is no limit.
+        '''
+        if not self.adaptive or not self.memoryLimit:
+            return None
+        return max(1, self.memoryLimit // self.getMaxHeapSize(tools, inputSize))
+
+
+    def _runWithReservedHeap(self, heapSize, run):
+        _reserveHeap(heapSize, self.memoryLimit)
+        self._local.peakRss = None
+        commander.addUsageListener(self._onCommandFinished)
+        try:
+            (successfulRun, cmdOutput) = run()
+        finally:
+            commander.removeUsageListener(self._onCommandFinished)
+            _releaseHeap(heapSize)
+        return (successfulRun, cmdOutput, self._local.peakRss)
+
+    def _onCommandFinished(self, cmd, wallTime, rusage):
+        #the listener is called in the thread that has run the command
+        if rusage is None or not hasattr(self._local, "peakRss"):
+            return
+        rss = maxRssToBytes(rusage.ru_maxrss)
+        if self._local.peakRss is None or rss > self._local.peakRss:
+            self._local.peakRss = rss
+
+    def _loadModel(self):
+        try:
+            with open(self.modelFile, "r") as f:
+                model = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if model.get("version") != HEAP_MODEL_VERSION:
+            return {}
+        return model.get("tools", {})
+
+    def _addSample(self, tool, inputSize, peakRss):
+        if not peakRss:
+            return
+        with _modelLock:
+            tools = self._loadModel()
+            samples = tools.get(tool, []) + [[inputSize, peakRss]]
+            tools[tool] = samples[-MAX_SAMPLES_PER_TOOL:]
+            try:
+                auxiliary_utils.ensureDirExists(os.path.dirname(os.path.abspath(self.modelFile)))
+                #the model is shared with other processes
+                tmpModelFile = "%s.%d.tmp" % (self.modelFile, os.getpid())
+                with open(tmpModelFile, "w") as f:
+                    json.dump({"version" : HEAP_MODEL_VERSION, "tools" : tools}, f)
+                os.rename(tmpModelFile, self.modelFile)
+            except (IOError, OSError) as e:
+                logger.warning("Cannot save heap model [%s]! %s" % (self.modelFile, str(e)))
+
+
+def getInputSize(paths):
+    '''
+    Returns the total size (in bytes) of the files and the directories.
+    '''
+    size = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                size += sum([os.path.getsize(os.path.join(root, fn)) for fn in files
+                             if os.path.isfile(os.path.join(root, fn))])
+        elif os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size
+
+def getHeapSize(javaOpts):
+    '''
+    Returns the maximum heap (in MB) set by -Xmx in the java options or None.
+    '''
+    match = XMX_RE.search(javaOpts or "")
+    if not match:
+        return None
+    return _toBytes(match) // MB
+
+def setHeapSize(javaOpts, heapSize):
+    '''
+    Returns the java options with the maximum heap set to heapSize MB. The
+    initial heap (-Xms) is lowered if it is larger than the maximum one.
+    '''
+    javaOpts = javaOpts or ""
+    xmx = "-Xmx%dm" % heapSize
+    if XMX_RE.search(javaOpts):
+        javaOpts = XMX_RE.sub(xmx, javaOpts)
+    else:
+        javaOpts = ("%s %s" % (javaOpts, xmx)).strip()
+    match = XMS_RE.search(javaOpts)
+    if match and _toBytes(match) > heapSize * MB:
+        javaOpts = XMS_RE.sub("-Xms%dm" % heapSize, javaOpts)
+    return javaOpts
+
+
+def _toBytes(match):
+    return int(match.group(1)) * JVM_SIZE_UNITS[match.group(2).lower()]
+
+def _predictPeakRss(samples, inputSize):
+    '''
+    Least squares fit of peak RSS against input size. Returns None if the
+    samples have less than two different input sizes.
+    '''
+    if len(set([size for (size, _) in samples])) < 2:
+        return None
+    n = float(len(samples))
+    meanSize = sum([size for (size, _) in samples]) / n
+    meanRss = sum([rss for (_, rss) in samples]) / n
+    covariance = sum([(size - meanSize) * (rss - meanRss) for (size, rss) in samples])
+    variance = sum([(size - meanSize) ** 2 for (size, _) in samples])
+    #larger inputs never need less memory
+    slope = max(0.0, covariance / variance)
+    return max(0.0, meanRss + slope * (inputSize - meanSize))
+
+def _getDefaultMemoryLimit():
+    try:
+        physicalMemory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+    return int(physicalMemory * PHYSICAL_MEMORY_SHARE) // MB
+
+def _reserveHeap(heapSize, memoryLimit):
+    with _reservedHeapCondition:
+        #a tool needing more than the limit runs alone
+        while memoryLimit and _reservedHeap[0] and _reservedHeap[0] + heapSize > memoryLimit:
+            _reservedHeapCondition.wait()
+        _reservedHeap[0] += heapSize
+
+def _releaseHeap(heapSize):
+    with _reservedHeapCondition:
+        _reservedHeap[0] -= heapSize
+        _reservedHeapCondition.notify_all()
@@ -5,24 +5,85 @@ Created on Sep 30, 2014
 '''
 
 import os
+import atexit
+import zipfile
+import tempfile
 
 from bbox_core.general_exceptions import MsgException
 from bbox_core.bbox_config import BBoxConfig
+from bbox_core.bboxheap import BBoxHeapManager, TOOL_APKTOOL, TOOL_DEX2JAR, \
+    TOOL_DX, TOOL_EMMA
+from interfaces import commander
+from interfaces.command_executor import RESOURCE_JVM, RESOURCE_DISK, \
+    RESOURCE_PROCESS
 from interfaces.apktool_interface import ApktoolInterface
 from interfaces.dex2jar_interface import Dex2JarInterface
 from interfaces.dx_interface import DxInterface
 from interfaces.emma_interface import EMMA_MERGE, EMMA_OUTMODE, EmmaInterface
 from interfaces.zipalign_interface import ZipalignInterface
+from interfaces.openssl_interface import OpenSslInterface
+from interfaces.toolserver_interface import ToolServerInterface, \
+    ToolServerUnavailableException
+from logconfig import logger
 from utils.android_manifest import AndroidManifest, \
     ManifestAlreadyInstrumentedException
 from utils.auxiliary_utils import ensureDirExists
 from utils.zip_utils import zipdir
+from utils import apk_utils
+from utils.axml import AxmlException
+from utils.apk_writer import ApkWriter, ApkWriterException, alignZip, \
+    checkZipAlignment
+from utils.auxiliary_utils import linkOrCopyFile
+from utils.jar_signer import JarSignatureBuilder, JarSignerException, \
+    DIGEST_ALGORITHMS, SIGNATURE_ENTRY_DATE_TIME, computeEntryDigests, \
+    isSignedEntry, loadDex2JarTestKey, derToPem
+from utils.pkcs7 import RsaPrivateKey, createSignedData, Pkcs7Exception
 import shutil
 
 
+EMMA_INSTRUMENTATION_CLASS = "com.zhauniarovich.bbtester.EmmaInstrumentation"
+WRITE_EXTERNAL_STORAGE_PERMISSION = "android.permission.WRITE_EXTERNAL_STORAGE"
+
+SIGNER_NATIVE = "NATIVE"
+SIGNER_OPENSSL = "OPENSSL"
+SIGNER_DEX2JAR = "DEX2JAR"
+SIGNERS = [SIGNER_NATIVE, SIGNER_OPENSSL, SIGNER_DEX2JAR]
+
+
 class BBoxInstrumenter:
     def __init__(self, config):
         self.config = config
+        self.heapManager = BBoxHeapManager(config)
+        self._initCommandLimits()
+        if self.config.useToolServer():
+            self._initToolServer()
+    
+    def _initCommandLimits(self):
+        executor = commander.getExecutor()
+        executor.setLimit(RESOURCE_JVM, self.config.getJvmCommandsLimit())
+        executor.setLimit(RESOURCE_DISK, self.config.getDiskCommandsLimit())
+        executor.setLimit(RESOURCE_PROCESS, self.config.getOtherCommandsLimit())
+    
+    def _initToolServer(self):
+        '''
+        Starts the tool server (one per process) that runs java tools in a warm
+        JVM. If the server cannot be started, the tools are run in separate
+        subprocesses.
+        '''
+        if commander.getToolServer():
+            return
+        toolServer = ToolServerInterface(javaPath = self.config.getToolServerJavaPath(),
+                                         javaOpts = self.config.getToolServerJavaOpts(),
+                                         pathToolServer = self.config.getToolServerPath(),
+                                         jarToolServer = self.config.getToolServerJar(),
+                                         memoryThreshold = self.config.getToolServerMemoryThreshold())
+        try:
+            toolServer.start()
+        except ToolServerUnavailableException as e:
+            logger.warning("Cannot start tool server, java tools will be run in subprocesses. %s" % e.msg)
+            return
+        atexit.register(toolServer.stop)
+        commander.setToolServer(toolServer)
     
 #     def setConfig(self, config):
 #         '''
@@ -64,17 +125,18 @@ class BBoxInstrumenter:
                                    pathApktool = self.config.getApktoolPath(),
                                    jarApktool = self.config.getApktoolJar())
         
-        (successfulRun, cmdOutput) = apktool.decode(apkPath = pathToApk,
-                                          dirToDecompile = dirToDecompile,
-                                          quiet = True,
-                                          noSrc = True,
-                                          noRes = False,
-                                          debug = False,        #maybe true to enable debugging
-                                          noDebugInfo = False,  #check this 
-                                          force = True, #directory exist so without this this process finishes
-                                          frameworkTag = "",
-                                          frameworkDir = "",
-                                          keepBrokenRes = True)
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_APKTOOL, apktool, [pathToApk],
+                lambda: apktool.decode(apkPath = pathToApk,
+                                       dirToDecompile = dirToDecompile,
+                                       quiet = True,
+                                       noSrc = True,
+                                       noRes = False,
+                                       debug = False,        #maybe true to enable debugging
+                                       noDebugInfo = False,  #check this 
+                                       force = True, #directory exist so without this this process finishes
+                                       frameworkTag = "",
+                                       frameworkDir = "",
+                                       keepBrokenRes = True))
         
         if not successfulRun:
             err = "Cannot decompile file: [%s] into dir [%s]. ERRSTR: %s" % (pathToApk, dirToDecompile, cmdOutput)
@@ -103,12 +165,13 @@ class BBoxInstrumenter:
                                    classDex2Jar = self.config.getDex2JarClassForDex2Jar(),
                                    classApksign = self.config.getDex2JarClassForApksign())
         
-        (successfulRun, cmdOutput) = dex2jar.dex2jar(source = dexFile, 
-                                                     output = jarFile, 
-                                                     force = overwrite)
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_DEX2JAR, dex2jar, [dexFile],
+                lambda: dex2jar.dex2jar(source = dexFile, 
+                                        output = jarFile, 
+                                        force = overwrite))
         
         if not successfulRun:
-            err = "Cannot convert dex [%s] into jar file [%s]. ERRSTR: %s" % (dexFile, cmdOutput)
+            err = "Cannot convert dex [%s] into jar file [%s]. ERRSTR: %s" % (dexFile, jarFile, cmdOutput)
             raise Dex2JarConvertionError(err)
         
     
@@ -222,14 +285,64 @@ class BBoxInstrumenter:
         # dx does not create folder. Thus, if you specify the folder that do not exist
         # dx tool will not create it and you will receive and error. This can be corrected by 
         # adding additional code for folder creation 
-        (successfulRun, cmdOutput) = dx.dex(inFiles = filesToConvert,
-                                            output = dexFile,
-                                            noLocals = True)
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_DX, dx, filesToConvert,
+                lambda: dx.dex(inFiles = filesToConvert,
+                               output = dexFile,
+                               noLocals = True))
         if not successfulRun:
             err = "Cannot convert jar [%s] to dex [%s]. ERRSTR: %s" % (jarFile, dexFile, cmdOutput)
             raise Jar2DexConvertionError(err)
     
     
+    def convertJar2MultiDex(self, jarFile, outputFolder, withFiles=[], mainDexClasses=[]):
+        '''
+        Converts the provided jar file into several dex files (classes.dex, 
+        classes2.dex, ...) in the output folder using multidex mode of dx.
+        
+        Args:
+            :param jarFile: the path to a jar file that needs to be converted
+            :param outputFolder: the folder for the resulting dex files
+            :param withFiles: additional files that need to be included into the
+                resulting dex files
+            :param mainDexClasses: class files (e.g., com/example/Main.class)
+                that must be in classes.dex
+        
+        Returns:
+            :ret list of paths to the dex files, classes.dex first
+        
+        Raises:
+            Jar2DexConvertionError: if the provided files cannot be converted. 
+        '''
+        dx = DxInterface(javaPath = self.config.getDxJavaPath(),
+                         javaOpts = self.config.getDxJavaOpts(),
+                         pathDx = self.config.getDxPath(),
+                         jarDx = self.config.getDxJar())
+        
+        ensureDirExists(outputFolder)
+        mainDexList = None
+        if mainDexClasses:
+            mainDexList = os.path.join(outputFolder, "main_dex_list.txt")
+            with open(mainDexList, "w") as f:
+                f.write("\n".join(mainDexClasses) + "\n")
+        
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_DX, dx, [jarFile] + withFiles,
+                lambda: dx.dex(inFiles = [jarFile] + withFiles,
+                               output = outputFolder,
+                               noLocals = True,
+                               multiDex = True,
+                               mainDexList = mainDexList))
+        if mainDexList:
+            os.remove(mainDexList)
+        if not successfulRun:
+            err = "Cannot convert jar [%s] to dex files in [%s]. ERRSTR: %s" % (jarFile, outputFolder, cmdOutput)
+            raise Jar2DexConvertionError(err)
+        
+        dexFiles = [fn for fn in os.listdir(outputFolder) if fn.endswith(".dex")]
+        #classes.dex, classes2.dex, ..., classes10.dex
+        dexFiles.sort(key=lambda fn: (len(fn), fn))
+        return [os.path.join(outputFolder, fn) for fn in dexFiles]
+    
+    
     def convertJar2DexFiles(self, jarFiles, outputFolder, withFiles=[], overwrite=True, proceedOnError=True):
         '''
         Converts provided jar files into dex files to the specified folder. 
@@ -271,7 +384,7 @@ class BBoxInstrumenter:
         return jar2dexMap   
     
     
-    def instrumentJarWithEmma(self, jarFile, outputFolder, emmaMetadataFile):
+    def instrumentJarWithEmma(self, jarFile, outputFolder, emmaMetadataFile, filters=[]):
         '''
         Instruments provided jar file with Emma code coverage tool code. The
         resulting emmaMetadataFile is create with merge==yes, i.e., if the file
@@ -284,6 +397,8 @@ class BBoxInstrumenter:
             :param outputFolder: where to store instrumented file
             :param emmaMetadataFile: path to the file with emma instrumentation
                 results
+            :param filters: Emma class filters (e.g., ["+com.example.*"]); the
+                classes that are filtered out are copied uninstrumented
         '''
         ensureDirExists(outputFolder)
         emma = EmmaInterface(javaPath = self.config.getEmmaJavaPath(),
@@ -292,19 +407,26 @@ class BBoxInstrumenter:
                              jarEmma = self.config.getEmmaJar(),
                              jarEmmaDevice = self.config.getEmmaDeviceJar())
         
-        (successfulRun, cmdOutput) = emma.instr(instrpaths = [jarFile],
-                                      outdir = outputFolder,
-                                      emmaMetadataFile = emmaMetadataFile,
-                                      merge = EMMA_MERGE.YES,
-                                      outmode = EMMA_OUTMODE.FULLCOPY)
-        if successfulRun:
-            #emma put instrumented jar files into lib folder so we need to move
-            #them back to the output folder and delete
-            jarsOutDir = os.path.join(outputFolder, "lib")
-            for filename in os.listdir(jarsOutDir):
-                shutil.move(os.path.join(jarsOutDir, filename), os.path.join(outputFolder, filename))
-            shutil.rmtree(jarsOutDir)
-            return
+        #the output folder may be shared by parallel workers, so emma writes
+        #into a dir of its own
+        emmaOutDir = tempfile.mkdtemp(prefix=".emma_", dir=outputFolder)
+        try:
+            (successfulRun, cmdOutput) = self.heapManager.run(TOOL_EMMA, emma, [jarFile],
+                    lambda: emma.instr(instrpaths = [jarFile],
+                                       outdir = emmaOutDir,
+                                       emmaMetadataFile = emmaMetadataFile,
+                                       merge = EMMA_MERGE.YES,
+                                       outmode = EMMA_OUTMODE.FULLCOPY,
+                                       filters = filters))
+            if successfulRun:
+                #emma put instrumented jar files into lib folder so we need to move
+                #them back to the output folder
+                jarsOutDir = os.path.join(emmaOutDir, "lib")
+                for filename in os.listdir(jarsOutDir):
+                    shutil.move(os.path.join(jarsOutDir, filename), os.path.join(outputFolder, filename))
+                return
+        finally:
+            shutil.rmtree(emmaOutDir, ignore_errors=True)
         
         if not successfulRun:
             err = "Cannot instrument jar file [%s] with Emma. %s" % (jarFile, cmdOutput)
@@ -312,6 +434,92 @@ class BBoxInstrumenter:
     
     
     
+    def instrumentJarsWithEmma(self, jarFiles, instrJarFiles, emmaMetadataFile, filters=[]):
+        '''
+        Instruments several jar files in one Emma run (one JVM start). The
+        information about all jar files is merged into emmaMetadataFile.
+        
+        Args:
+            :param jarFiles: list of jar files to instrument; the names of the
+                files must be unique
+            :param instrJarFiles: list of paths to the instrumented jar files 
+                (in the order of jarFiles)
+            :param emmaMetadataFile: path to the file with emma instrumentation
+                results
+            :param filters: Emma class filters
+        
+        Raises:
+            EmmaCannotInstrumentException: if the jar files cannot be instrumented
+        '''
+        names = [os.path.basename(jarFile) for jarFile in jarFiles]
+        if len(set(names)) != len(names):
+            raise EmmaCannotInstrumentException("Names of jar files instrumented in one run must be unique: %s" % jarFiles)
+        
+        emma = EmmaInterface(javaPath = self.config.getEmmaJavaPath(),
+                             javaOpts = self.config.getEmmaJavaOpts(),
+                             pathEmma = self.config.getEmmaDir(),
+                             jarEmma = self.config.getEmmaJar(),
+                             jarEmmaDevice = self.config.getEmmaDeviceJar())
+        #next to the results, so the jar files are moved without copying
+        instrJarsDir = os.path.dirname(instrJarFiles[0])
+        ensureDirExists(instrJarsDir)
+        outputFolder = tempfile.mkdtemp(prefix=".emma_", dir=instrJarsDir)
+        try:
+            (successfulRun, cmdOutput) = self.heapManager.run(TOOL_EMMA, emma, jarFiles,
+                    lambda: emma.instr(instrpaths = jarFiles,
+                                       outdir = outputFolder,
+                                       emmaMetadataFile = emmaMetadataFile,
+                                       merge = EMMA_MERGE.YES,
+                                       outmode = EMMA_OUTMODE.FULLCOPY,
+                                       filters = filters))
+            if not successfulRun:
+                err = "Cannot instrument jar files %s with Emma. %s" % (jarFiles, cmdOutput)
+                raise EmmaCannotInstrumentException(err)
+            #emma puts all instrumented jar files into lib folder
+            jarsOutDir = os.path.join(outputFolder, "lib")
+            for (name, instrJarFile) in zip(names, instrJarFiles):
+                ensureDirExists(os.path.dirname(instrJarFile))
+                shutil.move(os.path.join(jarsOutDir, name), instrJarFile)
+        except (OSError, IOError) as e:
+            raise EmmaCannotInstrumentException("Cannot collect jar files instrumented by Emma: %s" % str(e))
+        finally:
+            shutil.rmtree(outputFolder, ignore_errors=True)
+    
+    
+    def mergeEmmaMetadataFiles(self, emmaMetadataFiles, resultEmmaMetadataFile):
+        '''
+        Merges several Emma metadata files (e.g., obtained during separate
+        instrumentation of dex files of a multidex apk) into one file.
+        
+        Args:
+            :param emmaMetadataFiles: list of paths to Emma metadata files
+            :param resultEmmaMetadataFile: path to the resulting metadata file
+        
+        Raises:
+            EmmaCannotMergeException: if the provided files cannot be merged.
+        '''
+        if not emmaMetadataFiles:
+            raise EmmaCannotMergeException("No metadata files are provided to merge!")
+        
+        ensureDirExists(os.path.dirname(resultEmmaMetadataFile))
+        if len(emmaMetadataFiles) == 1:
+            shutil.copy2(emmaMetadataFiles[0], resultEmmaMetadataFile)
+            return
+        
+        emma = EmmaInterface(javaPath = self.config.getEmmaJavaPath(),
+                             javaOpts = self.config.getEmmaJavaOpts(),
+                             pathEmma = self.config.getEmmaDir(),
+                             jarEmma = self.config.getEmmaJar(),
+                             jarEmmaDevice = self.config.getEmmaDeviceJar())
+        
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_EMMA, emma, emmaMetadataFiles,
+                lambda: emma.merge(inputs = emmaMetadataFiles,
+                                   outfile = resultEmmaMetadataFile))
+        if not successfulRun:
+            err = "Cannot merge metadata files %s into [%s]. %s" % (emmaMetadataFiles, resultEmmaMetadataFile, cmdOutput)
+            raise EmmaCannotMergeException(err)
+    
+    
     #TODO: Maybe we need a method to instrument a number of jar files
 #     def _instrumentJarFilesWithEmma(self, jarFiles):
 #         self.emFileName = os.path.join(self.coverageReportsDir, "coverage.em")
@@ -321,13 +529,15 @@ class BBoxInstrumenter:
 #             raise EmmaCannotInstrumentException()
     
     
-    def instrumentAndroidManifestFile(self, pathToUnmodifiedFile, pathToModifiedFile=None, addSdCardPermission=True):
+    def instrumentAndroidManifestFile(self, pathToUnmodifiedFile, pathToModifiedFile=None, addSdCardPermission=True, pathToXmlFile=None):
         '''
         Adds instrumentation tag with predefined attributes corresponding to our
         instrumentation classes to the provided manifest file. If 
         instrumentation tag exists, this method substitutes it with appropriate
         one. Adds (if necessary) to the provided AndroidManifest file permission
-        to write to the external storage.
+        to write to the external storage. Both text (decoded by apktool) and 
+        binary (taken from an apk file) manifests are supported; the modified
+        manifest is stored in the same format.
         
         Args:
             :param pathToUnmodifiedFile: path to the unmodified 
@@ -335,27 +545,196 @@ class BBoxInstrumenter:
             :param pathToModifiedFile: path where to store modified
                 AndroidManifest.xml file. If pathToModifiedFile==None, the 
                 initial pathToUnmodifiedFile will be overridden.
+            :param pathToXmlFile: if provided, the text representation of the
+                modified manifest is stored there
         '''
         if not os.path.isfile(pathToUnmodifiedFile):
             raise IllegalArgumentException("File [%s] does not exist!" % pathToUnmodifiedFile) 
-        androidManifest = AndroidManifest(pathAndroidManifest=pathToUnmodifiedFile)
+        try:
+            androidManifest = AndroidManifest(pathAndroidManifest=pathToUnmodifiedFile)
+        except AxmlException as e:
+            raise IllegalArgumentException("Cannot parse binary manifest [%s]. %s" % (pathToUnmodifiedFile, e.msg))
         packageName = androidManifest.getPackageName()
-        #TODO: think how to substitute these constants later
         try:
-            androidManifest.addInstrumentation("com.zhauniarovich.bbtester.EmmaInstrumentation", packageName)
+            androidManifest.addInstrumentation(EMMA_INSTRUMENTATION_CLASS, packageName)
         except ManifestAlreadyInstrumentedException:
             #removing all existing instrumentation tags and creating our new
             androidManifest.removeExistingInstrumentation() #TODO: this can throw an exception
-            androidManifest.addInstrumentation("com.zhauniarovich.bbtester.EmmaInstrumentation", packageName)
+            androidManifest.addInstrumentation(EMMA_INSTRUMENTATION_CLASS, packageName)
         
         if addSdCardPermission:
-            androidManifest.addUsesPermission("android.permission.WRITE_EXTERNAL_STORAGE")
+            androidManifest.addUsesPermission(WRITE_EXTERNAL_STORAGE_PERMISSION)
         
         if not pathToModifiedFile or (pathToUnmodifiedFile == pathToModifiedFile):
             androidManifest.exportManifest(path=None)
         else: 
             androidManifest.exportManifest(path=pathToModifiedFile)
         
+        if pathToXmlFile:
+            androidManifest.exportXml(pathToXmlFile)
+        
+    
+    def extractApkCode(self, pathToApk, outputDir):
+        '''
+        Extracts the dex files (classes.dex, classes2.dex, ...) and the binary
+        AndroidManifest.xml file from the apk file without decoding the 
+        resources. Used instead of decompileApk in zip patching mode.
+        
+        Args:
+            :param pathToApk: path to a valid apk file
+            :param outputDir: path to a dir where the files will be stored
+        
+        Raises:
+            ApkCannotBeDecompiledException: if the files cannot be extracted.
+        '''
+        ensureDirExists(outputDir)
+        try:
+            with zipfile.ZipFile(pathToApk, "r") as apk:
+                names = apk.namelist()
+                if "AndroidManifest.xml" not in names:
+                    raise ApkCannotBeDecompiledException("There is no AndroidManifest.xml in [%s]" % pathToApk)
+                for name in names:
+                    if name == "AndroidManifest.xml" or apk_utils.isDexEntry(name):
+                        with open(os.path.join(outputDir, name), "wb") as f:
+                            f.write(apk.read(name))
+        except (zipfile.BadZipfile, IOError) as e:
+            raise ApkCannotBeDecompiledException("Cannot extract files from [%s] into dir [%s]. ERRSTR: %s" % (pathToApk, outputDir, str(e)))
+    
+    
+    def patchApk(self, pathToApk, destinationApk, replacedFiles={}, pathToResourcesBaseDir=None):
+        '''
+        Builds a new apk file from the original one without apktool. All
+        untouched entries are copied raw (without recompression), the entries
+        from replacedFiles are substituted, the files from the resources dir
+        are added. The signature of the original apk file is dropped.
+        
+        Args:
+            :param pathToApk: path to the original apk file
+            :param destinationApk: path to the resulting apk file
+            :param replacedFiles: dict {entry name : path to the file} of the
+                entries to substitute (or to add if absent)
+            :param pathToResourcesBaseDir: path to the base folder of the
+                resources to add or None
+        
+        Raises:
+            ApkPatchException: if the apk file cannot be patched
+        '''
+        self._writeApk(pathToApk, destinationApk, replacedFiles, pathToResourcesBaseDir)
+    
+    
+    def finaliseApk(self, pathToApk, destinationApk, replacedFiles={}, pathToResourcesBaseDir=None):
+        '''
+        Produces the final (signed and aligned) apk file reading the source
+        apk file only once. The entries are patched as in patchApk, their
+        digests are computed while they are written and the uncompressed 
+        entries are aligned. The signature entries are appended at the end.
+        
+        Raises:
+            ApkPatchException: if the apk file cannot be written
+            SignApkException: if the signature cannot be created
+        '''
+        if self.config.getSigner() == SIGNER_DEX2JAR:
+            #ApkSign cannot sign the entries while they are written
+            logger.warning("DEX2JAR signer runs only with intermediate apks (KEEP_INTERMEDIATE_APKS), "
+                           "signing [%s] in process" % destinationApk)
+        try:
+            signatureBuilder = JarSignatureBuilder(self.config.getSigningDigestAlgorithm())
+        except JarSignerException as e:
+            raise SignApkException("Cannot sign apk file [%s]. ERRSTR: %s" % (pathToApk, e.msg))
+        self._writeApk(pathToApk, destinationApk, replacedFiles, pathToResourcesBaseDir, signatureBuilder)
+    
+    
+    def _writeApk(self, pathToApk, destinationApk, replacedFiles, pathToResourcesBaseDir, signatureBuilder=None):
+        try:
+            with zipfile.ZipFile(pathToApk, "r") as apk, open(pathToApk, "rb") as srcFile, \
+                    ApkWriter(destinationApk, self.config.getZipalignAlignment()) as writer:
+                for zinfo in apk.infolist():
+                    name = zinfo.filename
+                    if name in replacedFiles:
+                        writer.writeFile(name, replacedFiles[name], zinfo.compress_type, 
+                                         self._getDigestListener(signatureBuilder, name))
+                    elif not apk_utils.isSignatureEntry(name):
+                        writer.copyRawEntry(srcFile, zinfo, self._getDigestListener(signatureBuilder, name))
+                
+                written = set(writer.getEntryNames())
+                for name in sorted(replacedFiles):
+                    if name not in written:
+                        writer.writeFile(name, replacedFiles[name], 
+                                         dataListener=self._getDigestListener(signatureBuilder, name))
+                
+                if pathToResourcesBaseDir:
+                    for root, _, files in os.walk(pathToResourcesBaseDir):
+                        for fn in sorted(files):
+                            absPath = os.path.join(root, fn)
+                            name = os.path.relpath(absPath, pathToResourcesBaseDir).replace(os.sep, "/")
+                            writer.writeFile(name, absPath, 
+                                             dataListener=self._getDigestListener(signatureBuilder, name))
+                
+                if signatureBuilder:
+                    for (name, data) in signatureBuilder.getSignatureEntries(self._createSignatureBlock):
+                        writer.writeBytes(name, data, dateTime=SIGNATURE_ENTRY_DATE_TIME)
+        except (zipfile.BadZipfile, IOError, OSError) as e:
+            raise ApkPatchException("Cannot patch apk file [%s] into [%s]. ERRSTR: %s" % (pathToApk, destinationApk, str(e)))
+        except ApkWriterException as e:
+            raise ApkPatchException("Cannot patch apk file [%s] into [%s]. ERRSTR: %s" % (pathToApk, destinationApk, e.msg))
+        except JarSignerException as e:
+            raise SignApkException("Cannot sign apk file [%s]. ERRSTR: %s" % (destinationApk, e.msg))
+    
+    def _getDigestListener(self, signatureBuilder, name):
+        if not signatureBuilder:
+            return None
+        return signatureBuilder.createEntryListener(name)
+    
+    def _createSignatureBlock(self, signatureFile):
+        '''
+        Signs the contents of the signature file and returns the DER encoded
+        PKCS#7 signature block. The block is created with openssl if it is 
+        the selected signer, otherwise in process.
+        '''
+        (keyDer, certDer) = self._getSigningKey()
+        digest = DIGEST_ALGORITHMS[self.config.getSigningDigestAlgorithm()]
+        if self.config.getSigner() != SIGNER_OPENSSL:
+            try:
+                return createSignedData(signatureFile, RsaPrivateKey.fromDer(keyDer), certDer, digest)
+            except Pkcs7Exception as e:
+                raise JarSignerException("Cannot create signature block. ERRSTR: %s" % e.msg)
+        
+        workDir = tempfile.mkdtemp(prefix="bbox_sign_")
+        try:
+            dataFile = os.path.join(workDir, "CERT.SF")
+            certFile = os.path.join(workDir, "cert.pem")
+            keyFile = os.path.join(workDir, "key.pem")
+            outFile = os.path.join(workDir, "CERT.RSA")
+            with open(dataFile, "wb") as f:
+                f.write(signatureFile)
+            with open(certFile, "wb") as f:
+                f.write(derToPem(certDer, "CERTIFICATE"))
+            fd = os.open(keyFile, os.O_WRONLY | os.O_CREAT, 0600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(derToPem(keyDer, "PRIVATE KEY"))
+            
+            openssl = OpenSslInterface(exeOpenssl=self.config.getOpensslExe())
+            (successfulRun, cmdOutput) = openssl.signPkcs7(dataFile, certFile, keyFile, outFile, digest)
+            if not successfulRun:
+                raise JarSignerException("Cannot create signature block. ERRSTR: %s" % cmdOutput)
+            with open(outFile, "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+    
+    def _getSigningKey(self):
+        keyFile = self.config.getSigningKeyFile()
+        certFile = self.config.getSigningCertFile()
+        if not keyFile:
+            return loadDex2JarTestKey(self.config.getDex2LibsPath())
+        if not certFile:
+            raise JarSignerException("Certificate of the signing key [%s] is not provided" % keyFile)
+        with open(keyFile, "rb") as f:
+            keyDer = f.read()
+        with open(certFile, "rb") as f:
+            certDer = f.read()
+        return (keyDer, certDer)
+    
     
     def addResourcesToApk(self, pathToApk, pathToResourcesBaseDir):
         '''
@@ -387,12 +766,13 @@ class BBoxInstrumenter:
                                    pathApktool = self.config.getApktoolPath(),
                                    jarApktool = self.config.getApktoolJar())
         
-        (successfulRun, cmdOutput) = apktool.build(srcPath = sourceFolder,
-                                                   finalApk = destinationApk,
-                                                   quiet = True,
-                                                   forceAll = force,
-                                                   debug = False,     #maybe true but I did not change
-                                                   aaptPath=self.config.getAaptPath())
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_APKTOOL, apktool, [sourceFolder],
+                lambda: apktool.build(srcPath = sourceFolder,
+                                      finalApk = destinationApk,
+                                      quiet = True,
+                                      forceAll = force,
+                                      debug = False,     #maybe true but I did not change
+                                      aaptPath=self.config.getAaptPath()))
         
         if not successfulRun:
             err = "Cannot build apk file [%s] from folder [%s] using apktool. ERRSTR: %s" % (destinationApk, sourceFolder, cmdOutput)
@@ -400,32 +780,103 @@ class BBoxInstrumenter:
     
         
     def signApk(self, unsignedApk, signedApk, force=True):
+        '''
+        Signs the apk file with the jar signature. Depending on the selected
+        signer, dex2jar ApkSign tool is run in a JVM or the apk file is signed
+        in process.
+        
+        Raises:
+            SignApkException: if the apk file cannot be signed
+        '''
+        signer = self.config.getSigner()
+        if signer not in SIGNERS:
+            raise SignApkException("Unknown signer: %s. Possible values: %s" % (signer, ", ".join(SIGNERS)))
+        if signer != SIGNER_DEX2JAR:
+            self._signApkInProcess(unsignedApk, signedApk)
+            return
+        
         dex2jar = Dex2JarInterface(javaPath = self.config.getDex2JarJavaPath(),
                                    javaOpts = self.config.getDex2JarJavaOpts(),
                                    pathDex2JarLibs = self.config.getDex2LibsPath(),
                                    classDex2Jar = self.config.getDex2JarClassForDex2Jar(),
                                    classApksign = self.config.getDex2JarClassForApksign())
         
-        (successfulRun, cmdOutput) = dex2jar.apkSign(source=unsignedApk,
-                                                     output=signedApk,
-                                                     force=force)
+        (successfulRun, cmdOutput) = self.heapManager.run(TOOL_DEX2JAR, dex2jar, [unsignedApk],
+                lambda: dex2jar.apkSign(source=unsignedApk,
+                                        output=signedApk,
+                                        force=force))
         if not successfulRun:
             err = "Cannot sign apk file [%s]. ERRSTR: %s" % (unsignedApk, cmdOutput)
             raise SignApkException(err)
         
     
+    def _signApkInProcess(self, unsignedApk, signedApk):
+        #the digests are computed over the unsigned apk, after that the 
+        #entries are copied raw and the signature entries are appended
+        try:
+            signatureBuilder = JarSignatureBuilder(self.config.getSigningDigestAlgorithm())
+            with zipfile.ZipFile(unsignedApk, "r") as apk:
+                zinfos = [zinfo for zinfo in apk.infolist() if not apk_utils.isSignatureEntry(zinfo.filename)]
+            
+            digests = computeEntryDigests(unsignedApk, 
+                                          [zinfo for zinfo in zinfos if isSignedEntry(zinfo.filename)],
+                                          signatureBuilder.createDigest, 
+                                          self.config.getSigningThreads())
+            for (name, digest) in digests.iteritems():
+                signatureBuilder.addEntryDigest(name, digest)
+            
+            with open(unsignedApk, "rb") as srcFile, \
+                    ApkWriter(signedApk, self.config.getZipalignAlignment()) as writer:
+                for zinfo in zinfos:
+                    writer.copyRawEntry(srcFile, zinfo)
+                for (name, data) in signatureBuilder.getSignatureEntries(self._createSignatureBlock):
+                    writer.writeBytes(name, data, dateTime=SIGNATURE_ENTRY_DATE_TIME)
+        except (zipfile.BadZipfile, IOError, OSError) as e:
+            raise SignApkException("Cannot sign apk file [%s]. ERRSTR: %s" % (unsignedApk, str(e)))
+        except (JarSignerException, ApkWriterException) as e:
+            raise SignApkException("Cannot sign apk file [%s]. ERRSTR: %s" % (unsignedApk, e.msg))
+    
+    
     def alignApk(self, unalignedApk, alignedApk, force=True):
+        '''
+        Aligns uncompressed entries of the apk file. By default, the alignment
+        is done in process; if the apk file is already aligned, alignedApk is
+        just a link to unalignedApk.
+        
+        Raises:
+            AlignApkException: if the apk file cannot be aligned
+        '''
+        alignment = self.config.getZipalignAlignment()
+        if self.config.useNativeZipalign():
+            self._alignApkNative(unalignedApk, alignedApk, alignment)
+            return
+        
         zipalign = ZipalignInterface(dirZipalign=self.config.getZipalignDir(),
                                      exeZipalign=self.config.getZipalingExe())
         
         (successfulRun, cmdOutput) = zipalign.align(inFile=unalignedApk,
                                                     outFile=alignedApk,
-                                                    alignment=4,
+                                                    alignment=alignment,
                                                     verbose=False,
                                                     overwrite=True)
         if not successfulRun:
             err = "Cannot align apk file [%s]. ERRSTR: %s" % (unalignedApk, cmdOutput)
             raise AlignApkException(err)
+    
+    def _alignApkNative(self, unalignedApk, alignedApk, alignment):
+        try:
+            if not checkZipAlignment(unalignedApk, alignment):
+                logger.debug("Apk file [%s] is already aligned" % unalignedApk)
+                linkOrCopyFile(unalignedApk, alignedApk)
+                return
+            alignZip(unalignedApk, alignedApk, alignment)
+            misaligned = checkZipAlignment(alignedApk, alignment)
+        except (zipfile.BadZipfile, IOError, OSError) as e:
+            raise AlignApkException("Cannot align apk file [%s]. ERRSTR: %s" % (unalignedApk, str(e)))
+        except ApkWriterException as e:
+            raise AlignApkException("Cannot align apk file [%s]. ERRSTR: %s" % (unalignedApk, e.msg))
+        if misaligned:
+            raise AlignApkException("Entries of apk file [%s] are not aligned: %s" % (alignedApk, ", ".join(misaligned)))
         
 #     def instrumentApk(self):
 #         #decompiling
@@ -485,11 +936,21 @@ class EmmaCannotInstrumentException(MsgException):
     Provided files cannot be instrumented with Emma.
     '''
     
+class EmmaCannotMergeException(MsgException):
+    '''
+    Provided Emma metadata files cannot be merged.
+    '''
+    
 class ApktoolBuildException(MsgException):
     '''
     Provided folder cannot be converted to an apk file.
     '''
     
+class ApkPatchException(MsgException):
+    '''
+    Provided apk file cannot be patched.
+    '''
+    
 class SignApkException(MsgException):
     '''
     Provided apk file cannot be signed.
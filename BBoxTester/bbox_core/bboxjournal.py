@@ -0,0 +1,252 @@
+'''
+Journal of the instrumentation pipeline.
+
+The journal is kept in the tmp dir of an apk and records the stages of the
+instrumentation that have been completed. For each stage it stores the hashes
+of the artifacts the stage has produced and the data needed by the subsequent
+stages (e.g., the lists of converted files). A rerun of the instrumentation
+checks the artifacts and resumes from the first stage that has not been
+completed or whose artifacts have been changed.
+
+A stage can modify the artifacts of the previous stages. Thus, an artifact is checked only against
+the hash recorded by the last stage that has written it. If a directory and
+some files inside it are artifacts of the same stage, the hash of the
+directory does not cover these files.
+
+The artifacts consumed by a later stage can be removed to save space (see
+discardArtifacts). Such a stage stays valid only while the consuming stage
+is valid: if the latter has to be repeated, the removed inputs have to be
+produced again.
+
+Each stage also records the fingerprint of its inputs (settings and tools it
+depends on) and the stages it depends on. A stage whose fingerprint differs
+from the current one is repeated together with the stages depending on it
+(directly or transitively); the other stages are kept. A stage without
+recorded dependencies depends on all stages completed before it.
+
+Independent stages may be completed by concurrently running tasks (see
+bboxscheduler), so the changes of the journal are serialised.
+'''
+import os
+import json
+import time
+import threading
+
+from utils import auxiliary_utils
+from logconfig import logger
+
+
+JOURNAL_FILENAME = "journal.json"
+JOURNAL_VERSION = 2
+
+
+class BBoxInstrJournal:
+    def __init__(self, journalPath):
+        self.journalPath = journalPath
+        self.apkHash = None
+        self.stages = []
+        self.stageInputs = {}
+        self.stageDependencies = {}
+        self._lock = threading.RLock()
+
+    def open(self, apkHash, stageInputs={}, stageDependencies={}):
+        '''
+        Loads the journal and drops the stages which artifacts are missing or
+        have been changed since the stage has been completed, and the stages
+        which inputs have been changed.
+
+        Args:
+            :param apkHash: hash of the apk file being instrumented
+            :param stageInputs: dict {state : fingerprint of the inputs of the
+                stage}; recorded when the stage is completed
+            :param stageDependencies: dict {state : list of states the stage
+                depends on}; recorded when the stage is completed
+
+        Returns:
+            :ret True if the journal corresponds to the apk and contains at
+                least one completed stage, False otherwise
+        '''
+        self.apkHash = apkHash
+        self.stages = []
+        self.stageInputs = stageInputs
+        self.stageDependencies = stageDependencies
+        try:
+            with open(self.journalPath, "r") as f:
+                journal = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if journal.get("version") != JOURNAL_VERSION or journal.get("apkHash") != apkHash:
+            logger.debug("Journal [%s] belongs to another apk file. Ignoring it..." % self.journalPath)
+            return False
+
+        self.stages = journal.get("stages", [])
+        self._dropChangedStages()
+        self._dropInvalidStages()
+        if self.stages:
+            self._save()
+        return len(self.stages) > 0
+
+    def reset(self, apkHash, stageInputs=None, stageDependencies=None):
+        '''
+        Starts a new empty journal for the apk file. The inputs and the
+        dependencies of the stages given to open are kept if not provided.
+        '''
+        self.apkHash = apkHash
+        self.stages = []
+        if stageInputs is not None:
+            self.stageInputs = stageInputs
+        if stageDependencies is not None:
+            self.stageDependencies = stageDependencies
+        self._save()
+
+    def isCompleted(self, state):
+        return self._findStage(state) is not None
+
+    def getCompletedStates(self):
+        return [stage["state"] for stage in self.stages]
+
+    def getData(self, state):
+        '''
+        Returns the data saved for the completed stage.
+        '''
+        index = self._findStage(state)
+        if index is None:
+            return None
+        return self.stages[index]["data"]
+
+    def complete(self, state, artifacts=[], data={}):
+        '''
+        Records that the stage has been completed. The stage and the stages
+        depending on it recorded earlier are dropped.
+
+        Args:
+            :param state: the state corresponding to the stage
+            :param artifacts: list of paths to the files and directories
+                produced by the stage
+            :param data: json-serializable dict needed to skip the stage
+        '''
+        artifactPaths = [os.path.abspath(pth) for pth in artifacts]
+        hashes = {}
+        for pth in artifactPaths:
+            hashes[pth] = self._computeHash(pth, artifactPaths)
+        with self._lock:
+            self.drop(state)
+            dependsOn = self.stageDependencies.get(state)
+            if dependsOn is None:
+                dependsOn = self.getCompletedStates()
+            self.stages.append({
+                "state" : state,
+                "completed" : time.time(),
+                "inputs" : self.stageInputs.get(state),
+                "dependsOn" : dependsOn,
+                "artifacts" : hashes,
+                "data" : data,
+            })
+            self._save()
+
+    def discardArtifacts(self, state, paths, consumerState):
+        '''
+        Records that the artifacts of the completed stage have been removed
+        after the consumer stage had used them.
+
+        Args:
+            :param state: the stage that has produced the artifacts
+            :param paths: paths to the removed artifacts; the artifacts inside
+                removed directories are discarded as well
+            :param consumerState: the completed stage that has used them
+        '''
+        with self._lock:
+            index = self._findStage(state)
+            if index is None:
+                return
+            stage = self.stages[index]
+            removedPaths = [os.path.abspath(pth) for pth in paths]
+            for pth in stage["artifacts"].keys():
+                if any(pth == removed or pth.startswith(removed + os.sep) for removed in removedPaths):
+                    del stage["artifacts"][pth]
+            stage["discardedAfter"] = consumerState
+            self._save()
+
+    def drop(self, state):
+        '''
+        Removes the stage and the stages depending on it.
+
+        Returns:
+            :ret list of the removed states
+        '''
+        with self._lock:
+            if self._findStage(state) is None:
+                return []
+            dropped = set([state])
+            #dependent stages are completed after the stages they depend on
+            for stage in self.stages:
+                if dropped.intersection(stage["dependsOn"]):
+                    dropped.add(stage["state"])
+            droppedStates = [stage["state"] for stage in self.stages if stage["state"] in dropped]
+            self.stages = [stage for stage in self.stages if stage["state"] not in dropped]
+            return droppedStates
+
+
+    def _findStage(self, state):
+        for i, stage in enumerate(self.stages):
+            if stage["state"] == state:
+                return i
+        return None
+
+    def _dropChangedStages(self):
+        for stage in list(self.stages):
+            state = stage["state"]
+            if self._findStage(state) is None or stage.get("inputs") == self.stageInputs.get(state):
+                continue
+            dropped = self.drop(state)
+            logger.info("Stages [%s] have to be repeated: the inputs of [%s] are changed" % (", ".join(dropped), state))
+
+    def _dropInvalidStages(self):
+        #dropping a stage makes the artifacts of the previous stages that were
+        #overwritten by it subject to the check, so we repeat until no changes
+        invalidIndex = self._findFirstInvalidStage()
+        while invalidIndex is not None:
+            dropped = self.drop(self.stages[invalidIndex]["state"])
+            logger.info("Stages [%s] have to be repeated: the artifacts of [%s] are changed or missing" % (", ".join(dropped), dropped[0]))
+            invalidIndex = self._findFirstInvalidStage()
+
+    def _findFirstInvalidStage(self):
+        lastWriters = {}
+        for i, stage in enumerate(self.stages):
+            for pth in stage["artifacts"]:
+                lastWriters[pth] = i
+
+        completedStates = self.getCompletedStates()
+        for i, stage in enumerate(self.stages):
+            consumerState = stage.get("discardedAfter")
+            if consumerState and consumerState not in completedStates:
+                return i
+            artifactPaths = stage["artifacts"].keys()
+            for (pth, recordedHash) in stage["artifacts"].iteritems():
+                if lastWriters[pth] != i:
+                    continue
+                if self._computeHash(pth, artifactPaths) != recordedHash:
+                    return i
+        return None
+
+    def _computeHash(self, path, stageArtifactPaths):
+        if not os.path.exists(path):
+            return None
+        if os.path.isfile(path):
+            return auxiliary_utils.getFileHash(path)
+        prefix = path + os.sep
+        excludes = set(pth for pth in stageArtifactPaths if pth.startswith(prefix))
+        return auxiliary_utils.getDirHash(path, excludes=excludes)
+
+    def _save(self):
+        journal = {
+            "version" : JOURNAL_VERSION,
+            "apkHash" : self.apkHash,
+            "stages" : self.stages,
+        }
+        auxiliary_utils.ensureDirExists(os.path.dirname(self.journalPath))
+        tmpJournalPath = self.journalPath + ".tmp"
+        with open(tmpJournalPath, "w") as f:
+            json.dump(journal, f, indent=2)
+        os.rename(tmpJournalPath, self.journalPath)
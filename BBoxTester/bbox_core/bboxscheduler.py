@@ -0,0 +1,147 @@
+'''
+Scheduler of the instrumentation stages.
+
+The stages are added as tasks together with the tasks they depend on. A task
+is started as soon as all its dependencies have succeeded, at most the
+configured number of tasks run at the same time. The tools are run in
+subprocesses, so the tasks are executed by threads.
+
+A task fails if it returns False. After a failure or an exception no new
+tasks are started; the running ones are waited for. If the run is
+interrupted (e.g., by Ctrl-C), the commands of the running tasks are killed
+and the tasks are waited for before the interrupt is re-raised.
+'''
+import sys
+import threading
+from collections import OrderedDict
+
+from bbox_core.general_exceptions import MsgException
+from interfaces import commander
+
+
+#python 2 delivers signals to a thread waiting on a condition only after
+#the wait, so the scheduler waits in short intervals
+WAIT_INTERVAL = 0.5
+
+
+class BBoxStageScheduler:
+    def __init__(self, workers=1):
+        '''
+        Args:
+            :param workers: maximum number of tasks run at the same time; with
+                one worker the tasks are run in the order they were added
+        '''
+        self.workers = max(1, workers)
+        self._tasks = OrderedDict()
+        self._results = {}
+
+    def addTask(self, name, function, dependsOn=[]):
+        '''
+        Args:
+            :param name: name of the task
+            :param function: function without arguments performing the task
+            :param dependsOn: names of the tasks (added before) which have to
+                succeed before the task is started
+        '''
+        for dependency in dependsOn:
+            if dependency not in self._tasks:
+                raise UnknownTaskException("Task [%s] depends on unknown task [%s]" % (name, dependency))
+        self._tasks[name] = (function, list(dependsOn))
+
+    def run(self):
+        '''
+        Runs the tasks.
+
+        Returns:
+            :ret True if all the tasks have been run and none of them has
+                failed, False otherwise
+
+        Raises:
+            the first exception raised by a task
+        '''
+        if self.workers == 1:
+            self._results = self._runSequentially()
+        else:
+            self._results = self._runConcurrently()
+        return len(self._results) == len(self._tasks) and False not in self._results.values()
+
+    def getResult(self, name):
+        '''
+        Returns the value returned by the task or None if it has not been run.
+        '''
+        return self._results.get(name)
+
+
+    def _runSequentially(self):
+        results = {}
+        for (name, (function, dependsOn)) in self._tasks.iteritems():
+            if not self._isReady(dependsOn, results):
+                break
+            results[name] = function()
+            if results[name] is False:
+                break
+        return results
+
+    def _runConcurrently(self):
+        results = {}
+        errors = []
+        running = set()
+        pending = list(self._tasks.keys())
+        condition = threading.Condition()
+
+        def runTask(name, function):
+            try:
+                result = function()
+            except BaseException:
+                result = None
+                errors.append(sys.exc_info())
+            with condition:
+                running.discard(name)
+                results[name] = result
+                condition.notify_all()
+
+        threads = []
+        try:
+            with condition:
+                while True:
+                    failed = errors or False in results.values()
+                    for name in list(pending):
+                        if failed or len(running) >= self.workers:
+                            break
+                        (function, dependsOn) = self._tasks[name]
+                        if not self._isReady(dependsOn, results):
+                            continue
+                        pending.remove(name)
+                        running.add(name)
+                        thread = threading.Thread(target=runTask, args=(name, function),
+                                                  name="stage-%s" % name)
+                        thread.daemon = True
+                        thread.start()
+                        threads.append(thread)
+                    if not running:
+                        break
+                    condition.wait(WAIT_INTERVAL)
+        except BaseException:
+            #the tools of the abandoned tasks must not survive as orphans; the
+            #tasks may start other commands after a failed one
+            while [thread for thread in threads if thread.is_alive()]:
+                commander.killRunningCommands()
+                for thread in threads:
+                    thread.join(WAIT_INTERVAL)
+            raise
+
+        if errors:
+            (excType, excValue, excTraceback) = errors[0]
+            raise excType, excValue, excTraceback
+        return results
+
+    def _isReady(self, dependsOn, results):
+        return all(dependency in results and results[dependency] is not False
+                   for dependency in dependsOn)
+
+
+#Exceptions
+class UnknownTaskException(MsgException):
+    '''
+    The task depends on a task which has not been added.
+    '''
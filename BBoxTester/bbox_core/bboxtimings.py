@@ -0,0 +1,225 @@
+'''
+Timings of the instrumentation pipeline.
+
+For every stage (the time between two transitions of the state machine) the
+wall time, the CPU time (user + system, see resource.getrusage) and the peak
+resident set size of the tools spawned during the stage are recorded. The
+tools that process files one by one (dex2jar, Emma, dx) are additionally
+measured per file as the steps of the stage. The stages run while the dex
+files are processed (the instrumentation of the manifest and the apktool
+build, see bboxscheduler) are measured as single steps. A step counts only
+the tools run by its own thread, so the steps run at the same time do not
+include each other's tools.
+
+CPU time and peak RSS cover only the tools run in subprocesses: the stages
+performed in process (e.g., native signing) and the tools run in the tool
+server have no CPU time and peak RSS.
+'''
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from interfaces import commander
+from interfaces.command_metrics import PROMETHEUS_PREFIX, maxRssToBytes, formatPrometheusLabels
+
+
+TIMINGS_FILENAME = "timings.json"
+PROMETHEUS_FILENAME = "timings.prom"
+
+STEP_DEX2JAR = "dex2jar"
+STEP_EMMA = "emma"
+STEP_DX = "dx"
+STEP_MANIFEST = "manifest"
+STEP_APKTOOL = "apktool"
+
+
+class UsageMeter:
+    '''
+    Measures wall time, CPU time and peak RSS of the commands run while the
+    meter is active. Only the commands run by the thread that has started the
+    meter are counted unless allThreads is True. Can be used as a context
+    manager.
+    '''
+    def __init__(self, allThreads=False):
+        self.allThreads = allThreads
+        self.peakRss = None
+        self.cpuTime = 0.0
+        self._startWallTime = None
+        self.record = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.peakRss = None
+        self.cpuTime = 0.0
+        self._startWallTime = time.time()
+        self._local.active = True
+        commander.addUsageListener(self._onCommandFinished)
+
+    def stop(self):
+        '''
+        Returns:
+            :ret dict with wallTime, cpuTime (seconds) and peakRss (bytes or
+                None if no command has been run)
+        '''
+        commander.removeUsageListener(self._onCommandFinished)
+        self._local.active = False
+        self.record = OrderedDict([
+            ("wallTime", round(time.time() - self._startWallTime, 6)),
+            ("cpuTime", round(self.cpuTime, 6)),
+            ("peakRss", self.peakRss),
+        ])
+        return self.record
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def _onCommandFinished(self, cmd, wallTime, rusage):
+        #the listener is called in the thread that has run the command
+        if rusage is None:
+            return
+        if not self.allThreads and not getattr(self._local, "active", False):
+            return
+        rss = maxRssToBytes(rusage.ru_maxrss)
+        with self._lock:
+            self.cpuTime += rusage.ru_utime + rusage.ru_stime
+            if self.peakRss is None or rss > self.peakRss:
+                self.peakRss = rss
+
+
+class BBoxStageTimings:
+    '''
+    Collects the timings of the stages. onTransition has to be registered as
+    a transition listener of the state machine.
+    '''
+    def __init__(self):
+        self.apkName = None
+        self.stages = []
+        self._meter = None
+        self._pendingSteps = []
+
+    def start(self, apkName):
+        '''
+        Starts measuring the first stage; the timings of the previous run are
+        dropped.
+        '''
+        self.apkName = apkName
+        self.stages = []
+        self._pendingSteps = []
+        self._stopMeter()
+        #the transitions may happen in the threads of the scheduler
+        self._meter = UsageMeter(allThreads=True)
+        self._meter.start()
+
+    def stop(self):
+        self._stopMeter()
+        self._pendingSteps = []
+
+    def onTransition(self, fromState, toState):
+        '''
+        Closes the stage that has led to toState and starts the next one.
+        '''
+        if not self._meter:
+            return
+        record = OrderedDict([("stage", toState)])
+        record.update(self._meter.stop())
+        #the steps may have been measured in other processes
+        stepsRss = [step["peakRss"] for step in self._pendingSteps if step["peakRss"] is not None]
+        if stepsRss:
+            record["peakRss"] = max(stepsRss + [record["peakRss"] or 0])
+        record["steps"] = self._pendingSteps
+        self.stages.append(record)
+        self._pendingSteps = []
+        self._meter.start()
+
+    def measureStep(self, step, fileName):
+        '''
+        Returns a context manager that measures one step of the current stage
+        (e.g., the conversion of one dex file).
+        '''
+        return _StepMeter(self, step, fileName)
+
+    def addStep(self, step, fileName, usage):
+        '''
+        Adds the step measured elsewhere (e.g., in a worker process) to the
+        current stage.
+
+        Args:
+            :param step: name of the step (e.g., STEP_DEX2JAR)
+            :param fileName: file processed by the step
+            :param usage: dict returned by UsageMeter.stop
+        '''
+        record = OrderedDict([("step", step), ("file", fileName)])
+        record.update(usage)
+        self._pendingSteps.append(record)
+
+    def getTimings(self):
+        '''
+        Returns:
+            :ret list of dicts (stage, wallTime, cpuTime, peakRss, steps) in
+                the order of the stages
+        '''
+        return self.stages
+
+    def writeJson(self, path):
+        with open(path, "w") as f:
+            json.dump(OrderedDict([("apk", self.apkName), ("stages", self.stages)]), f, indent=2)
+
+    def writePrometheus(self, path):
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            f.write(self.toPrometheus())
+        #scrapers must not see a partially written file
+        os.rename(tmpPath, path)
+
+    def toPrometheus(self):
+        '''
+        Returns the timings in Prometheus text exposition format.
+        '''
+        lines = []
+        metrics = [("wallTime", "wall_seconds", "Wall time of the stage"),
+                   ("cpuTime", "cpu_seconds", "CPU time of the processes spawned during the stage"),
+                   ("peakRss", "peak_rss_bytes", "Peak RSS of the processes spawned during the stage")]
+        for (kind, records) in [("stage", self._getStages()), ("step", self._getSteps())]:
+            for (key, suffix, description) in metrics:
+                name = "%s_%s_%s" % (PROMETHEUS_PREFIX, kind, suffix)
+                lines.append("# HELP %s %s." % (name, description.replace("stage", kind)))
+                lines.append("# TYPE %s gauge" % name)
+                for (labels, record) in records:
+                    if record[key] is not None:
+                        lines.append("%s{%s} %s" % (name, formatPrometheusLabels(labels), repr(record[key])))
+        return "\n".join(lines) + "\n"
+
+    def _getStages(self):
+        return [([("apk", self.apkName), ("stage", stage["stage"])], stage) for stage in self.stages]
+
+    def _getSteps(self):
+        steps = []
+        for stage in self.stages:
+            for step in stage["steps"]:
+                labels = [("apk", self.apkName), ("stage", stage["stage"]),
+                          ("step", step["step"]), ("file", step["file"])]
+                steps.append((labels, step))
+        return steps
+
+    def _stopMeter(self):
+        if self._meter:
+            self._meter.stop()
+            self._meter = None
+
+
+class _StepMeter(UsageMeter):
+    def __init__(self, timings, step, fileName):
+        UsageMeter.__init__(self)
+        self._timings = timings
+        self._step = step
+        self._fileName = fileName
+
+    def __exit__(self, excType, excValue, traceback):
+        self._timings.addStep(self._step, self._fileName, self.stop())
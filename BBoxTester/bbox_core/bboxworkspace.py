@@ -0,0 +1,200 @@
+'''
+Workspace of the instrumentation of an apk file.
+
+The workspace decides where the directories of the pipeline stages (decoded
+apk, raw jars, instrumented jars) are placed. If a RAM-backed file system
+(e.g., /dev/shm) is enabled, a stage directory is put there while the
+estimated size fits into the budget shared by all concurrent
+instrumentations; otherwise the directory is created in the tmp dir of the
+apk on disk. Stage directories can be released as soon as the next stage has
+consumed them.
+
+The placement of the stage directories is saved into the tmp dir of the apk,
+so a resumed instrumentation finds the directories where the previous run
+has left them. The budget is accounted in a ledger in the RAM-backed
+directory, protected by a file lock.
+'''
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+
+from utils import auxiliary_utils
+from logconfig import logger
+
+
+WORKSPACE_FILENAME = "workspace.json"
+LEDGER_FILENAME = "ledger.json"
+LEDGER_LOCK_FILENAME = "ledger.lock"
+
+
+class BBoxWorkspace:
+    def __init__(self, config, apkTmpDir):
+        self.apkTmpDir = os.path.abspath(apkTmpDir)
+        self.useTmpfs = config.useTmpfsWorkspace()
+        self.tmpfsDir = os.path.abspath(config.getTmpfsWorkspaceDir())
+        self.tmpfsBudget = config.getTmpfsWorkspaceBudget() * 1024 * 1024
+        self.releaseConsumed = config.releaseConsumedStages()
+        #workspace dirs of different tmp dirs (even of the same apk) differ
+        workspaceId = "%s-%s" % (os.path.basename(self.apkTmpDir),
+                                 hashlib.sha1(self.apkTmpDir).hexdigest()[:12])
+        self.tmpfsWorkspaceDir = os.path.join(self.tmpfsDir, workspaceId)
+        self.workspaceFile = os.path.join(self.apkTmpDir, WORKSPACE_FILENAME)
+        self.stageDirs = {}
+
+    def open(self, resume):
+        '''
+        Loads the placement of the stage directories of the previous run if
+        the instrumentation is resumed, otherwise removes the directories left
+        by the previous run.
+        '''
+        self.stageDirs = self._loadPlacement()
+        if not resume:
+            self.cleanup()
+
+    def getStageDir(self, name, estimatedSize=0):
+        '''
+        Returns the path to the stage directory. The directory is placed on
+        the RAM-backed file system if it is enabled and the estimated size
+        fits into the budget.
+
+        Args:
+            :param name: name of the stage directory
+            :param estimatedSize: estimated size of the directory in bytes
+        '''
+        path = self.stageDirs.get(name)
+        if path and (os.path.exists(path) or not self._isOnTmpfs(path)):
+            return path
+
+        path = os.path.join(self.apkTmpDir, name)
+        if self.useTmpfs:
+            tmpfsPath = os.path.join(self.tmpfsWorkspaceDir, name)
+            if self._reserve(tmpfsPath, estimatedSize):
+                path = tmpfsPath
+                auxiliary_utils.ensureDirExists(self.tmpfsWorkspaceDir)
+            else:
+                logger.debug("Stage dir [%s] does not fit into tmpfs budget, using disk" % name)
+        self.stageDirs[name] = path
+        self._savePlacement()
+        return path
+
+    def updateUsage(self, name):
+        '''
+        Replaces the reservation of the stage directory with its actual size.
+        '''
+        path = self.stageDirs.get(name)
+        if path and self._isOnTmpfs(path) and os.path.exists(path):
+            size = auxiliary_utils.getDirSize(path)
+            with self._lockedLedger() as ledger:
+                ledger.entries[path] = size
+
+    def release(self, name):
+        '''
+        Removes the stage directory (the next stage has consumed it).
+
+        Returns:
+            :ret path to the removed directory or None if it is unknown
+        '''
+        path = self.stageDirs.get(name)
+        if not path:
+            return None
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        if self._isOnTmpfs(path):
+            with self._lockedLedger() as ledger:
+                ledger.entries.pop(path, None)
+        return path
+
+    def cleanup(self):
+        '''
+        Removes all stage directories placed on the RAM-backed file system.
+        The directories on disk are removed together with the tmp dir.
+        '''
+        for path in self.stageDirs.values():
+            if self._isOnTmpfs(path) and os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+        if os.path.isdir(self.tmpfsWorkspaceDir):
+            shutil.rmtree(self.tmpfsWorkspaceDir, ignore_errors=True)
+        if os.path.isdir(self.tmpfsDir):
+            with self._lockedLedger() as ledger:
+                for path in ledger.entries.keys():
+                    if path.startswith(self.tmpfsWorkspaceDir + os.sep):
+                        del ledger.entries[path]
+        self.stageDirs = {}
+        if os.path.isdir(self.apkTmpDir):
+            self._savePlacement()
+
+
+    def _isOnTmpfs(self, path):
+        return path.startswith(self.tmpfsDir + os.sep)
+
+    def _reserve(self, path, size):
+        try:
+            auxiliary_utils.ensureDirExists(self.tmpfsDir)
+            stat = os.statvfs(self.tmpfsDir)
+            freeSpace = stat.f_bavail * stat.f_frsize
+            with self._lockedLedger() as ledger:
+                used = sum(ledger.entries.values())
+                if used + size > self.tmpfsBudget or size > freeSpace:
+                    return False
+                ledger.entries[path] = size
+                return True
+        except (OSError, IOError) as e:
+            logger.warning("Cannot use tmpfs workspace [%s]: %s" % (self.tmpfsDir, str(e)))
+            return False
+
+    def _lockedLedger(self):
+        return _Ledger(os.path.join(self.tmpfsDir, LEDGER_FILENAME),
+                       os.path.join(self.tmpfsDir, LEDGER_LOCK_FILENAME))
+
+    def _loadPlacement(self):
+        try:
+            with open(self.workspaceFile, "r") as f:
+                return json.load(f).get("stageDirs", {})
+        except (IOError, ValueError):
+            return {}
+
+    def _savePlacement(self):
+        auxiliary_utils.ensureDirExists(self.apkTmpDir)
+        with open(self.workspaceFile, "w") as f:
+            json.dump({"stageDirs" : self.stageDirs}, f, indent=2)
+
+
+class _Ledger:
+    '''
+    Context manager giving exclusive access to the reservations of the
+    RAM-backed file system {path : size}. The reservations of directories
+    that do not exist anymore are dropped.
+    '''
+    def __init__(self, ledgerPath, lockPath):
+        self.ledgerPath = ledgerPath
+        self.lockPath = lockPath
+        self.entries = {}
+        self._lockFile = None
+
+    def __enter__(self):
+        self._lockFile = open(self.lockPath, "a")
+        fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+        try:
+            with open(self.ledgerPath, "r") as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+        for path in self.entries.keys():
+            if not os.path.exists(path) and not os.path.exists(os.path.dirname(path)):
+                del self.entries[path]
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                tmpPath = self.ledgerPath + ".tmp"
+                with open(tmpPath, "w") as f:
+                    json.dump(self.entries, f)
+                os.rename(tmpPath, self.ledgerPath)
+        finally:
+            fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+            self._lockFile.close()
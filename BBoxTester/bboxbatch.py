@@ -0,0 +1,423 @@
+'''
+Batch instrumentation of many apk files.
+
+Each apk file is instrumented by BBoxCoverage.instrumentApkForCoverage in a
+separate worker process, so a crash or a hang of one apk does not affect the
+others. A worker is killed (together with the tools it has started) if the
+apk exceeds the timeout or if its tmp dir grows over the limit. The outcome
+of each apk file is appended to a JSONL log as soon as the apk is processed;
+apk files that have already succeeded according to the log are skipped on a
+rerun. The metrics of the commands run by the workers (see command_metrics)
+are written into the results dir at the end of the batch; the workers that
+have been killed do not report them.
+
+Usage examples:
+    python bboxbatch.py /path/to/apks --results-dir ./RESULTS --log results.jsonl
+    python bboxbatch.py --apk-list apks.txt --workers 8 --timeout 3600
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+from bboxcoverage import BBoxCoverage, INSTRUMENTATION_STATES, \
+    RESULTS_RELATIVE_DIR, TMP_RELATIVE_DIR
+from bbox_core.bbox_config import BBoxConfig
+from bbox_core.bboxworkspace import BBoxWorkspace
+from bbox_core.bboxheap import BBoxHeapManager, TOOL_APKTOOL, TOOL_DEX2JAR, \
+    TOOL_DX, TOOL_EMMA
+from interfaces import commander
+from interfaces.command_metrics import CommandMetrics, METRICS_FILENAME, PROMETHEUS_FILENAME
+from utils import auxiliary_utils
+from utils.apk_scan import ApkScanCache, ApkScanException
+from logconfig import logger
+
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_FAILURE = "failure"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_DISK_LIMIT = "disk_limit"
+OUTCOME_CRASH = "crash"
+
+POLL_INTERVAL = 0.2
+DISK_CHECK_INTERVAL = 5
+
+
+class BBoxBatchInstrumenter:
+    def __init__(self, pathToBBoxConfigFile="./config/bbox_config.ini", resultsDir=None,
+                 tmpDir=None, resultsLog=None, workers=None, apkTimeout=None,
+                 tmpMaxSize=None, copyApkToRes=False, keepFailedTmpDirs=False):
+        '''
+        Args:
+            :param pathToBBoxConfigFile: config used by the workers
+            :param resultsDir: root dir of the instrumentation results
+            :param tmpDir: root dir of the tmp dirs of the workers
+            :param resultsLog: path to the JSONL log of the outcomes
+            :param workers: number of worker processes (BATCH_WORKERS by default)
+            :param apkTimeout: timeout of one apk in seconds (BATCH_APK_TIMEOUT_SEC)
+            :param tmpMaxSize: limit of the tmp dir of one apk in MB
+                (BATCH_TMP_MAX_SIZE_MB)
+            :param copyApkToRes: copy the original apk into its results dir
+            :param keepFailedTmpDirs: do not remove the tmp dirs of failed apks
+        '''
+        self.pathToBBoxConfigFile = pathToBBoxConfigFile
+        self.config = BBoxConfig(pathToBBoxConfigFile)
+        self.resultsDir = os.path.abspath(resultsDir or os.path.join(os.getcwd(), RESULTS_RELATIVE_DIR))
+        self.tmpDir = os.path.abspath(tmpDir or os.path.join(os.getcwd(), TMP_RELATIVE_DIR))
+        self.resultsLog = os.path.abspath(resultsLog or os.path.join(self.resultsDir, "batch_results.jsonl"))
+        self.workers = max(1, workers or self.config.getBatchWorkers())
+        self.apkTimeout = apkTimeout or self.config.getBatchApkTimeout()
+        self.tmpMaxSize = (tmpMaxSize or self.config.getBatchTmpMaxSize()) * 1024 * 1024
+        self.copyApkToRes = copyApkToRes
+        self.keepFailedTmpDirs = keepFailedTmpDirs
+        self.heapManager = BBoxHeapManager(self.config)
+        self.commandMetrics = CommandMetrics()
+
+
+    def run(self, apkPaths):
+        '''
+        Instruments the apk files.
+
+        Returns:
+            :ret dict {outcome : number of apk files}, skipped apk files are
+                counted as "skipped"
+        '''
+        auxiliary_utils.ensureDirExists(self.resultsDir)
+        auxiliary_utils.ensureDirExists(self.tmpDir)
+        auxiliary_utils.ensureDirExists(os.path.dirname(self.resultsLog))
+
+        succeeded = self.getSucceededApks()
+        summary = {"skipped" : 0}
+        pending = []
+        apkNames = set()
+        for apkPath in apkPaths:
+            apkPath = os.path.abspath(apkPath)
+            if apkPath in succeeded:
+                summary["skipped"] += 1
+                continue
+            #results and tmp dirs are named after the apk file
+            apkName = os.path.splitext(os.path.basename(apkPath))[0]
+            if apkName in apkNames:
+                logger.warning("Skipping [%s]: another apk file with the same name is in the batch" % apkPath)
+                summary["skipped"] += 1
+                continue
+            apkNames.add(apkName)
+            pending.append(apkPath)
+
+        logger.info("Batch: %d apk files to instrument, %d skipped, %d workers" % (len(pending), summary["skipped"], self.workers))
+        if self.config.usePrescan():
+            pending = self._sortByEstimatedCost(pending)
+        pending.reverse()
+        running = []
+        with open(self.resultsLog, "a") as log:
+            try:
+                while pending or running:
+                    while pending and len(running) < self.workers and self._fitsIntoMemory(running, pending[-1]):
+                        running.append(self._startJob(pending.pop()))
+
+                    time.sleep(POLL_INTERVAL)
+                    for job in list(running):
+                        record = self._checkJob(job)
+                        if record is None:
+                            continue
+                        running.remove(job)
+                        self._writeRecord(log, record)
+                        summary[record["outcome"]] = summary.get(record["outcome"], 0) + 1
+            except BaseException:
+                #the workers run in their own sessions and do not get Ctrl-C;
+                #without the limits checked here they must not keep running
+                logger.warning("Batch interrupted: killing %d running workers" % len(running))
+                for job in running:
+                    self._killJob(job)
+                raise
+
+        self.commandMetrics.writeJson(os.path.join(self.resultsDir, METRICS_FILENAME))
+        self.commandMetrics.writePrometheus(os.path.join(self.resultsDir, PROMETHEUS_FILENAME))
+        logger.info("Batch finished: %s" % ", ".join(["%s: %d" % (k, v) for (k, v) in sorted(summary.items())]))
+        return summary
+
+
+    def getSucceededApks(self):
+        '''
+        Returns the set of paths to the apk files which last outcome in the
+        results log is success.
+        '''
+        outcomes = {}
+        if not os.path.isfile(self.resultsLog):
+            return set()
+        with open(self.resultsLog, "r") as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #the last line can be truncated if the batch was killed
+                    continue
+                outcomes[record.get("apk")] = record.get("outcome")
+        return set([apk for (apk, outcome) in outcomes.iteritems() if outcome == OUTCOME_SUCCESS])
+
+
+    def _sortByEstimatedCost(self, apkPaths):
+        '''
+        Orders the apk files from the largest to the smallest total size of
+        the dex files, so the long jobs do not start last and leave the other
+        workers idle. The scans are cached and reused by the workers.
+        '''
+        scanCache = ApkScanCache(self.config.getPrescanCacheDir())
+        costs = {}
+        for apkPath in apkPaths:
+            try:
+                scan = scanCache.getScan(apkPath, auxiliary_utils.getFileHash(apkPath))
+                costs[apkPath] = scan["totalDexSize"]
+            except (ApkScanException, IOError):
+                #the worker reports the broken apk file
+                costs[apkPath] = 0
+        return sorted(apkPaths, key=lambda apkPath: costs[apkPath], reverse=True)
+
+    def _fitsIntoMemory(self, running, apkPath):
+        '''
+        Checks if the heap predicted for the tools of the apk file fits into
+        the memory limit together with the heaps of the running jobs. A job
+        is always started if nothing is running.
+        '''
+        if not running or not self.heapManager.adaptive or not self.heapManager.memoryLimit:
+            return True
+        reservedHeapSize = sum([job.heapSize for job in running])
+        return reservedHeapSize + self._estimateJobHeap(apkPath) <= self.heapManager.memoryLimit
+
+    def _estimateJobHeap(self, apkPath):
+        return self.heapManager.getMaxHeapSize([TOOL_APKTOOL, TOOL_DEX2JAR, TOOL_EMMA, TOOL_DX], 
+                                               os.path.getsize(apkPath))
+
+    def _startJob(self, apkPath):
+        job = _BatchJob(apkPath)
+        job.heapSize = self._estimateJobHeap(apkPath)
+        job.apkTmpDir = os.path.join(self.tmpDir, job.apkName)
+        (receiver, sender) = multiprocessing.Pipe(duplex=False)
+        job.connection = receiver
+        job.process = multiprocessing.Process(target=_instrumentApkInWorker,
+                                              args=(self.pathToBBoxConfigFile, apkPath, self.resultsDir,
+                                                    self.tmpDir, self.copyApkToRes, sender))
+        job.startTime = time.time()
+        job.lastEventTime = job.startTime
+        job.process.start()
+        sender.close()
+        logger.info("Batch: started [%s] (pid %d)" % (apkPath, job.process.pid))
+        return job
+
+    def _checkJob(self, job):
+        '''
+        Processes the messages of the worker and enforces the limits.
+
+        Returns:
+            :ret the record for the results log if the job is finished, None
+                otherwise
+        '''
+        self._readMessages(job)
+        if job.result is not None:
+            job.process.join()
+            (success, instrumentedApk, error) = job.result
+            if success:
+                return self._finishJob(job, OUTCOME_SUCCESS, instrumentedApk=instrumentedApk)
+            return self._finishJob(job, OUTCOME_FAILURE, error or "Instrumentation failed")
+
+        if not job.process.is_alive():
+            job.process.join()
+            self._readMessages(job)
+            if job.result is not None:
+                return self._checkJob(job)
+            return self._finishJob(job, OUTCOME_CRASH, "Worker exited with code %s" % job.process.exitcode)
+
+        now = time.time()
+        if now - job.startTime > self.apkTimeout:
+            self._killJob(job)
+            return self._finishJob(job, OUTCOME_TIMEOUT, "Timeout of %d seconds is exceeded" % self.apkTimeout)
+
+        if now - job.lastDiskCheck > DISK_CHECK_INTERVAL:
+            job.lastDiskCheck = now
+            try:
+                tmpSize = auxiliary_utils.getDirSize(job.apkTmpDir)
+            except OSError:
+                #files are removed by the worker while we are counting
+                tmpSize = 0
+            if tmpSize > self.tmpMaxSize:
+                self._killJob(job)
+                return self._finishJob(job, OUTCOME_DISK_LIMIT, "Tmp dir size %d exceeds the limit %d" % (tmpSize, self.tmpMaxSize))
+        return None
+
+    def _readMessages(self, job):
+        try:
+            while job.connection.poll():
+                message = job.connection.recv()
+                if message[0] == "stage":
+                    (_, state, eventTime) = message
+                    job.stageTimings[state] = round(eventTime - job.lastEventTime, 3)
+                    job.lastEventTime = eventTime
+                    job.lastState = state
+                elif message[0] == "metrics":
+                    self.commandMetrics.merge(message[1])
+                elif message[0] == "result":
+                    job.result = message[1:]
+        except (EOFError, IOError):
+            pass
+
+    def _killJob(self, job):
+        #the worker is the leader of its session; the tools started by it run
+        #in sessions of their own
+        commander.killSession(job.process.pid)
+        if job.process.is_alive():
+            job.process.terminate()
+        job.process.join()
+
+    def _finishJob(self, job, outcome, error=None, instrumentedApk=None):
+        job.connection.close()
+        if outcome != OUTCOME_SUCCESS and not self.keepFailedTmpDirs:
+            #killed workers leave their stage dirs in RAM
+            BBoxWorkspace(self.config, job.apkTmpDir).open(False)
+            shutil.rmtree(job.apkTmpDir, ignore_errors=True)
+
+        failedStage = None
+        if outcome != OUTCOME_SUCCESS:
+            failedStage = _getNextState(job.lastState)
+        record = OrderedDict([
+            ("apk", job.apkPath),
+            ("apkName", job.apkName),
+            ("outcome", outcome),
+            ("failedStage", failedStage),
+            ("error", error),
+            ("instrumentedApk", instrumentedApk),
+            ("startTime", job.startTime),
+            ("duration", round(time.time() - job.startTime, 3)),
+            ("stageTimings", job.stageTimings),
+        ])
+        logger.info("Batch: [%s] %s%s" % (job.apkPath, outcome, " at stage %s" % failedStage if failedStage else ""))
+        return record
+
+    def _writeRecord(self, log, record):
+        log.write(json.dumps(record) + "\n")
+        log.flush()
+        os.fsync(log.fileno())
+
+
+class _BatchJob:
+    def __init__(self, apkPath):
+        self.apkPath = apkPath
+        self.apkName = os.path.splitext(os.path.basename(apkPath))[0]
+        self.apkTmpDir = None
+        self.process = None
+        self.connection = None
+        self.startTime = None
+        self.lastEventTime = None
+        self.lastDiskCheck = 0
+        self.lastState = None
+        self.stageTimings = OrderedDict()
+        self.result = None
+        self.heapSize = 0
+
+
+def _getNextState(state):
+    if state not in INSTRUMENTATION_STATES:
+        return INSTRUMENTATION_STATES[0]
+    index = INSTRUMENTATION_STATES.index(state)
+    if index + 1 < len(INSTRUMENTATION_STATES):
+        return INSTRUMENTATION_STATES[index + 1]
+    return None
+
+
+def _instrumentApkInWorker(pathToBBoxConfigFile, apkPath, resultsDir, tmpDir, copyApkToRes, connection):
+    #own session, so the parent can kill the worker with its children
+    try:
+        os.setsid()
+    except OSError:
+        pass
+
+    def onTransition(fromState, toState):
+        connection.send(("stage", toState, time.time()))
+
+    #the worker has a copy of the metrics of the parent
+    commander.getCommandMetrics().reset()
+    try:
+        try:
+            bboxcoverage = BBoxCoverage(pathToBBoxConfigFile)
+            bboxcoverage.addStateTransitionListener(onTransition)
+            success = bboxcoverage.instrumentApkForCoverage(pathToOrigApk=apkPath,
+                                                            resultsDir=resultsDir,
+                                                            tmpDir=tmpDir,
+                                                            removeApkTmpDirAfterInstr=True,
+                                                            copyApkToRes=copyApkToRes)
+            instrumentedApk = bboxcoverage.getInstrumentedApk() if success else None
+            result = ("result", success, instrumentedApk, None)
+        except Exception:
+            result = ("result", False, None, traceback.format_exc())
+        #the parent finishes the job after the result
+        connection.send(("metrics", commander.getCommandMetrics().getState()))
+        connection.send(result)
+    finally:
+        connection.close()
+
+
+def findApkFiles(paths):
+    '''
+    Returns the list of apk files: directories are searched recursively for
+    *.apk files.
+    '''
+    apkFiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.lower().endswith(".apk"):
+                        apkFiles.append(os.path.join(root, fn))
+        else:
+            apkFiles.append(path)
+    return apkFiles
+
+
+def readApkList(pathToList):
+    with open(pathToList, "r") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Instrument many apk files in parallel worker processes.")
+    parser.add_argument("paths", nargs="*", help="apk files or directories with apk files")
+    parser.add_argument("--apk-list", default=None, help="file with paths to apk files, one per line")
+    parser.add_argument("--config", default="./config/bbox_config.ini", help="path to BBoxTester config file")
+    parser.add_argument("--results-dir", default=None, help="root dir of the results (default: ./%s)" % RESULTS_RELATIVE_DIR)
+    parser.add_argument("--tmp-dir", default=None, help="root dir of tmp files (default: ./%s)" % TMP_RELATIVE_DIR)
+    parser.add_argument("--log", default=None, help="JSONL results log (default: <results-dir>/batch_results.jsonl)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: BATCH_WORKERS)")
+    parser.add_argument("--timeout", type=int, default=None, help="timeout of one apk in seconds (default: BATCH_APK_TIMEOUT_SEC)")
+    parser.add_argument("--tmp-max-size", type=int, default=None, help="limit of tmp dir of one apk in MB (default: BATCH_TMP_MAX_SIZE_MB)")
+    parser.add_argument("--copy-apk", action="store_true", help="copy original apk files into the results dirs")
+    parser.add_argument("--keep-failed-tmp", action="store_true", help="keep tmp dirs of failed apk files")
+    args = parser.parse_args(argv)
+
+    apkPaths = findApkFiles(args.paths)
+    if args.apk_list:
+        apkPaths.extend(readApkList(args.apk_list))
+    if not apkPaths:
+        parser.error("No apk files provided")
+
+    batch = BBoxBatchInstrumenter(pathToBBoxConfigFile=args.config,
+                                  resultsDir=args.results_dir,
+                                  tmpDir=args.tmp_dir,
+                                  resultsLog=args.log,
+                                  workers=args.workers,
+                                  apkTimeout=args.timeout,
+                                  tmpMaxSize=args.tmp_max_size,
+                                  copyApkToRes=args.copy_apk,
+                                  keepFailedTmpDirs=args.keep_failed_tmp)
+    summary = batch.run(apkPaths)
+    print ", ".join(["%s: %d" % (k, v) for (k, v) in sorted(summary.items())])
+    failed = sum([v for (k, v) in summary.items() if k not in (OUTCOME_SUCCESS, "skipped")])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
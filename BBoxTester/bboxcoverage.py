@@ -3,24 +3,40 @@ Created on Oct 14, 2014
 
 @author: Yury Zhauniarovich <y.zhalnerovich{at}gmail.com>
 '''
-import os, sys, shutil
+import os, sys, shutil, re
+import hashlib
+import zipfile
+import multiprocessing
 import ConfigParser
 from bbox_core.bbox_config import BBoxConfig
 from utils.state_machine import StateMachine
-from utils import apk_utils, auxiliary_utils, zip_utils
+from utils import apk_utils, auxiliary_utils, zip_utils, emma_filters, apk_scan, class_refs
+from utils.class_refs import ClassFileException
+from utils.apk_scan import ApkScanCache, ApkScanException
 from bbox_core.bboxreporter import MsgException, BBoxReporter
 from bbox_core.bboxinstrumenter import BBoxInstrumenter,\
     ApkCannotBeDecompiledException, Dex2JarConvertionError,\
     EmmaCannotInstrumentException, Jar2DexConvertionError,\
     IllegalArgumentException, ApktoolBuildException, SignApkException,\
-    AlignApkException
+    AlignApkException, EmmaCannotMergeException, ApkPatchException
 from bbox_core.bboxexecutor import BBoxExecutor, ApkCannotBeInstalledException
+from bbox_core.bboxcache import BBoxInstrCache
+from bbox_core.bboxclasscache import BBoxEmmaClassCache
+from bbox_core.bboxjournal import BBoxInstrJournal, JOURNAL_FILENAME
+from bbox_core.bboxworkspace import BBoxWorkspace
+from bbox_core.bboxtimings import BBoxStageTimings, UsageMeter, TIMINGS_FILENAME, \
+    PROMETHEUS_FILENAME, STEP_DEX2JAR, STEP_EMMA, STEP_DX, STEP_MANIFEST, STEP_APKTOOL
+from bbox_core.bboxscheduler import BBoxStageScheduler
+from bbox_core.bboxheap import TOOL_DEX2JAR, TOOL_EMMA, TOOL_DX
 from logconfig import logger
 from string import rfind
-from utils.android_manifest import AndroidManifest
+from utils.android_manifest import AndroidManifest, NoManifestFoundException
+from utils.axml import AxmlException
+from xml.parsers.expat import ExpatError
 from time import localtime
 import datetime
 from interfaces.emma_interface import EMMA_REPORT
+from interfaces import commander
 import time
 from six import iteritems
 
@@ -33,6 +49,32 @@ DEVICE_REPORT_FOLDER_PATH = "/mnt/sdcard"
 
 PARAMS_SECTION = "parameters"
 
+#tmp dir of the apk built by apktool (when intermediate apks are not kept)
+BUILD_RELATIVE_DIR = "build"
+#tmp dir of the dex files produced by dx (the decoded ones are kept unchanged)
+INSTR_DEX_RELATIVE_DIR = "instrumented_dex"
+#instrumented binary manifest in the tmp dir (zip patch mode)
+INSTR_MANIFEST_FILENAME = "AndroidManifest.instr.xml"
+#decoded manifest saved in the tmp dir while apktool builds the apk
+DECODED_MANIFEST_BACKUP_FILENAME = "AndroidManifest.decoded.xml"
+#dir apktool creates in the decoded apk during the build
+APKTOOL_BUILD_DIR = "build"
+#stage dirs are estimated as this factor times the size of their input
+WORKSPACE_SIZE_FACTOR = 2
+#classes of the multidex support library; they load the secondary dex files
+#and have to be in classes.dex
+MULTIDEX_CLASS_PREFIXES = ("android/support/multidex/", "androidx/multidex/")
+#Android 5.0 loads all dex files of the apk without the support library
+NATIVE_MULTIDEX_SDK_VERSION = 21
+#apktool moves minSdkVersion from the manifest to apktool.yml
+APKTOOL_MIN_SDK_RE = re.compile(r"minSdkVersion:\s*'?(\d+)")
+
+#apktool decodes and rebuilds the whole apk
+PIPELINE_MODE_APKTOOL = "APKTOOL"
+#only dex files and binary manifest are replaced in the original apk
+PIPELINE_MODE_ZIP_PATCH = "ZIP_PATCH"
+PIPELINE_MODES = [PIPELINE_MODE_APKTOOL, PIPELINE_MODE_ZIP_PATCH]
+
 
 
 STATE_UNINITIALIZED = "UNINITIALIZED"
@@ -56,6 +98,41 @@ STATE_APK_FINISHED_TESTING = "TEST_IS_FINISHED"
 
 
 
+#states passed by the instrumentation pipeline after the folders are created
+INSTRUMENTATION_STAGE_STATES = [STATE_APK_DECOMPILED,
+                                STATE_DEX_CONVERTED_TO_JAR,
+                                STATE_JARS_INSTRUMENTED,
+                                STATE_JAR_CONVERTED_TO_DEX,
+                                STATE_MANIFEST_INSTRUMENTED,
+                                STATE_INSTRUMENTED_APK_BUILD,
+                                STATE_FINAL_INSTRUMENTED_APK_BUILD,
+                                STATE_INSTRUMENTED_APK_SIGNED,
+                                STATE_INSTRUMENTED_APK_ALIGNED,
+                                ]
+
+#all states passed by a successful instrumentation in their order
+INSTRUMENTATION_STATES = ([STATE_APK_VALID, STATE_FOLDERS_CREATED] + 
+                          INSTRUMENTATION_STAGE_STATES + [STATE_APK_INSTRUMENTED])
+
+#(section, option) pairs of BBoxConfig the stages depend on directly; a change
+#repeats the stage and the stages depending on it
+STAGE_INPUT_OPTIONS = {
+    STATE_APK_DECOMPILED : [("GENERAL", "PIPELINE_MODE"), ("APKTOOL", "APKTOOL_JAR")],
+    STATE_DEX_CONVERTED_TO_JAR : [("DEX2JAR", "DEX2JAR_LIBS_PATH"), ("DEX2JAR", "DEX2JAR_CLASS_DEX2JAR")],
+    STATE_JARS_INSTRUMENTED : [("EMMA", "EMMA_JAR"), ("EMMA", "EMMA_INCLUDE_FILTERS"), 
+                               ("EMMA", "EMMA_EXCLUDE_FILTERS"), ("EMMA", "EMMA_AUTO_FILTERS")],
+    STATE_JAR_CONVERTED_TO_DEX : [("DX", "DX_JAR"), ("DX", "DX_MULTIDEX"), ("DX", "DX_MULTIDEX_THRESHOLD"), 
+                                  ("EMMA", "EMMA_DEVICE_JAR"), ("EMMA", "ANDROID_SPECIFIC_INSTRUMENTATION_CLASSES_PATH")],
+    STATE_MANIFEST_INSTRUMENTED : [("GENERAL", "PIPELINE_MODE")],
+    STATE_INSTRUMENTED_APK_BUILD : [("GENERAL", "KEEP_INTERMEDIATE_APKS"), ("AAPT", "AAPT_DIR")],
+    STATE_FINAL_INSTRUMENTED_APK_BUILD : [("GENERAL", "KEEP_INTERMEDIATE_APKS"), ("EMMA", "EMMA_RESOURCES_DIR")],
+    STATE_INSTRUMENTED_APK_SIGNED : [("SIGNING", "SIGNER"), ("SIGNING", "SIGNING_KEY_FILE"), 
+                                     ("SIGNING", "SIGNING_CERT_FILE"), ("SIGNING", "SIGNING_DIGEST_ALGORITHM"), 
+                                     ("DEX2JAR", "DEX2JAR_CLASS_APKSIGN")],
+    STATE_INSTRUMENTED_APK_ALIGNED : [("ZIPALIGN", "ZIPALIGN_ALIGNMENT")],
+}
+
+
 STATES = [(STATE_UNINITIALIZED, STATE_APK_VALID),
           (STATE_APK_VALID, STATE_FOLDERS_CREATED),
           (STATE_FOLDERS_CREATED, STATE_APK_DECOMPILED),
@@ -111,6 +188,10 @@ class BBoxCoverage:
         self.bboxExecutor = BBoxExecutor(self.config)
         self.bboxReporter = BBoxReporter(self.config)
         self._bboxStateMachine = StateMachine(states=STATES)
+        self.apkScan = None
+        self.stageTimings = BBoxStageTimings()
+        self._taskTimings = {}
+        self._bboxStateMachine.addTransitionListener(self.stageTimings.onTransition)
     
     def getInstrumentedApk(self):
         return self.instrumentedApk
@@ -118,10 +199,32 @@ class BBoxCoverage:
     def getPackageName(self):
         return self.packageName
     
+    def getCurrentState(self):
+        return self._bboxStateMachine.getCurrentState()
+    
+    def addStateTransitionListener(self, listener):
+        '''
+        Registers a function called as listener(fromState, toState) after each
+        state transition (e.g., to track the progress of the instrumentation).
+        '''
+        self._bboxStateMachine.addTransitionListener(listener)
+    
+    def getStageTimings(self):
+        '''
+        Returns the timings of the stages of the last instrumentation: list of
+        dicts with stage (the state reached), wallTime, cpuTime, peakRss and
+        steps (the same numbers per processed file).
+        '''
+        return self.stageTimings.getTimings()
+    
     def instrumentApkForCoverage(self, pathToOrigApk, resultsDir=None, tmpDir=None, 
                                  removeApkTmpDirAfterInstr=True, 
                                  copyApkToRes = True):
         '''
+        If the tmp dir of a previous unsuccessful instrumentation of the same
+        apk file is kept, the instrumentation resumes from the first stage that
+        has not been completed (see RESUME_INSTRUMENTATION option).
+        
         Args:
             :param pathToOrigApk:
             :param resultsDir:
@@ -130,6 +233,32 @@ class BBoxCoverage:
         Returns:
             :ret True - if instrumentation was successful, False otherwise
         '''
+        self.workspace = None
+        self.apkResultsDir = None
+        success = False
+        self.stageTimings.start(os.path.splitext(os.path.basename(pathToOrigApk))[0])
+        try:
+            success = self._instrumentApkForCoverage(pathToOrigApk, resultsDir, tmpDir, 
+                                                     removeApkTmpDirAfterInstr, copyApkToRes)
+        finally:
+            self.stageTimings.stop()
+            self._writeStageTimings()
+            #the stage dirs in RAM are kept only to resume the instrumentation
+            if not success and self.workspace and not self.config.resumeInstrumentation():
+                self.workspace.cleanup()
+        return success
+    
+    def _writeStageTimings(self):
+        if not self.apkResultsDir or not os.path.isdir(self.apkResultsDir):
+            return
+        try:
+            self.stageTimings.writeJson(os.path.join(self.apkResultsDir, TIMINGS_FILENAME))
+            self.stageTimings.writePrometheus(os.path.join(self.apkResultsDir, PROMETHEUS_FILENAME))
+        except (OSError, IOError) as e:
+            logger.warning("Cannot write stage timings! %s" % str(e))
+    
+    def _instrumentApkForCoverage(self, pathToOrigApk, resultsDir, tmpDir, 
+                                  removeApkTmpDirAfterInstr, copyApkToRes):
         self._bboxStateMachine.start(STATE_UNINITIALIZED)
         
         valid = self._checkProvidedApk(pathToOrigApk)
@@ -151,25 +280,73 @@ class BBoxCoverage:
         
         apkFileName = os.path.splitext(os.path.basename(pathToOrigApk))[0]
         
-        self.apkTmpDir = self._createDir(tmpDir, apkFileName, False, True)
-        self.apkResultsDir = self._createDir(resultsRootDir, apkFileName, False, True)
-        self.coverageMetadataFolder = self._createDir(self.apkResultsDir, self.config.getCoverageMetadataRelativeDir(), False, True)
-        self.runtimeReportsRootDir = self._createDir(self.apkResultsDir, self.config.getRuntimeReportsRelativeDir(), False, True)
+        pipelineMode = self.config.getPipelineMode()
+        if pipelineMode not in PIPELINE_MODES:
+            logger.error("Unknown pipeline mode: %s. Possible values: %s" % (pipelineMode, ", ".join(PIPELINE_MODES)))
+            return False
+        
+        #checking if there is a journal of a previous run for this apk
+        apkHash = auxiliary_utils.getFileHash(pathToOrigApk)
+        if self.config.usePrescan() and not self._prescanApk(pathToOrigApk, apkHash):
+            return False
+        #only the stages which inputs have changed and the stages depending on
+        #them are repeated
+        journal = BBoxInstrJournal(os.path.join(tmpRootDir, apkFileName, JOURNAL_FILENAME))
+        stageInputs = self._getStageInputs()
+        stageDependencies = _getStageDependencies(pipelineMode)
+        resume = self.config.resumeInstrumentation() and journal.open(apkHash, stageInputs, stageDependencies)
+        keepIntermediateApks = self.config.keepIntermediateApks()
+        if resume:
+            logger.info("Resuming instrumentation of [%s] after the stages: %s" % (pathToOrigApk, ", ".join(journal.getCompletedStates())))
+        
+        #stage dirs of the previous run placed outside of the tmp dir have to
+        #be found before the tmp dir is recreated
+        self.workspace = BBoxWorkspace(self.config, os.path.join(tmpRootDir, apkFileName))
+        self.workspace.open(resume)
+        self.apkTmpDir = self._createDir(tmpRootDir, apkFileName, False, not resume)
+        self.apkResultsDir = self._createDir(resultsRootDir, apkFileName, False, not resume)
+        self.coverageMetadataFolder = self._createDir(self.apkResultsDir, self.config.getCoverageMetadataRelativeDir(), False, not resume)
+        self.runtimeReportsRootDir = self._createDir(self.apkResultsDir, self.config.getRuntimeReportsRelativeDir(), False, not resume)
+        if not resume:
+            journal.reset(apkHash, stageInputs, stageDependencies)
         self._bboxStateMachine.transitToState(STATE_FOLDERS_CREATED)
         
         #coping initial apk file if required
         if copyApkToRes:
             shutil.copy2(pathToOrigApk, self.apkResultsDir)
         
+        #taking the instrumented apk from the cache if it has been already built
+        instrCache = None
+        cacheKey = None
+        if self.config.useInstrCache():
+            instrCache = BBoxInstrCache(self.config)
+            cacheKey = instrCache.computeKey(pathToOrigApk, apkHash)
+            alignedApkFilePath = self._restoreFromInstrCache(instrCache, cacheKey, apkFileName)
+            if alignedApkFilePath:
+                return self._finishInstrumentation(alignedApkFilePath, removeApkTmpDirAfterInstr)
+        
         #decompiling apk into a folder
-        decompileDir = os.path.join(self.apkTmpDir, self.config.getDecompiledApkRelativeDir())
-        success = self._decompileApk(self.bboxInstrumenter, pathToOrigApk, decompileDir)
-        if not success:
-            return False
+        decompileDir = self.workspace.getStageDir(self.config.getDecompiledApkRelativeDir(),
+                                                  self._estimateDecodedSize(pathToOrigApk, pipelineMode))
+        decompiledAndroidManifestPath = os.path.join(decompileDir, "AndroidManifest.xml")
+        if not journal.isCompleted(STATE_APK_DECOMPILED):
+            if pipelineMode == PIPELINE_MODE_ZIP_PATCH:
+                success = self._extractApkCode(self.bboxInstrumenter, pathToOrigApk, decompileDir)
+            else:
+                success = self._decompileApk(self.bboxInstrumenter, pathToOrigApk, decompileDir)
+            if not success:
+                return False
+            #getting all available dex files
+            dexFilesRelativePaths = self._getDexFilePathsRelativeToDir(decompileDir)
+            artifacts = [decompileDir, decompiledAndroidManifestPath]
+            artifacts.extend([os.path.join(decompileDir, pth) for pth in dexFilesRelativePaths])
+            journal.complete(STATE_APK_DECOMPILED, artifacts, 
+                             {"dexFilesRelativePaths" : dexFilesRelativePaths})
+            self.workspace.updateUsage(self.config.getDecompiledApkRelativeDir())
+        else:
+            dexFilesRelativePaths = journal.getData(STATE_APK_DECOMPILED)["dexFilesRelativePaths"]
         self._bboxStateMachine.transitToState(STATE_APK_DECOMPILED)
         
-        #getting all available dex files
-        dexFilesRelativePaths = self._getDexFilePathsRelativeToDir(decompileDir)
         if not dexFilesRelativePaths:
             logger.error("There is no dex files to convert!")
             return False
@@ -179,46 +356,285 @@ class BBoxCoverage:
             return False
         
         
-        #converting dex to jar files
-        rawJarFilesRootDir = os.path.join(self.apkTmpDir, self.config.getTmpJarRelativeDir())
-        jarFilesRelativePaths = self._convertDex2JarFiles(
-                                    converter=self.bboxInstrumenter, 
-                                    dexFilesRootDir=decompileDir, 
-                                    dexFilesRelativePaths=dexFilesRelativePaths,
-                                    jarFilesRootDir=rawJarFilesRootDir,
-                                    proceedOnError=True)
-        self._bboxStateMachine.transitToState(STATE_DEX_CONVERTED_TO_JAR)
+        dexFilesSize = sum([os.path.getsize(os.path.join(decompileDir, pth)) for pth in dexFilesRelativePaths 
+                            if os.path.isfile(os.path.join(decompileDir, pth))])
+        rawJarFilesRootDir = self.workspace.getStageDir(self.config.getTmpJarRelativeDir(), 
+                                                        WORKSPACE_SIZE_FACTOR * dexFilesSize)
+        self.coverageMetadataFile = os.path.join(self.coverageMetadataFolder, self.config.getCoverageMetadataFilename())
+        emmaInstrJarFilesRootDir = self.workspace.getStageDir(self.config.getInstrumentedFilesRelativeDir(), 
+                                                              WORKSPACE_SIZE_FACTOR * dexFilesSize)
+        instrDexFilesRootDir = self.workspace.getStageDir(INSTR_DEX_RELATIVE_DIR, WORKSPACE_SIZE_FACTOR * dexFilesSize)
         
-        if "classes.jar" not in jarFilesRelativePaths:
-            #main file is not converted
-            logger.error("Conversion from classes.dex to classes.jar was not successful!")
-            return False
+        emmaFilters = []
+        if not journal.isCompleted(STATE_JARS_INSTRUMENTED):
+            emmaFilters = self._getEmmaFilters(decompiledAndroidManifestPath)
+        mainDexRules = ([], None)
+        if not journal.isCompleted(STATE_JAR_CONVERTED_TO_DEX) and self.config.useDxMultiDex():
+            mainDexRules = _getMainDexRules(decompiledAndroidManifestPath, decompileDir)
         
-        #instrumenting available jar files
-        self.coverageMetadataFile = os.path.join(self.coverageMetadataFolder, self.config.getCoverageMetadataFilename())
-        emmaInstrJarFilesRootDir = os.path.join(self.apkTmpDir, self.config.getInstrumentedFilesRelativeDir())
-        emmaInstrJarFileRelativePaths = self._instrFilesWithEmma(
-                            instrumenter=self.bboxInstrumenter, 
-                            jarFilesRootDir=rawJarFilesRootDir, 
-                            jarFilesRelativePaths=jarFilesRelativePaths, 
-                            instrJarsRootDir=emmaInstrJarFilesRootDir,
-                            coverageMetadataFile=self.coverageMetadataFile,
-                            proceedOnError=True)
-        self._bboxStateMachine.transitToState(STATE_JARS_INSTRUMENTED)
-        
-        if "classes.jar" not in emmaInstrJarFileRelativePaths:
-            #main file is not instrumented
-            logger.error("Instrumentation of classes.jar was not successful!")
+        self.androidManifestFile = os.path.join(self.apkResultsDir, "AndroidManifest.xml")
+        instrAndroidManifestPath = os.path.join(self.apkTmpDir, INSTR_MANIFEST_FILENAME)
+        #without intermediate apks, the output of apktool is kept only in the
+        #tmp dir and the final apk is produced from it in one pass
+        if keepIntermediateApks:
+            compiledApkDir = self.apkResultsDir
+        else:
+            compiledApkDir = self.workspace.getStageDir(BUILD_RELATIVE_DIR, 
+                                                        WORKSPACE_SIZE_FACTOR * os.path.getsize(pathToOrigApk))
+            auxiliary_utils.ensureDirExists(compiledApkDir)
+        compiledApkFilePath = os.path.join(compiledApkDir, "%s%s.apk" % (apkFileName, self.config.getInstrFileSuffix()))
+        compiledApkFilePathWithEmmaRes = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getFinalInstrFileSuffix()))
+        signedApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getSignedFileSuffix()))
+        alignedApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getAlignedFileSuffix()))
+        
+        #the manifest is instrumented (and the apk is built by apktool) while
+        #the dex files go through dex2jar, Emma and dx; the state machine
+        #enters the stages in their order when the tasks are finished
+        self._taskTimings = {}
+        #the workers of the dex files are forked before the stage threads are
+        #started: a process forked while another thread holds a lock (e.g.,
+        #of a logging handler) inherits the lock held and deadlocks on it
+        dexPool = self._createDexProcessingPool(journal, decompileDir, dexFilesRelativePaths)
+        scheduler = BBoxStageScheduler(self.config.getStageWorkers())
+        scheduler.addTask(STATE_JAR_CONVERTED_TO_DEX, 
+                          lambda: self._instrumentDexFiles(journal, decompileDir, dexFilesRelativePaths, 
+                                                           rawJarFilesRootDir, emmaInstrJarFilesRootDir, 
+                                                           instrDexFilesRootDir, emmaFilters, mainDexRules, 
+                                                           dexPool))
+        scheduler.addTask(STATE_MANIFEST_INSTRUMENTED, 
+                          lambda: self._instrumentManifest(journal, pipelineMode, decompiledAndroidManifestPath, 
+                                                           instrAndroidManifestPath))
+        if pipelineMode == PIPELINE_MODE_APKTOOL:
+            scheduler.addTask(STATE_INSTRUMENTED_APK_BUILD, 
+                              lambda: self._buildApk(journal, decompileDir, compiledApkFilePath), 
+                              dependsOn=[STATE_MANIFEST_INSTRUMENTED])
+        try:
+            succeeded = scheduler.run()
+        finally:
+            if dexPool:
+                dexPool.terminate()
+                dexPool.join()
+        if not succeeded:
             return False
+        instrDexFilesRelativePaths = scheduler.getResult(STATE_JAR_CONVERTED_TO_DEX)
+        self._addTaskTimings(STATE_MANIFEST_INSTRUMENTED)
+        self._bboxStateMachine.transitToState(STATE_MANIFEST_INSTRUMENTED)
+        
+        finalisedStates = [STATE_FINAL_INSTRUMENTED_APK_BUILD, STATE_INSTRUMENTED_APK_SIGNED, STATE_INSTRUMENTED_APK_ALIGNED]
+        #instrumented dex files replace the original ones when the final apk
+        #is written
+        replacedFiles = {}
+        for dexFileRelativePath in instrDexFilesRelativePaths:
+            replacedFiles[dexFileRelativePath] = os.path.join(instrDexFilesRootDir, dexFileRelativePath)
+        if pipelineMode == PIPELINE_MODE_ZIP_PATCH:
+            #instrumented files and Emma resources are put into the copy of the
+            #original apk in one pass
+            replacedFiles["AndroidManifest.xml"] = instrAndroidManifestPath
+            finalisedApkSource = pathToOrigApk
+            finalisedStates.insert(0, STATE_INSTRUMENTED_APK_BUILD)
+            
+            if keepIntermediateApks:
+                if not journal.isCompleted(STATE_FINAL_INSTRUMENTED_APK_BUILD):
+                    success = self._patchApk(self.bboxInstrumenter, pathToOrigApk, compiledApkFilePathWithEmmaRes, 
+                                             replacedFiles, self.config.getEmmaResourcesDir())
+                    if not success:
+                        logger.error("Cannot build apk!")
+                        return False
+                    journal.complete(STATE_INSTRUMENTED_APK_BUILD, [compiledApkFilePathWithEmmaRes])
+                    journal.complete(STATE_FINAL_INSTRUMENTED_APK_BUILD, [compiledApkFilePathWithEmmaRes])
+                self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_BUILD)
+                self._bboxStateMachine.transitToState(STATE_FINAL_INSTRUMENTED_APK_BUILD)
+        else:
+            finalisedApkSource = compiledApkFilePath
+            self._addTaskTimings(STATE_INSTRUMENTED_APK_BUILD)
+            self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_BUILD)
+            
+            #need to put instrumented dex files and resources into file
+            if keepIntermediateApks:
+                if not journal.isCompleted(STATE_FINAL_INSTRUMENTED_APK_BUILD):
+                    success = self._patchApk(self.bboxInstrumenter, compiledApkFilePath, compiledApkFilePathWithEmmaRes, 
+                                             replacedFiles, self.config.getEmmaResourcesDir())
+                    if not success:
+                        logger.error("Cannot build apk!")
+                        return False
+                    journal.complete(STATE_FINAL_INSTRUMENTED_APK_BUILD, [compiledApkFilePathWithEmmaRes])
+                self._bboxStateMachine.transitToState(STATE_FINAL_INSTRUMENTED_APK_BUILD)
+        
+        if keepIntermediateApks:
+            if not journal.isCompleted(STATE_INSTRUMENTED_APK_SIGNED):
+                success = self._signApk(self.bboxInstrumenter, compiledApkFilePathWithEmmaRes, signedApkFilePath)
+                if not success:
+                    logger.error("Cannot sign apk!")
+                    return False
+                journal.complete(STATE_INSTRUMENTED_APK_SIGNED, [signedApkFilePath])
+            self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_SIGNED)
+            
+            if not journal.isCompleted(STATE_INSTRUMENTED_APK_ALIGNED):
+                success = self._alignApk(self.bboxInstrumenter, signedApkFilePath, alignedApkFilePath)
+                if not success:
+                    logger.error("Cannot align apk!")
+                    return False
+                journal.complete(STATE_INSTRUMENTED_APK_ALIGNED, [alignedApkFilePath])
+            self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_ALIGNED)
+        else:
+            #adding resources, signing and aligning in one pass
+            if not journal.isCompleted(STATE_INSTRUMENTED_APK_ALIGNED):
+                success = self._finaliseApk(self.bboxInstrumenter, finalisedApkSource, alignedApkFilePath, 
+                                            replacedFiles, self.config.getEmmaResourcesDir())
+                if not success:
+                    logger.error("Cannot finalise apk!")
+                    return False
+                for state in finalisedStates:
+                    journal.complete(state, [alignedApkFilePath])
+            for state in finalisedStates:
+                self._bboxStateMachine.transitToState(state)
+            #the final apk does not depend on the tmp files anymore
+            self._releaseStageDir(journal, BUILD_RELATIVE_DIR, 
+                                  [STATE_INSTRUMENTED_APK_BUILD], STATE_INSTRUMENTED_APK_ALIGNED)
+            self._releaseStageDir(journal, INSTR_DEX_RELATIVE_DIR, 
+                                  [STATE_JAR_CONVERTED_TO_DEX], STATE_INSTRUMENTED_APK_ALIGNED)
+            self._releaseStageDir(journal, self.config.getDecompiledApkRelativeDir(), 
+                                  [STATE_APK_DECOMPILED], STATE_INSTRUMENTED_APK_ALIGNED)
+        
+        if instrCache:
+            try:
+                instrCache.store(cacheKey, alignedApkFilePath, self.androidManifestFile, 
+                                 self.coverageMetadataFile, apkFileName)
+            except (OSError, IOError) as e:
+                logger.warning("Cannot put instrumented apk into the cache! %s" % str(e))
+        
+        return self._finishInstrumentation(alignedApkFilePath, removeApkTmpDirAfterInstr)
+    
+    
+    def _instrumentDexFiles(self, journal, decompileDir, dexFilesRelativePaths, rawJarFilesRootDir, 
+                            emmaInstrJarFilesRootDir, instrDexFilesRootDir, emmaFilters, mainDexRules, 
+                            dexPool):
+        '''
+        Task of the scheduler: converts the dex files into jar files,
+        instruments them with Emma and converts them back. If dexPool is not
+        None, the dex files are processed in its worker processes. 
+        mainDexRules are returned by _getMainDexRules.
+        
+        Returns:
+            :ret list of relative paths of the instrumented dex files or False
+                if the main dex file has not been instrumented
+        '''
+        if journal.isCompleted(STATE_JAR_CONVERTED_TO_DEX):
+            jarFilesRelativePaths = journal.getData(STATE_DEX_CONVERTED_TO_JAR)["jarFilesRelativePaths"]
+            emmaInstrJarFileRelativePaths = journal.getData(STATE_JARS_INSTRUMENTED)["instrJarFilesRelativePaths"]
+            instrDexFilesRelativePaths = journal.getData(STATE_JAR_CONVERTED_TO_DEX)["instrDexFilesRelativePaths"]
+            self._bboxStateMachine.transitToState(STATE_DEX_CONVERTED_TO_JAR)
+            self._bboxStateMachine.transitToState(STATE_JARS_INSTRUMENTED)
+            self._bboxStateMachine.transitToState(STATE_JAR_CONVERTED_TO_DEX)
+            self._releaseStageDir(journal, self.config.getTmpJarRelativeDir(), 
+                                  [STATE_DEX_CONVERTED_TO_JAR], STATE_JAR_CONVERTED_TO_DEX)
+            self._releaseStageDir(journal, self.config.getInstrumentedFilesRelativeDir(), 
+                                  [STATE_JARS_INSTRUMENTED], STATE_JAR_CONVERTED_TO_DEX)
+        elif dexPool is not None:
+            #each dex file goes through dex2jar, emma and dx in a separate process
+            metadataFilesRootDir = os.path.join(self.apkTmpDir, self.config.getTmpMetadataRelativeDir())
+            #metadata of an interrupted run must not be merged with the new one
+            self._removeIfExists(metadataFilesRootDir)
+            self._removeIfExists(self.coverageMetadataFile)
+            try:
+                (jarFilesRelativePaths, emmaInstrJarFileRelativePaths, instrDexFilesRelativePaths, steps) = \
+                    self._processDexFilesInParallel(
+                        dexFilesRootDir=decompileDir,
+                        dexFilesRelativePaths=dexFilesRelativePaths,
+                        jarFilesRootDir=rawJarFilesRootDir,
+                        instrJarsRootDir=emmaInstrJarFilesRootDir,
+                        instrDexFilesRootDir=instrDexFilesRootDir,
+                        metadataFilesRootDir=metadataFilesRootDir,
+                        coverageMetadataFile=self.coverageMetadataFile,
+                        emmaFilters=emmaFilters,
+                        mainDexRules=mainDexRules,
+                        pool=dexPool)
+            except EmmaCannotMergeException as e:
+                logger.error("Cannot merge coverage metadata files! %s" % e.msg)
+                return False
+            journal.complete(STATE_DEX_CONVERTED_TO_JAR, 
+                             [os.path.join(rawJarFilesRootDir, pth) for pth in jarFilesRelativePaths], 
+                             {"jarFilesRelativePaths" : jarFilesRelativePaths})
+            self._addStepTimings(steps, STEP_DEX2JAR)
+            self._bboxStateMachine.transitToState(STATE_DEX_CONVERTED_TO_JAR)
+            journal.complete(STATE_JARS_INSTRUMENTED, 
+                             [os.path.join(emmaInstrJarFilesRootDir, pth) for pth in emmaInstrJarFileRelativePaths] + [self.coverageMetadataFile], 
+                             {"instrJarFilesRelativePaths" : emmaInstrJarFileRelativePaths})
+            self._addStepTimings(steps, STEP_EMMA)
+            self._bboxStateMachine.transitToState(STATE_JARS_INSTRUMENTED)
+            journal.complete(STATE_JAR_CONVERTED_TO_DEX, 
+                             [os.path.join(instrDexFilesRootDir, pth) for pth in instrDexFilesRelativePaths], 
+                             {"instrDexFilesRelativePaths" : instrDexFilesRelativePaths})
+            self._addStepTimings(steps, STEP_DX)
+            self._bboxStateMachine.transitToState(STATE_JAR_CONVERTED_TO_DEX)
+            self._removeIfExists(metadataFilesRootDir)
+            self._releaseStageDir(journal, self.config.getTmpJarRelativeDir(), 
+                                  [STATE_DEX_CONVERTED_TO_JAR], STATE_JAR_CONVERTED_TO_DEX)
+            self._releaseStageDir(journal, self.config.getInstrumentedFilesRelativeDir(), 
+                                  [STATE_JARS_INSTRUMENTED], STATE_JAR_CONVERTED_TO_DEX)
+        else:
+            #converting dex to jar files
+            if not journal.isCompleted(STATE_DEX_CONVERTED_TO_JAR):
+                jarFilesRelativePaths = self._convertDex2JarFiles(
+                                            converter=self.bboxInstrumenter, 
+                                            dexFilesRootDir=decompileDir, 
+                                            dexFilesRelativePaths=dexFilesRelativePaths,
+                                            jarFilesRootDir=rawJarFilesRootDir,
+                                            proceedOnError=True)
+                journal.complete(STATE_DEX_CONVERTED_TO_JAR, 
+                                 [os.path.join(rawJarFilesRootDir, pth) for pth in jarFilesRelativePaths], 
+                                 {"jarFilesRelativePaths" : jarFilesRelativePaths})
+            else:
+                jarFilesRelativePaths = journal.getData(STATE_DEX_CONVERTED_TO_JAR)["jarFilesRelativePaths"]
+            self._bboxStateMachine.transitToState(STATE_DEX_CONVERTED_TO_JAR)
+        
+            if "classes.jar" not in jarFilesRelativePaths:
+                #main file is not converted
+                logger.error("Conversion from classes.dex to classes.jar was not successful!")
+                return False
+        
+            #instrumenting available jar files
+            if not journal.isCompleted(STATE_JARS_INSTRUMENTED):
+                #emma merges metadata into the existing file
+                self._removeIfExists(self.coverageMetadataFile)
+                emmaInstrJarFileRelativePaths = self._instrFilesWithEmma(
+                                    instrumenter=self.bboxInstrumenter, 
+                                    jarFilesRootDir=rawJarFilesRootDir, 
+                                    jarFilesRelativePaths=jarFilesRelativePaths, 
+                                    instrJarsRootDir=emmaInstrJarFilesRootDir,
+                                    coverageMetadataFile=self.coverageMetadataFile,
+                                    filters=emmaFilters,
+                                    classCache=_getEmmaClassCache(self.config),
+                                    proceedOnError=True)
+                journal.complete(STATE_JARS_INSTRUMENTED, 
+                                 [os.path.join(emmaInstrJarFilesRootDir, pth) for pth in emmaInstrJarFileRelativePaths] + [self.coverageMetadataFile], 
+                                 {"instrJarFilesRelativePaths" : emmaInstrJarFileRelativePaths})
+            else:
+                emmaInstrJarFileRelativePaths = journal.getData(STATE_JARS_INSTRUMENTED)["instrJarFilesRelativePaths"]
+            self._bboxStateMachine.transitToState(STATE_JARS_INSTRUMENTED)
+            self._releaseStageDir(journal, self.config.getTmpJarRelativeDir(), 
+                                  [STATE_DEX_CONVERTED_TO_JAR], STATE_JARS_INSTRUMENTED)
+        
+            if "classes.jar" not in emmaInstrJarFileRelativePaths:
+                #main file is not instrumented
+                logger.error("Instrumentation of classes.jar was not successful!")
+                return False
         
-        #converting jar files back to dex files
-        instrDexFilesRelativePaths = self._convertJar2DexWithInstr(
-                    converter=self.bboxInstrumenter,
-                    instrJarsRootDir=emmaInstrJarFilesRootDir, 
-                    instrJarFilesRelativePaths=emmaInstrJarFileRelativePaths,
-                    finalDexFilesRootDir=decompileDir,
-                    proceedOnError=True)
-        self._bboxStateMachine.transitToState(STATE_JAR_CONVERTED_TO_DEX)
+            #converting jar files back to dex files
+            instrDexFilesRelativePaths = self._convertJar2DexWithInstr(
+                        converter=self.bboxInstrumenter,
+                        instrJarsRootDir=emmaInstrJarFilesRootDir, 
+                        instrJarFilesRelativePaths=emmaInstrJarFileRelativePaths,
+                        finalDexFilesRootDir=instrDexFilesRootDir,
+                        dexFilesRelativePaths=dexFilesRelativePaths,
+                        mainDexRules=mainDexRules,
+                        proceedOnError=True)
+            journal.complete(STATE_JAR_CONVERTED_TO_DEX, 
+                             [os.path.join(instrDexFilesRootDir, pth) for pth in instrDexFilesRelativePaths], 
+                             {"instrDexFilesRelativePaths" : instrDexFilesRelativePaths})
+            self._bboxStateMachine.transitToState(STATE_JAR_CONVERTED_TO_DEX)
+            self._releaseStageDir(journal, self.config.getInstrumentedFilesRelativeDir(), 
+                                  [STATE_JARS_INSTRUMENTED], STATE_JAR_CONVERTED_TO_DEX)
         
         if "classes.dex" not in instrDexFilesRelativePaths:
             logger.error("There is no classes.dex file found in the list of dex files")
@@ -227,51 +643,111 @@ class BBoxCoverage:
         #checking what files have not been converted
         uninstrumentedFiles = self._getUnInstrFilesRelativePaths(dexFilesRelativePaths, instrDexFilesRelativePaths)
         if uninstrumentedFiles:
-            logger.debug("The following files were not instrumented: %s" + str(uninstrumentedFiles))
+            logger.debug("The following files were not instrumented: %s" % str(uninstrumentedFiles))
         
-        #instrument AndroidManifest.xml
-        decompiledAndroidManifestPath = os.path.join(decompileDir, "AndroidManifest.xml")
-        success = self._instrAndroidManifest(self.bboxInstrumenter, decompiledAndroidManifestPath)
+        return instrDexFilesRelativePaths
+    
+    
+    def _instrumentManifest(self, journal, pipelineMode, decompiledAndroidManifestPath, instrAndroidManifestPath):
+        '''
+        Task of the scheduler: instruments AndroidManifest.xml. The decoded
+        manifest is not changed, so the decoded apk can be reused when the
+        later stages are repeated.
+        '''
+        if journal.isCompleted(STATE_MANIFEST_INSTRUMENTED):
+            return True
+        with UsageMeter() as meter:
+            if pipelineMode == PIPELINE_MODE_ZIP_PATCH:
+                #binary manifest is instrumented, its text version goes to result folder
+                success = self._instrAndroidManifest(self.bboxInstrumenter, decompiledAndroidManifestPath, 
+                                                     instrAndroidManifestPath, pathToXmlFile=self.androidManifestFile)
+                artifacts = [instrAndroidManifestPath, self.androidManifestFile]
+            else:
+                success = self._instrAndroidManifest(self.bboxInstrumenter, decompiledAndroidManifestPath, 
+                                                     self.androidManifestFile)
+                artifacts = [self.androidManifestFile]
+        self._taskTimings[STATE_MANIFEST_INSTRUMENTED] = (STEP_MANIFEST, "AndroidManifest.xml", meter.record)
         if not success:
             logger.error("Cannot instrument AndroidManifest.xml file!")
             return False
-        #coping instrumented AndroidManifest.xml to result folder
-        shutil.copy2(decompiledAndroidManifestPath, self.apkResultsDir)
-        self.androidManifestFile = os.path.join(self.apkResultsDir, "AndroidManifest.xml")
-        self._bboxStateMachine.transitToState(STATE_MANIFEST_INSTRUMENTED)
-        
-        compiledApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getInstrFileSuffix()))
-        success = self._compileApk(self.bboxInstrumenter, decompileDir, compiledApkFilePath)
+        journal.complete(STATE_MANIFEST_INSTRUMENTED, artifacts)
+        return True
+    
+    
+    def _buildApk(self, journal, decompileDir, compiledApkFilePath):
+        '''
+        Task of the scheduler: builds the apk with the instrumented manifest
+        with apktool. The instrumented dex files are put into the apk later,
+        so the build does not wait for them.
+        '''
+        if journal.isCompleted(STATE_INSTRUMENTED_APK_BUILD):
+            return True
+        with UsageMeter() as meter:
+            success = self._compileApkWithManifest(self.bboxInstrumenter, decompileDir, 
+                                                   self.androidManifestFile, compiledApkFilePath)
+        self._taskTimings[STATE_INSTRUMENTED_APK_BUILD] = (STEP_APKTOOL, os.path.basename(compiledApkFilePath), meter.record)
         if not success:
             logger.error("Cannot build apk!")
             return False
-        self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_BUILD)
-        
-        #need to copy resources into file
-        compiledApkFilePathWithEmmaRes = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getFinalInstrFileSuffix()))
-        shutil.copy2(compiledApkFilePath, compiledApkFilePathWithEmmaRes)
-        self._putAdditionalResources(apk=compiledApkFilePathWithEmmaRes, resources=self.config.getEmmaResourcesDir())
-        self._bboxStateMachine.transitToState(STATE_FINAL_INSTRUMENTED_APK_BUILD)
-        
-        signedApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getSignedFileSuffix()))
-        success = self._signApk(self.bboxInstrumenter, compiledApkFilePathWithEmmaRes, signedApkFilePath)
-        if not success:
-            logger.error("Cannot sign apk!")
-            return False
-        self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_SIGNED)
-        
-        alignedApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getAlignedFileSuffix()))
-        success = self._alignApk(self.bboxInstrumenter, signedApkFilePath, alignedApkFilePath)
-        if not success:
-            logger.error("Cannot align apk!")
-            return False
-        self._bboxStateMachine.transitToState(STATE_INSTRUMENTED_APK_ALIGNED)
-        
+        journal.complete(STATE_INSTRUMENTED_APK_BUILD, [compiledApkFilePath])
+        return True
+    
+    
+    def _addTaskTimings(self, state):
+        '''
+        Adds the usage of the task run by the scheduler to the timings of
+        its stage.
+        '''
+        if state in self._taskTimings:
+            (step, fileName, usage) = self._taskTimings.pop(state)
+            self.stageTimings.addStep(step, fileName, usage)
+    
+    
+    def _removeIfExists(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    
+    
+    def _releaseStageDir(self, journal, stageDirName, producerStates, consumerState):
+        '''
+        Removes the stage dir after the consumer stage has used it (if
+        configured) and records it in the journal.
+        '''
+        if not self.workspace.releaseConsumed:
+            return
+        stageDir = self.workspace.release(stageDirName)
+        if stageDir:
+            for state in producerStates:
+                journal.discardArtifacts(state, [stageDir], consumerState)
+    
+    
+    def _estimateDecodedSize(self, pathToApk, pipelineMode):
+        '''
+        Estimates the size of the decoded apk from the uncompressed size of
+        its entries. In the zip patch mode only dex files and the manifest are
+        extracted.
+        '''
+        try:
+            with zipfile.ZipFile(pathToApk, "r") as apkZip:
+                zinfos = apkZip.infolist()
+        except (zipfile.BadZipfile, IOError):
+            return 0
+        if pipelineMode == PIPELINE_MODE_ZIP_PATCH:
+            zinfos = [zinfo for zinfo in zinfos 
+                      if zinfo.filename.endswith(".dex") or zinfo.filename == "AndroidManifest.xml"]
+        return WORKSPACE_SIZE_FACTOR * sum([zinfo.file_size for zinfo in zinfos])
+    
+    
+    def _finishInstrumentation(self, instrumentedApk, removeApkTmpDirAfterInstr):
         #cleaning: if tmp dir needs to be removed after instrumentation
         if removeApkTmpDirAfterInstr:
+            if self.workspace:
+                self.workspace.cleanup()
             shutil.rmtree(self.apkTmpDir)
         
-        self.instrumentedApk = alignedApkFilePath
+        self.instrumentedApk = instrumentedApk
         self.androidManifest = AndroidManifest(self.androidManifestFile)
         self.packageName = self.androidManifest.getInstrumentationTargetPackage()
         self.runnerName = self.androidManifest.getInstrumentationRunnerName()
@@ -279,6 +755,28 @@ class BBoxCoverage:
         #Final node transition
         self._bboxStateMachine.transitToState(STATE_APK_INSTRUMENTED)
         return True
+    
+    
+    def _restoreFromInstrCache(self, instrCache, cacheKey, apkFileName):
+        '''
+        Populates the results dir with the files from the instrumentation cache.
+        
+        Returns:
+            :ret path to the instrumented apk or None if there is no cache entry
+        '''
+        entryDir = instrCache.lookup(cacheKey)
+        if not entryDir:
+            return None
+        
+        logger.info("Taking instrumented apk from the cache entry [%s]" % entryDir)
+        alignedApkFilePath = os.path.join(self.apkResultsDir, "%s%s.apk" % (apkFileName, self.config.getAlignedFileSuffix()))
+        self.androidManifestFile = os.path.join(self.apkResultsDir, "AndroidManifest.xml")
+        self.coverageMetadataFile = os.path.join(self.coverageMetadataFolder, self.config.getCoverageMetadataFilename())
+        instrCache.restore(entryDir, alignedApkFilePath, self.androidManifestFile, self.coverageMetadataFile)
+        
+        for state in INSTRUMENTATION_STAGE_STATES:
+            self._bboxStateMachine.transitToState(state)
+        return alignedApkFilePath
         
     
     def _createDir(self, root, directory, createNew=True, overwrite=False):
@@ -306,6 +804,29 @@ class BBoxCoverage:
         return resultDir
     
     
+    def _prescanApk(self, pathToApk, apkHash):
+        '''
+        Checks the zip structure and the dex headers of the apk file before
+        the tools are run. The scan is stored in self.apkScan.
+        '''
+        self.apkScan = None
+        try:
+            scan = ApkScanCache(self.config.getPrescanCacheDir()).getScan(pathToApk, apkHash)
+        except ApkScanException as e:
+            logger.error("Apk file [%s] is broken! %s" % (pathToApk, e.msg))
+            return False
+        #dex files over the limit are split by dx in multidex mode
+        methodLimit = 0 if self.config.useDxMultiDex() else self.config.getPrescanMethodLimit()
+        problems = apk_scan.checkScan(scan, methodLimit, self.config.getPrescanMethodsPerClass())
+        if problems:
+            logger.error("Apk file [%s] cannot be instrumented: %s" % (pathToApk, "; ".join(problems)))
+            return False
+        self.apkScan = scan
+        return True
+    
+    def getApkScan(self):
+        return self.apkScan
+    
     def _checkProvidedApk(self, pathToApk):
         '''
         This methods validates the provided apk file.
@@ -334,6 +855,16 @@ class BBoxCoverage:
         return True
     
     
+    def _extractApkCode(self, extractor, apk, outputDir):
+        try:
+            extractor.extractApkCode(apk, outputDir)
+        except ApkCannotBeDecompiledException as e:
+            logger.error(e.msg)
+            return False
+        
+        return True
+    
+    
     def _convertDex2JarFiles(self, converter, dexFilesRootDir, dexFilesRelativePaths, jarFilesRootDir, proceedOnError=True):
         jarFilesRelativePaths = []
         for dexFileRelativePath in dexFilesRelativePaths:
@@ -341,10 +872,11 @@ class BBoxCoverage:
             jarFileRelativePath = os.path.splitext(dexFileRelativePath)[0] + ".jar"
             jarFilePath = os.path.join(jarFilesRootDir, jarFileRelativePath)
             try:
-                converter.convertDex2Jar(dexFilePath, jarFilePath, overwrite=True)
+                with self.stageTimings.measureStep(STEP_DEX2JAR, dexFileRelativePath):
+                    converter.convertDex2Jar(dexFilePath, jarFilePath, overwrite=True)
             except Dex2JarConvertionError as e:
                 if proceedOnError:
-                    logger.warning("Cannot convert [%s] to [%s]. %s" (dexFilePath, jarFilePath, e.msg))
+                    logger.warning("Cannot convert [%s] to [%s]. %s" % (dexFilePath, jarFilePath, e.msg))
                     continue
                 else:
                     raise
@@ -353,20 +885,81 @@ class BBoxCoverage:
         return jarFilesRelativePaths
         
     
+    def _getStageInputs(self):
+        '''
+        Returns the fingerprints of the inputs of the stages: the config
+        options they depend on and the contents of the Emma jars, our
+        instrumentation classes, the Emma resources and the signing key.
+        '''
+        contentInputs = {
+            STATE_JARS_INSTRUMENTED : [os.path.join(self.config.getEmmaDir(), self.config.getEmmaJar())],
+            STATE_JAR_CONVERTED_TO_DEX : [os.path.join(self.config.getEmmaDir(), self.config.getEmmaDeviceJar()),
+                                          self.config.getAndroidSpecificInstrumentationClassesPath()],
+            STATE_FINAL_INSTRUMENTED_APK_BUILD : [self.config.getEmmaResourcesDir()],
+            STATE_INSTRUMENTED_APK_SIGNED : [path for path in [self.config.getSigningKeyFile(), 
+                                                               self.config.getSigningCertFile()] if path],
+        }
+        stageInputs = {}
+        for (state, options) in iteritems(STAGE_INPUT_OPTIONS):
+            h = hashlib.sha256()
+            for (section, option) in options:
+                h.update("%s.%s=%s\n" % (section, option, self.config.getOptionValue(section, option)))
+            for path in contentInputs.get(state, []):
+                if os.path.exists(path):
+                    h.update("%s:%s\n" % (path, auxiliary_utils.getDirHash(path)))
+            stageInputs[state] = h.hexdigest()
+        return stageInputs
+    
+    
+    def _getEmmaFilters(self, pathToAndroidManifest):
+        '''
+        Returns the Emma class filters: the configured ones and, in the
+        automatic mode, the ones derived from the manifest of the app.
+        '''
+        includes = emma_filters.parseFilterList(self.config.getEmmaIncludeFilters())
+        excludes = emma_filters.parseFilterList(self.config.getEmmaExcludeFilters())
+        if self.config.useEmmaAutoFilters():
+            try:
+                (autoIncludes, autoExcludes) = emma_filters.getAutoFilterPackages(AndroidManifest(pathToAndroidManifest))
+                includes.extend(autoIncludes)
+                excludes.extend(autoExcludes)
+            except (IOError, AxmlException, ExpatError) as e:
+                logger.warning("Cannot derive Emma filters from the manifest! %s" % str(e))
+        filters = emma_filters.buildEmmaFilters(includes, excludes)
+        if filters:
+            logger.info("Emma filters: %s" % ",".join(filters))
+        return filters
+    
+    
     def _instrFilesWithEmma(self, instrumenter, jarFilesRootDir, jarFilesRelativePaths, 
-            instrJarsRootDir, coverageMetadataFile, proceedOnError=True):
+            instrJarsRootDir, coverageMetadataFile, filters=[], classCache=None, proceedOnError=True):
         
         instrJarFilesRelativePaths = []
-        for jarFileRelativePath in jarFilesRelativePaths:
+        remainingJarFilesRelativePaths = jarFilesRelativePaths
+        #the class cache instruments jar files one by one
+        if not classCache and self.config.instrumentJarsInOneEmmaRun() and len(jarFilesRelativePaths) > 1:
+            batch = _getPathsWithUniqueNames(jarFilesRelativePaths)
+            if self._instrFilesWithEmmaInOneRun(instrumenter, jarFilesRootDir, batch, 
+                                                instrJarsRootDir, coverageMetadataFile, filters):
+                instrJarFilesRelativePaths.extend(batch)
+                remainingJarFilesRelativePaths = [pth for pth in jarFilesRelativePaths if pth not in batch]
+        
+        for jarFileRelativePath in remainingJarFilesRelativePaths:
             jarFileAbsPath = os.path.join(jarFilesRootDir, jarFileRelativePath)
             instrJarRelativeDir = jarFileRelativePath[:jarFileRelativePath.rfind("/")+1]
             instrJarFullDir = os.path.join(instrJarsRootDir, instrJarRelativeDir)
             
             try:
-                instrumenter.instrumentJarWithEmma(jarFile=jarFileAbsPath, outputFolder=instrJarFullDir, emmaMetadataFile=coverageMetadataFile)
+                with self.stageTimings.measureStep(STEP_EMMA, jarFileRelativePath):
+                    if classCache:
+                        classCache.instrumentJar(instrumenter, jarFile=jarFileAbsPath, outputFolder=instrJarFullDir, 
+                                                 emmaMetadataFile=coverageMetadataFile, filters=filters)
+                    else:
+                        instrumenter.instrumentJarWithEmma(jarFile=jarFileAbsPath, outputFolder=instrJarFullDir, 
+                                                           emmaMetadataFile=coverageMetadataFile, filters=filters)
             except EmmaCannotInstrumentException as e:
                 if proceedOnError:
-                    logger.warning("Cannot instrument [%s]. %s" (jarFileAbsPath, e.msg))
+                    logger.warning("Cannot instrument [%s]. %s" % (jarFileAbsPath, e.msg))
                     continue
                 else:
                     raise
@@ -375,10 +968,37 @@ class BBoxCoverage:
         return instrJarFilesRelativePaths
     
     
+    def _instrFilesWithEmmaInOneRun(self, instrumenter, jarFilesRootDir, jarFilesRelativePaths, 
+                                    instrJarsRootDir, coverageMetadataFile, filters):
+        '''
+        Instruments the jar files in one Emma run. 
+        
+        Returns:
+            :ret True if all files have been instrumented, False if they have 
+                to be instrumented one by one
+        '''
+        metadataExisted = os.path.exists(coverageMetadataFile)
+        try:
+            with self.stageTimings.measureStep(STEP_EMMA, ",".join(jarFilesRelativePaths)):
+                instrumenter.instrumentJarsWithEmma(
+                    jarFiles=[os.path.join(jarFilesRootDir, pth) for pth in jarFilesRelativePaths], 
+                    instrJarFiles=[os.path.join(instrJarsRootDir, pth) for pth in jarFilesRelativePaths], 
+                    emmaMetadataFile=coverageMetadataFile, 
+                    filters=filters)
+        except EmmaCannotInstrumentException as e:
+            logger.warning("Cannot instrument jar files in one run, instrumenting them one by one. %s" % e.msg)
+            if not metadataExisted:
+                self._removeIfExists(coverageMetadataFile)
+            return False
+        return True
+    
+    
     def _convertJar2DexWithInstr(self, converter, instrJarsRootDir, 
                                  instrJarFilesRelativePaths, 
-                                 finalDexFilesRootDir, proceedOnError):
+                                 finalDexFilesRootDir, dexFilesRelativePaths, 
+                                 mainDexRules, proceedOnError):
         instrDexFilesRelativePaths = []
+        overflowDexFiles = []
         for jarFileRelativePath in instrJarFilesRelativePaths:
             jarFileAbsPath = os.path.join(instrJarsRootDir, jarFileRelativePath)
             dexFileRelativePath = os.path.splitext(jarFileRelativePath)[0] + ".dex"
@@ -388,18 +1008,12 @@ class BBoxCoverage:
             print "jarFileRelativePath: " + jarFileRelativePath
             
             try:
-                withFiles = []
-                #we compile main file with additional instrumentation files
-                #hack: emma copies instrumented jar files into lib folder
-                if jarFileRelativePath == "classes.jar":
-                    emmaDevicePath = os.path.join(self.config.getEmmaDir(), self.config.getEmmaDeviceJar())
-                    withFiles.append(self.config.getAndroidSpecificInstrumentationClassesPath())
-                    withFiles.append(emmaDevicePath)
-                
-                converter.convertJar2Dex(jarFile=jarFileAbsPath, 
-                                         dexFile=dexFileAbsPath, 
-                                         withFiles=withFiles, 
-                                         overwrite=True)
+                with self.stageTimings.measureStep(STEP_DX, jarFileRelativePath):
+                    overflowDexFiles.extend(_convertJar2DexWithSplitting(self.config, converter, 
+                                                                         instrJarsRootDir, 
+                                                                         jarFileRelativePath, 
+                                                                         dexFileAbsPath, 
+                                                                         mainDexRules))
             except Jar2DexConvertionError as e:
                 if proceedOnError:
                     logger.warning("Cannot instrument [%s]. %s" % (jarFileAbsPath, e.msg))
@@ -408,9 +1022,96 @@ class BBoxCoverage:
                     raise
             instrDexFilesRelativePaths.append(dexFileRelativePath)
         
+        instrDexFilesRelativePaths.extend(_placeOverflowDexFiles(finalDexFilesRootDir, 
+                                                                 dexFilesRelativePaths, 
+                                                                 overflowDexFiles))
         return instrDexFilesRelativePaths
     
     
+    def _createDexProcessingPool(self, journal, dexFilesRootDir, dexFilesRelativePaths):
+        '''
+        Returns the pool of the worker processes of the dex files or None if
+        the dex files are not processed in parallel.
+        '''
+        workers = self.config.getDexProcessingWorkers()
+        if journal.isCompleted(STATE_JAR_CONVERTED_TO_DEX) or workers <= 1 or len(dexFilesRelativePaths) <= 1:
+            return None
+        #the workers run the tools in their own processes, so their number is
+        #limited by the heap the tools need for the largest dex file
+        workers = min(workers, len(dexFilesRelativePaths))
+        largestDexFileSize = max([os.path.getsize(os.path.join(dexFilesRootDir, pth)) 
+                                  for pth in dexFilesRelativePaths])
+        maxConcurrency = self.bboxInstrumenter.heapManager.getMaxConcurrency(
+                                [TOOL_DEX2JAR, TOOL_EMMA, TOOL_DX], largestDexFileSize)
+        if maxConcurrency and maxConcurrency < workers:
+            logger.info("Processing dex files in %d workers instead of %d to fit into the memory limit" % (maxConcurrency, workers))
+            workers = maxConcurrency
+        return multiprocessing.Pool(processes=workers)
+    
+    def _processDexFilesInParallel(self, dexFilesRootDir, dexFilesRelativePaths, 
+                                   jarFilesRootDir, instrJarsRootDir, 
+                                   instrDexFilesRootDir, metadataFilesRootDir, 
+                                   coverageMetadataFile, emmaFilters, mainDexRules, pool):
+        '''
+        Runs the dex2jar -> Emma -> dx chain for each dex file in a worker
+        process of the pool (see _createDexProcessingPool). Each dex file is
+        instrumented into its own Emma metadata file; the metadata files of
+        successfully processed dex files are merged into coverageMetadataFile
+        at the end.
+        
+        Returns:
+            :ret tuple of lists with relative paths of converted jar files, 
+                instrumented jar files and instrumented dex files (including
+                the dex files split off by dx), and the list of the timings of
+                the steps (step, file, usage)
+        
+        Raises:
+            EmmaCannotMergeException: if the metadata files cannot be merged
+        '''
+        tasks = []
+        for dexFileRelativePath in dexFilesRelativePaths:
+            tasks.append((self.config.getPathToConfigFile(), dexFilesRootDir, 
+                          dexFileRelativePath, jarFilesRootDir, instrJarsRootDir, 
+                          instrDexFilesRootDir, metadataFilesRootDir, emmaFilters, mainDexRules))
+        results = pool.map(_processDexFileChain, tasks)
+        
+        jarFilesRelativePaths = []
+        instrJarFilesRelativePaths = []
+        instrDexFilesRelativePaths = []
+        metadataFiles = []
+        overflowDexFiles = []
+        steps = []
+        for (result, metricsState) in results:
+            (dexFileRelativePath, jarFileRelativePath, instrJarFileRelativePath, 
+                instrDexFileRelativePath, metadataFile, fileOverflowDexFiles, error, fileSteps) = result
+            commander.getCommandMetrics().merge(metricsState)
+            steps.extend(fileSteps)
+            overflowDexFiles.extend(fileOverflowDexFiles)
+            if error:
+                logger.warning("Cannot process [%s]. %s" % (dexFileRelativePath, error))
+            if jarFileRelativePath:
+                jarFilesRelativePaths.append(jarFileRelativePath)
+            if instrJarFileRelativePath:
+                instrJarFilesRelativePaths.append(instrJarFileRelativePath)
+            if instrDexFileRelativePath:
+                instrDexFilesRelativePaths.append(instrDexFileRelativePath)
+                metadataFiles.append(metadataFile)
+        
+        instrDexFilesRelativePaths.extend(_placeOverflowDexFiles(instrDexFilesRootDir, 
+                                                                 dexFilesRelativePaths, 
+                                                                 overflowDexFiles))
+        if metadataFiles:
+            self.bboxInstrumenter.mergeEmmaMetadataFiles(metadataFiles, coverageMetadataFile)
+        
+        return (jarFilesRelativePaths, instrJarFilesRelativePaths, instrDexFilesRelativePaths, steps)
+    
+    
+    def _addStepTimings(self, steps, step):
+        for (stepName, fileName, usage) in steps:
+            if stepName == step:
+                self.stageTimings.addStep(stepName, fileName, usage)
+    
+    
     def _getUnInstrFilesRelativePaths(self, dexFilesRelativePaths, instrDexFilesRelativePaths):
         uninstrumentedFiles = []
         for dexFileRelativePath in dexFilesRelativePaths:
@@ -419,10 +1120,10 @@ class BBoxCoverage:
         return uninstrumentedFiles
     
     
-    def _instrAndroidManifest(self, instrumenter, initAndroidManifest, instrAndroidManifest=None, addSdCardPermission=True):
+    def _instrAndroidManifest(self, instrumenter, initAndroidManifest, instrAndroidManifest=None, addSdCardPermission=True, pathToXmlFile=None):
         success = True
         try:
-            instrumenter.instrumentAndroidManifestFile(initAndroidManifest, instrAndroidManifest, addSdCardPermission)
+            instrumenter.instrumentAndroidManifestFile(initAndroidManifest, instrAndroidManifest, addSdCardPermission, pathToXmlFile)
         except IllegalArgumentException as e:
             logger.error("Cannot instrument AndroidManifest file. %s" % e.msg)
             success = False
@@ -432,6 +1133,35 @@ class BBoxCoverage:
         return success
     
     
+    def _patchApk(self, patcher, origApk, apkPath, replacedFiles, resources):
+        success = True
+        try:
+            patcher.patchApk(origApk, apkPath, replacedFiles, resources)
+        except ApkPatchException as e:
+            logger.error("Cannot patch apk! %s" % e.msg)
+            success = False
+        except:
+            logger.error("Cannot patch apk!")
+            success = False
+        return success
+    
+    
+    def _finaliseApk(self, finaliser, sourceApk, apkPath, replacedFiles, resources):
+        success = True
+        try:
+            finaliser.finaliseApk(sourceApk, apkPath, replacedFiles, resources)
+        except ApkPatchException as e:
+            logger.error("Cannot write apk! %s" % e.msg)
+            success = False
+        except SignApkException as e:
+            logger.error("Cannot sign apk! %s" % e.msg)
+            success = False
+        except:
+            logger.error("Cannot finalise apk!")
+            success = False
+        return success
+    
+    
     def _compileApk(self, compiler, fromDir, apkPath):
         success = True
         try:
@@ -444,6 +1174,24 @@ class BBoxCoverage:
             success = False
         return success
     
+    def _compileApkWithManifest(self, compiler, fromDir, androidManifest, apkPath):
+        '''
+        Builds the apk with the provided manifest instead of the decoded one.
+        The decoded apk is restored after the build.
+        '''
+        decodedAndroidManifest = os.path.join(fromDir, "AndroidManifest.xml")
+        decodedAndroidManifestBackup = os.path.join(self.apkTmpDir, DECODED_MANIFEST_BACKUP_FILENAME)
+        apktoolBuildDir = os.path.join(fromDir, APKTOOL_BUILD_DIR)
+        apktoolBuildDirExisted = os.path.exists(apktoolBuildDir)
+        shutil.copy2(decodedAndroidManifest, decodedAndroidManifestBackup)
+        try:
+            shutil.copy2(androidManifest, decodedAndroidManifest)
+            return self._compileApk(compiler, fromDir, apkPath)
+        finally:
+            shutil.move(decodedAndroidManifestBackup, decodedAndroidManifest)
+            if not apktoolBuildDirExisted:
+                shutil.rmtree(apktoolBuildDir, ignore_errors=True)
+    
     def _putAdditionalResources(self, apk, resources):
         zip_utils.zipdir(resources, apk)
     
@@ -494,7 +1242,14 @@ class BBoxCoverage:
 ################################################################################
     
     def initAlreadyInstrApkEnv(self, pathToInstrApk, resultsDir, pathToInstrManifestFile=None):
-        if not apk_utils.checkInputApkFile(pathToInstrApk):
+        '''
+        Initializes the environment for testing of an already instrumented apk
+        file. If the decoded instrumented AndroidManifest.xml file is not 
+        found, the manifest is read directly from the apk file and its text
+        version is stored in the results dir.
+        '''
+        (valid, _) = apk_utils.checkInputApkFile(pathToInstrApk)
+        if not valid:
             logger.error("Provided file [%s] is not a valid apk file!" % pathToInstrApk)
             return
         
@@ -520,16 +1275,27 @@ class BBoxCoverage:
         else:
             androidManifestPath = os.path.join(resultsDir, "AndroidManifest.xml")
         
-        if not os.path.isfile(androidManifestPath):
-            logger.warning("Path [%s] is not pointing to a real file! Leaving pointer to AndroidManifest.xml empty!" % androidManifestPath)
-            return
+        if os.path.isfile(androidManifestPath):
+            androidManifest = AndroidManifest(androidManifestPath)
+        else:
+            logger.info("Path [%s] is not pointing to a real file! Reading AndroidManifest.xml from the apk file..." % androidManifestPath)
+            try:
+                androidManifest = AndroidManifest.fromApk(pathToInstrApk)
+            except NoManifestFoundException as e:
+                logger.warning("%s Leaving pointer to AndroidManifest.xml empty!" % e.msg)
+                return
+            except AxmlException as e:
+                logger.warning("Cannot parse AndroidManifest.xml of the apk file! %s" % e.msg)
+                return
+            androidManifestPath = os.path.join(resultsDir, "AndroidManifest.xml")
+            androidManifest.exportXml(androidManifestPath)
         
         self.instrumentedApk = pathToInstrApk
         self.apkResultsDir = resultsDir
         self.runtimeReportsRootDir = self._createDir(resultsDir, self.config.getRuntimeReportsRelativeDir(), False, False)
         self.androidManifestFile = androidManifestPath
         
-        self.androidManifest = AndroidManifest(self.androidManifestFile)
+        self.androidManifest = androidManifest
         self.packageName = self.androidManifest.getInstrumentationTargetPackage()
         self.runnerName = self.androidManifest.getInstrumentationRunnerName()
         
@@ -651,6 +1417,271 @@ class BBoxCoverage:
         
         return  reports
         
+def _getJar2DexWithFiles(config, jarFileRelativePath):
+    '''
+    Returns the list of additional files that need to be compiled together with
+    the provided jar file. The main file is compiled with the Emma runtime and
+    our instrumentation classes.
+    '''
+    withFiles = []
+    #hack: emma copies instrumented jar files into lib folder
+    if jarFileRelativePath == "classes.jar":
+        emmaDevicePath = os.path.join(config.getEmmaDir(), config.getEmmaDeviceJar())
+        withFiles.append(config.getAndroidSpecificInstrumentationClassesPath())
+        withFiles.append(emmaDevicePath)
+    return withFiles
+
+
+def _getStageDependencies(pipelineMode):
+    '''
+    Returns the dict {state : states the stage uses the results of}.
+    '''
+    dependencies = {
+        STATE_APK_DECOMPILED : [],
+        STATE_DEX_CONVERTED_TO_JAR : [STATE_APK_DECOMPILED],
+        STATE_JARS_INSTRUMENTED : [STATE_DEX_CONVERTED_TO_JAR],
+        STATE_JAR_CONVERTED_TO_DEX : [STATE_JARS_INSTRUMENTED],
+        STATE_MANIFEST_INSTRUMENTED : [STATE_APK_DECOMPILED],
+        STATE_INSTRUMENTED_APK_BUILD : [STATE_MANIFEST_INSTRUMENTED],
+        STATE_FINAL_INSTRUMENTED_APK_BUILD : [STATE_INSTRUMENTED_APK_BUILD, STATE_JAR_CONVERTED_TO_DEX],
+        STATE_INSTRUMENTED_APK_SIGNED : [STATE_FINAL_INSTRUMENTED_APK_BUILD],
+        STATE_INSTRUMENTED_APK_ALIGNED : [STATE_INSTRUMENTED_APK_SIGNED],
+    }
+    if pipelineMode == PIPELINE_MODE_ZIP_PATCH:
+        #the instrumented dex files are patched into the apk when it is built
+        dependencies[STATE_INSTRUMENTED_APK_BUILD] = [STATE_MANIFEST_INSTRUMENTED, STATE_JAR_CONVERTED_TO_DEX]
+    return dependencies
+
+def _convertJar2DexWithSplitting(config, converter, instrJarsRootDir, jarFileRelativePath, dexFile, 
+                                 mainDexRules=([], None)):
+    '''
+    Converts the instrumented jar file into the dex file. If the classes
+    would exceed the reference limit of one dex file (Emma adds methods and
+    fields to every class), dx splits them into several dex files; the Emma
+    runtime, our instrumentation classes, the classes of the manifest and
+    the multidex support library stay in the primary one.
+    
+    Args:
+        :param mainDexRules: tuple returned by _getMainDexRules
+    
+    Returns:
+        :ret list of paths to the dex files split off the dex file; they have
+            to be renamed with _placeOverflowDexFiles
+    
+    Raises:
+        Jar2DexConvertionError: if the jar file cannot be converted
+    '''
+    jarFile = os.path.join(instrJarsRootDir, jarFileRelativePath)
+    withFiles = _getJar2DexWithFiles(config, jarFileRelativePath)
+    #dx does not create folders
+    auxiliary_utils.ensureDirExists(os.path.dirname(dexFile))
+    splittable = config.useDxMultiDex() and \
+        apk_utils.isDexEntry(os.path.splitext(jarFileRelativePath)[0] + ".dex")
+    if not (splittable and _exceedsDexReferenceLimit(config, jarFile, withFiles)):
+        try:
+            converter.convertJar2Dex(jarFile=jarFile, dexFile=dexFile, withFiles=withFiles, overwrite=True)
+            return []
+        except Jar2DexConvertionError as e:
+            #dx counts some references the estimation misses
+            if not (splittable and "too many" in e.msg.lower()):
+                raise
+    
+    logger.info("Splitting [%s] into several dex files" % jarFile)
+    multiDexDir = os.path.join(instrJarsRootDir, os.path.splitext(jarFileRelativePath)[0] + "_multidex")
+    shutil.rmtree(multiDexDir, ignore_errors=True)
+    mainDexClasses = []
+    for path in withFiles:
+        mainDexClasses.extend(class_refs.listClassFiles(path))
+    (manifestClasses, minSdkVersion) = mainDexRules
+    jarClasses = class_refs.listClassFiles(jarFile)
+    multiDexClasses = [cls for cls in jarClasses if cls.startswith(MULTIDEX_CLASS_PREFIXES)]
+    mainDexClasses.extend([cls for cls in jarClasses if cls in manifestClasses])
+    mainDexClasses.extend(multiDexClasses)
+    if jarFileRelativePath == "classes.jar" and not multiDexClasses and \
+            minSdkVersion is not None and minSdkVersion < NATIVE_MULTIDEX_SDK_VERSION:
+        logger.warning("The app has no multidex support library and minSdkVersion %d: "
+                       "the classes split off [%s] are not loaded before Android 5.0" % (minSdkVersion, jarFile))
+    dexFiles = converter.convertJar2MultiDex(jarFile, multiDexDir, withFiles, mainDexClasses)
+    shutil.move(dexFiles[0], dexFile)
+    return dexFiles[1:]
+
+def _getMainDexRules(pathToAndroidManifest, decompileDir):
+    '''
+    Returns what dx has to keep in classes.dex when it splits the dex files:
+    the classes of the manifest (application, instrumentation and
+    components) are loaded by the platform before the secondary dex files.
+    
+    Returns:
+        :ret tuple (set of class files of the manifest, e.g. 
+            com/example/Main.class, minSdkVersion of the app or None if the 
+            manifest cannot be read)
+    '''
+    try:
+        androidManifest = AndroidManifest(pathToAndroidManifest)
+    except (IOError, AxmlException, ExpatError) as e:
+        logger.warning("Cannot read the classes of the main dex file from the manifest! %s" % str(e))
+        return (set(), None)
+    manifestClasses = set()
+    for tag in emma_filters.COMPONENT_TAGS:
+        for className in androidManifest.getElements(tag, "android:name"):
+            manifestClasses.add(className.replace(".", "/") + ".class")
+    minSdkVersion = androidManifest.getMinSdkVersion()
+    if minSdkVersion is None:
+        try:
+            with open(os.path.join(decompileDir, "apktool.yml"), "r") as f:
+                match = APKTOOL_MIN_SDK_RE.search(f.read())
+            if match:
+                minSdkVersion = int(match.group(1))
+        except IOError:
+            pass
+    if minSdkVersion is None:
+        #the platform default
+        minSdkVersion = 1
+    return (manifestClasses, minSdkVersion)
+
+def _exceedsDexReferenceLimit(config, jarFile, withFiles):
+    counter = class_refs.ReferenceCounter()
+    try:
+        for path in [jarFile] + withFiles:
+            counter.addPath(path)
+    except (ClassFileException, zipfile.BadZipfile, IOError) as e:
+        logger.warning("Cannot estimate the references of [%s]. %s" % (jarFile, str(e)))
+        return False
+    logger.debug("[%s]: %d method and %d field references" % (jarFile, counter.getMethodCount(), counter.getFieldCount()))
+    threshold = config.getDxMultiDexThreshold()
+    return counter.getMethodCount() > threshold or counter.getFieldCount() > threshold
+
+def _placeOverflowDexFiles(dexFilesRootDir, dexFilesRelativePaths, overflowDexFiles):
+    '''
+    Moves the dex files split off by dx to the root of the instrumented dex
+    files as classesN.dex after the dex files of the original apk.
+    
+    Returns:
+        :ret list of relative paths of the placed dex files
+    '''
+    index = max([_getDexIndex(pth) for pth in dexFilesRelativePaths if apk_utils.isDexEntry(pth)] + [1])
+    placedRelativePaths = []
+    for dexFile in overflowDexFiles:
+        index += 1
+        dexFileRelativePath = "classes%d.dex" % index
+        shutil.move(dexFile, os.path.join(dexFilesRootDir, dexFileRelativePath))
+        placedRelativePaths.append(dexFileRelativePath)
+    for multiDexDir in set([os.path.dirname(dexFile) for dexFile in overflowDexFiles]):
+        shutil.rmtree(multiDexDir, ignore_errors=True)
+    return placedRelativePaths
+
+def _getDexIndex(dexFileName):
+    number = dexFileName[len("classes"):-len(".dex")]
+    return int(number) if number else 1
+
+def _getPathsWithUniqueNames(paths):
+    '''
+    Returns the paths whose file names differ from the names of the preceding
+    paths.
+    '''
+    names = set()
+    uniquePaths = []
+    for pth in paths:
+        name = os.path.basename(pth)
+        if name not in names:
+            names.add(name)
+            uniquePaths.append(pth)
+    return uniquePaths
+
+
+def _getEmmaClassCache(config):
+    '''
+    Returns the cache of instrumented library classes or None if it is disabled.
+    '''
+    if not config.useEmmaClassCache():
+        return None
+    return BBoxEmmaClassCache(config)
+
+
+def _processDexFileChain(task):
+    '''
+    Worker function for BBoxCoverage._processDexFilesInParallel. Must be a 
+    module level function to be picklable.
+    
+    Returns:
+        :ret tuple (result of _runDexFileChain, state of the command metrics
+            of the tools run for the dex file)
+    '''
+    #the worker has a copy of the metrics of its parent and may be reused
+    metrics = commander.getCommandMetrics()
+    metrics.reset()
+    try:
+        result = _runDexFileChain(task)
+    except (OSError, IOError) as e:
+        #an exception escaping from pool.map would abort all dex files
+        result = (task[2], None, None, None, None, [], str(e), [])
+    return (result, metrics.getState())
+
+def _runDexFileChain(task):
+    '''
+    Converts one dex file to jar, instruments it with Emma (using a separate
+    metadata file) and converts it back to dex.
+    
+    Returns:
+        :ret tuple (dexFileRelativePath, jarFileRelativePath, 
+            instrJarFileRelativePath, instrDexFileRelativePath, metadataFile, 
+            overflowDexFiles, error, steps). The relative paths of the stages 
+            that have not been completed are None. overflowDexFiles are the dex
+            files split off by dx. steps is the list of the timings of the 
+            tools (step, file, usage).
+    '''
+    (pathToConfigFile, dexFilesRootDir, dexFileRelativePath, jarFilesRootDir, 
+        instrJarsRootDir, instrDexFilesRootDir, metadataFilesRootDir, emmaFilters, mainDexRules) = task
+    config = BBoxConfig(pathToConfigFile)
+    instrumenter = BBoxInstrumenter(config)
+    steps = []
+    
+    dexFilePath = os.path.join(dexFilesRootDir, dexFileRelativePath)
+    jarFileRelativePath = os.path.splitext(dexFileRelativePath)[0] + ".jar"
+    jarFilePath = os.path.join(jarFilesRootDir, jarFileRelativePath)
+    meter = UsageMeter()
+    try:
+        with meter:
+            instrumenter.convertDex2Jar(dexFilePath, jarFilePath, overwrite=True)
+    except Dex2JarConvertionError as e:
+        steps.append((STEP_DEX2JAR, dexFileRelativePath, meter.record))
+        return (dexFileRelativePath, None, None, None, None, [], e.msg, steps)
+    steps.append((STEP_DEX2JAR, dexFileRelativePath, meter.record))
+    
+    instrJarRelativeDir = jarFileRelativePath[:jarFileRelativePath.rfind("/")+1]
+    instrJarFullDir = os.path.join(instrJarsRootDir, instrJarRelativeDir)
+    metadataFile = os.path.join(metadataFilesRootDir, os.path.splitext(dexFileRelativePath)[0] + ".em")
+    auxiliary_utils.ensureDirExists(os.path.dirname(metadataFile))
+    meter = UsageMeter()
+    try:
+        with meter:
+            classCache = _getEmmaClassCache(config)
+            if classCache:
+                classCache.instrumentJar(instrumenter, jarFile=jarFilePath, outputFolder=instrJarFullDir, 
+                                         emmaMetadataFile=metadataFile, filters=emmaFilters)
+            else:
+                instrumenter.instrumentJarWithEmma(jarFile=jarFilePath, outputFolder=instrJarFullDir, 
+                                                   emmaMetadataFile=metadataFile, filters=emmaFilters)
+    except EmmaCannotInstrumentException as e:
+        steps.append((STEP_EMMA, jarFileRelativePath, meter.record))
+        return (dexFileRelativePath, jarFileRelativePath, None, None, None, [], e.msg, steps)
+    steps.append((STEP_EMMA, jarFileRelativePath, meter.record))
+    
+    meter = UsageMeter()
+    try:
+        with meter:
+            overflowDexFiles = _convertJar2DexWithSplitting(config, instrumenter, instrJarsRootDir, jarFileRelativePath, 
+                                                            os.path.join(instrDexFilesRootDir, dexFileRelativePath), 
+                                                            mainDexRules)
+    except Jar2DexConvertionError as e:
+        steps.append((STEP_DX, jarFileRelativePath, meter.record))
+        return (dexFileRelativePath, jarFileRelativePath, jarFileRelativePath, None, None, [], e.msg, steps)
+    steps.append((STEP_DX, jarFileRelativePath, meter.record))
+    
+    return (dexFileRelativePath, jarFileRelativePath, jarFileRelativePath, dexFileRelativePath, metadataFile, 
+            overflowDexFiles, None, steps)
+    
+
 class ApkIsNotValidException(MsgException):
     '''
     Path is pointing on a non-valid apk-path
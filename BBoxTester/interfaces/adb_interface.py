@@ -20,11 +20,12 @@
 import os
 import string
 import time
-import signal
 import subprocess
-import threading
 import re
+import shlex
 
+import commander
+from command_executor import RESOURCE_PROCESS, deviceResource
 from logconfig import logger
 from six import iteritems
 
@@ -62,8 +63,8 @@ class AdbInterface:
     """Helper class for communicating with Android device via adb."""
     
     LOG_LEVELS = ['V', 'I', 'D', 'W', 'E', 'WTF']
-    # argument to pass to adb, to direct command to specific device
-    _target_arg = ""
+    # arguments to pass to adb, to direct command to specific device
+    _target_args = []
 
     DEVICE_TEST_RESULTS_DIR = "/data/test_results/"
 
@@ -73,7 +74,7 @@ class AdbInterface:
         deviceSerials = []
         input_devices = None
         try:
-            input_devices = runCommand("adb devices")
+            input_devices = runCommand(["adb", "devices"])
         except WaitForResponseTimedOutError:
             logger.error("Command timeout exception!")
             return deviceSerials
@@ -92,21 +93,22 @@ class AdbInterface:
     
     def setEmulatorTarget(self):
         """Direct all future commands to the only running emulator."""
-        self._target_arg = "-e"
+        self._target_args = ["-e"]
 
     def setDeviceTarget(self):
         """Direct all future commands to the only connected USB device."""
-        self._target_arg = "-d"
+        self._target_args = ["-d"]
 
     def setTargetSerial(self, serial):
         """Direct all future commands to Android target with the given serial."""
-        self._target_arg = "-s %s" % serial
+        self._target_args = ["-s", serial]
     
     def sendCommand(self, command_string, timeout_time=20, retry_count=3):
         """Send a command via adb.
 
         Args:
-            command_string: adb command to run
+            command_string: adb command to run: list of adb arguments or a
+                string split into the arguments as a shell would do
             timeout_time: number of seconds to wait for command to respond before
                 retrying
             retry_count: number of times to retry command before raising
@@ -117,15 +119,39 @@ class AdbInterface:
         Raises:
             WaitForResponseTimedOutError if device does not respond to command within time
         """
-        adb_cmd = "adb %s %s" % (self._target_arg, command_string)
-        logger.debug("about to run %s" % adb_cmd)
-        return runCommand(adb_cmd, timeout_time=timeout_time, retry_count=retry_count)
+        adb_cmd = self._adbArgs(command_string)
+        logger.debug("about to run %s" % commander.formatCommand(adb_cmd))
+        return runCommand(adb_cmd, timeout_time=timeout_time, retry_count=retry_count,
+                          resource=self._getResource())
+    
+    def sendStreamingCommand(self, command_string, lineCallback=None, timeout_time=None,
+                             outputPath=None):
+        """Send a command via adb without keeping its whole output. Used for 
+        the commands producing long output.
+
+        Args:
+            command_string: adb command to run (see sendCommand)
+            lineCallback: function called as lineCallback(stream, line) for
+                each output line as it arrives (see commander.runStreaming)
+            timeout_time: number of seconds to wait for command to finish
+            outputPath: path to a gzip file the whole output is written to
+        Returns:
+            the last lines of the output of command
+
+        Raises:
+            WaitForResponseTimedOutError if command does not finish within time
+        """
+        adb_cmd = self._adbArgs(command_string)
+        logger.debug("about to run %s" % commander.formatCommand(adb_cmd))
+        return runStreaming(adb_cmd, lineCallback=lineCallback, timeout_time=timeout_time,
+                            tee_path=outputPath, resource=self._getResource())
     
     def sendShellCommand(self, cmd, timeout_time=20, retry_count=3):
         """Send a adb shell command.
 
         Args:
-            cmd: adb shell command to run
+            cmd: adb shell command to run; it is passed as is to the shell
+                of the device
             timeout_time: number of seconds to wait for command to respond before
                 retrying
             retry_count: number of times to retry command before raising
@@ -137,9 +163,22 @@ class AdbInterface:
         Raises:
             WaitForResponseTimedOutError: if device does not respond to command
         """
-        return self.sendCommand("shell %s" % cmd, timeout_time=timeout_time,
+        return self.sendCommand(["shell", cmd], timeout_time=timeout_time,
                                                         retry_count=retry_count)
 
+    def _adbArgs(self, command):
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+        return ["adb"] + self._target_args + list(command)
+
+    def _shellArgs(self, cmd):
+        return self._adbArgs(["shell", cmd])
+
+    def _getResource(self):
+        # the commands of each device are limited and measured separately;
+        # the device is named by its serial (or -e, -d)
+        return deviceResource(self._target_args[-1] if self._target_args else "default")
+
     def bugReport(self, path):
         """Dumps adb bugreport to the file specified by the path.
 
@@ -158,7 +197,7 @@ class AdbInterface:
             src: file path of host file to push
             dest: destination absolute file path on device
         """
-        self.sendCommand("push %s %s" % (src, dest), timeout_time=60)
+        self.sendCommand(["push", src, dest], timeout_time=60)
 
     def pull(self, src, dest):
         """Pulls the file src on the device onto dest on the host.
@@ -175,7 +214,7 @@ class AdbInterface:
             os.makedirs(os.path.dirname(dest))
 
         if self.doesFileExist(src):
-            self.sendCommand("pull %s %s" % (src, dest), timeout_time=60)
+            self.sendCommand(["pull", src, dest], timeout_time=60)
             return True
         else:
             logger.info("ADB pull Failed: Source file %s does not exist." % src)
@@ -193,7 +232,7 @@ class AdbInterface:
         Returns:
             output of install command
         """
-        return self.sendCommand("install -r %s" % apk_path)
+        return self.sendCommand(["install", "-r", apk_path])
     
 
     
@@ -204,11 +243,11 @@ class AdbInterface:
         return self.sendCommand(cmd)
     
     def _buildUninstallCommand(self, package_name, keep_data=False):
-        options = ""
+        cmd = ["uninstall"]
         if keep_data:
-            options  += " -k"
+            cmd.append("-k")
         
-        cmd = "uninstall %s %s" % (options, package_name)
+        cmd.append(package_name)
         return cmd 
 
     def doesFileExist(self, src):
@@ -330,11 +369,12 @@ class AdbInterface:
         'normal' output to stdout, instead of parsing return results. Command will
         never timeout.
         """
-        adb_command_string = self.previewInstrumentationCommand(
+        inst_command_string = self._buildInstrumentationCommand(
                 package_name, runner_name, no_window_animation=no_window_animation,
                 raw_mode=raw_mode, wait=wait, instrumentation_args=instrumentation_args)
-        logger.debug(adb_command_string)
-        runCommand(adb_command_string, return_output=False)
+        logger.debug(self.previewShellCommand(inst_command_string))
+        runCommand(self._shellArgs(inst_command_string), return_output=False,
+                   resource=self._getResource())
 
     def previewInstrumentationCommand(
             self, package_name, runner_name, no_window_animation=False,
@@ -346,7 +386,7 @@ class AdbInterface:
         return self.previewShellCommand(inst_command_string)
 
     def previewShellCommand(self, cmd):
-        return "adb %s shell %s" % (self._target_arg, cmd)
+        return commander.formatCommand(self._shellArgs(cmd))
 
     def _buildInstrumentationCommand(
             self, package, runner_name, no_window_animation=False, profile=False,
@@ -390,11 +430,12 @@ class AdbInterface:
         'normal' output to stdout, instead of parsing return results. Command will
         never timeout.
         """
-        adb_command_string = self.previewInstrumentationCommandMod(
+        inst_command_string = self._buildInstrumentationCommandMod(
                 package_name, runner_name, no_window_animation=no_window_animation,
                 raw_mode=raw_mode, wait=wait, instrumentation_args=instrumentation_args)
-        logger.debug(adb_command_string)
-        runCommand(adb_command_string, return_output=False)
+        logger.debug(self.previewShellCommand(inst_command_string))
+        runCommand(self._shellArgs(inst_command_string), return_output=False,
+                   resource=self._getResource())
 
     def previewInstrumentationCommandMod(
             self, package_name, runner_name, no_window_animation=False,
@@ -645,7 +686,10 @@ class AdbInterface:
         """Returns the serial number of the targeted device."""
         return self.sendCommand("get-serialno").strip()
     
-    def getLogcat(self, tag = None, level = None):
+    def getLogcat(self, tag = None, level = None, lineCallback=None, outputPath=None, timeout=None):
+        """Streams the log of the device to the callback and/or the gzip file
+        until the timeout expires. Returns the last lines of the log.
+        """
 #         logger.debug("Attaching to a logcat pipe...")
 #         if not self.is_alive():
 #             logger.error("The device [%s] is not running!" % self.device_name)
@@ -660,12 +704,17 @@ class AdbInterface:
 #         if tag != '*':
 #             command.append('*:S')
         
-        cmd = "logcat %s:%s" % (tag, level)
+        cmd = ["logcat", "%s:%s" % (tag, level)]
         if tag != '*':
             # if we get only specified tag all others need to be suppressed
-            cmd = ' '.join(cmd, "*:S")
+            cmd.append("*:S")
         
-        return self.sendCommand(cmd, timeout_time=None)
+        try:
+            return self.sendStreamingCommand(cmd, lineCallback=lineCallback, 
+                                             timeout_time=timeout, outputPath=outputPath)
+        except WaitForResponseTimedOutError:
+            #logcat does not finish by itself
+            return None
     
     
     def cleanLogcat(self):
@@ -683,8 +732,8 @@ class AdbInterface:
 #         
 #         logger.debug("Logcat is cleaned!")
         
-        cmd = "logcat -c"
-        runCommand(cmd=cmd, return_output=False)
+        cmd = self._adbArgs(["logcat", "-c"])
+        runCommand(cmd=cmd, return_output=False, resource=self._getResource())
             
     def getPackageUid(self, package_name):
         logger.debug("Getting UID of the package [%s]..." % package_name)
@@ -786,8 +835,12 @@ class AdbInterface:
     def runMonkeyTest(self, timeout=None, packageName=None, verbosityLevel=0, 
             seed=None, throttle=0, eventsCount=500, dbgNoEvents=False, 
             hprof=False, ignoreCrashes=False, ignoreTimeouts=False, ignoreSecurityExceptions=False,
-            killProcessAfterError=False, monitorNativeCrashes=False, waitDbg=False):
-        
+            killProcessAfterError=False, monitorNativeCrashes=False, waitDbg=False,
+            lineCallback=None, outputPath=None):
+        """Runs monkey on the device. The output of monkey (long with the high
+        verbosity levels) is streamed to the callback and/or the gzip file.
+        Returns the last lines of the output.
+        """
         options = ""
         if packageName:
             options += " -p %s" % packageName
@@ -817,7 +870,8 @@ class AdbInterface:
         
         cmd = "monkey %s %d" % (options, eventsCount) 
         print cmd
-        return self.sendShellCommand(cmd, timeout_time=timeout, retry_count=1)
+        return self.sendStreamingCommand(["shell", cmd], lineCallback=lineCallback, 
+                                         timeout_time=timeout, outputPath=outputPath)
 
 def ParseAmInstrumentOutput(result):
     """Given the raw output of an "am instrument" command that targets and
@@ -1006,16 +1060,19 @@ def setAbortOnError(abort=True):
     _abort_on_error = abort
 
 def runCommand(cmd, timeout_time=None, retry_count=3, return_output=True,
-                             stdin_input=None):
-    """Spawn and retry a subprocess to run the given shell command.
+                             stdin_input=None, resource=RESOURCE_PROCESS):
+    """Spawn and retry a subprocess to run the given command.
 
     Args:
-        cmd: shell command to run
+        cmd: command to run (argv list or shell command string, see 
+            commander.runCommand)
         timeout_time: time in seconds to wait for command to run before aborting.
         retry_count: number of times to retry command
         return_output: if True return output of command as string. Otherwise,
             direct output of command to stdout.
         stdin_input: data to feed to stdin
+        resource: resource of the command in the executor of commands (see
+            commander.runCommand)
     Returns:
         output of command
     """
@@ -1023,96 +1080,73 @@ def runCommand(cmd, timeout_time=None, retry_count=3, return_output=True,
     while True:
         try:
             result = runOnce(cmd, timeout_time=timeout_time,
-                                             return_output=return_output, stdin_input=stdin_input)
+                                             return_output=return_output, stdin_input=stdin_input,
+                                             resource=resource)
         except WaitForResponseTimedOutError:
             if retry_count == 0:
                 raise
             retry_count -= 1
-            logger.info("No response for %s, retrying" % cmd)
+            logger.info("No response for %s, retrying" % commander.formatCommand(cmd))
         else:
             # Success
             return result
 
-def runOnce(cmd, timeout_time=None, return_output=True, stdin_input=None):
-    """Spawns a subprocess to run the given shell command.
+def runOnce(cmd, timeout_time=None, return_output=True, stdin_input=None, 
+            resource=RESOURCE_PROCESS):
+    """Spawns a subprocess to run the given command.
 
     Args:
-        cmd: shell command to run
+        cmd: command to run (argv list or shell command string, see 
+            commander.runCommand)
         timeout_time: time in seconds to wait for command to run before aborting.
         return_output: if True return output of command as string. Otherwise,
             direct output of command to stdout.
         stdin_input: data to feed to stdin
+        resource: see runCommand
     Returns:
-        output of command
+        output of command (standard output followed by standard error)
     Raises:
         adb_interface_errors.WaitForResponseTimedOutError if command did not complete within
             timeout_time seconds.
         adb_interface_errors.AbortError is command returned error code and setAbortOnError is on.
     """
-    start_time = time.time()
-    so = []
-    pid = []
-    global _abort_on_error, error_occurred
-    error_occurred = False
+    return _runAndCheck(cmd, lambda: commander.runCommand(cmd, timeout_time=timeout_time, 
+                        return_output=return_output, stdin_input=stdin_input, resource=resource))
 
-    def Run():
-        global error_occurred
-        if return_output:
-            output_dest = subprocess.PIPE
-        else:
-            # None means direct to stdout
-            output_dest = None
-        if stdin_input:
-            stdin_dest = subprocess.PIPE
-        else:
-            stdin_dest = None
-        pipe = subprocess.Popen(
-                cmd,
-                executable='/bin/bash',
-                stdin=stdin_dest,
-                stdout=output_dest,
-                stderr=subprocess.STDOUT,
-                shell=True)
-        pid.append(pipe.pid)
-        try:
-            output = pipe.communicate(input=stdin_input)[0]
-            if output is not None and len(output) > 0:
-                so.append(output)
-        except OSError, e:
-            logger.debug("failed to retrieve stdout from: %s" % cmd)
-            logger.error(e)
-            so.append("ERROR")
-            error_occurred = True
-        if pipe.returncode:
-            logger.debug("Error: %s returned %d error code" %(cmd,
-                    pipe.returncode))
-            error_occurred = True
-
-    t = threading.Thread(target=Run)
-    t.start()
-
-    break_loop = False
-    while not break_loop:
-        if not t.isAlive():
-            break_loop = True
-
-        # Check the timeout
-        if (not break_loop and timeout_time is not None
-                and time.time() > start_time + timeout_time):
-            try:
-                os.kill(pid[0], signal.SIGKILL)
-            except OSError:
-                # process already dead. No action required.
-                pass
+def runStreaming(cmd, lineCallback=None, timeout_time=None, tee_path=None, 
+                 resource=RESOURCE_PROCESS):
+    """Spawns a subprocess to run the given command without keeping its whole
+    output (see commander.runStreaming). The command is not retried.
 
-            logger.debug("about to raise a timeout for: %s" % cmd)
-            raise WaitForResponseTimedOutError
-        if not break_loop:
-            time.sleep(0.1)
+    Returns:
+        the last lines of the output of command
+    Raises:
+        the same errors as runOnce
+    """
+    return _runAndCheck(cmd, lambda: commander.runStreaming(cmd, lineCallback=lineCallback, 
+                        timeout_time=timeout_time, tee_path=tee_path, resource=resource))
 
-    t.join()
-    output = "".join(so)
+def _runAndCheck(cmd, run):
+    global error_occurred
+    error_occurred = False
+    try:
+        result = run()
+    except OSError, e:
+        logger.debug("failed to run: %s" % commander.formatCommand(cmd))
+        logger.error(e)
+        error_occurred = True
+        if _abort_on_error:
+            raise AbortError(msg="ERROR")
+        return "ERROR"
+    if result.timedOut:
+        logger.debug("about to raise a timeout for: %s" % commander.formatCommand(cmd))
+        raise WaitForResponseTimedOutError
+    output = result.stdout + result.stderr
+    if result.returnCode:
+        logger.debug("Error: %s returned %d error code" %(commander.formatCommand(cmd),
+                result.returnCode))
+        error_occurred = True
     if _abort_on_error and error_occurred:
         raise AbortError(msg=output)
 
-    return "".join(so)
+    return output
@@ -1,6 +1,11 @@
 import os
+import shlex
 import commander
 
+#apktool prints a line per processed file in the verbose mode; only the last
+#lines are needed for the error messages
+OUTPUT_TAIL_LINES = 500
+
 
 class ApktoolInterface:
     def __init__(self, javaPath = "java", javaOpts = "-Xms512m -Xmx1024m", pathApktool = "./auxiliary/apktool", jarApktool="apktool.jar"):
@@ -11,7 +16,7 @@ class ApktoolInterface:
         #TODO: later we can join path and jar and check if they exist or not
         # if not - generate an exception
     
-    def _previewApktoolCommand(self, cmdStr, quiet):
+    def _previewApktoolCommand(self, options, quiet):
         path = os.path.join(self.pathApktool, self.jarApktool)
         verbose = None
         if quiet:
@@ -19,12 +24,13 @@ class ApktoolInterface:
         else:
             verbose = "--verbose"
             
-        apktoolCmd = "%s %s %s" % (path, verbose, cmdStr)
+        apktoolCmd = [path, verbose] + options
         return apktoolCmd
     
-    def _runApktoolCommand(self, commandString):
-        cmd = "'%s' %s -jar %s" % (self.javaPath, self.javaOpts, commandString)
-        return commander.runOnce(cmd)
+    def _runApktoolCommand(self, args):
+        cmd = [self.javaPath] + shlex.split(self.javaOpts) + ["-jar"] + args
+        return commander.runJavaTool(cmd, classpath=[args[0]], mainClass=None, args=args[1:],
+                                     tail_lines=OUTPUT_TAIL_LINES, tool="apktool")
 
     def _interpResultsDecodeCmd(self, returnCode, cmdOutput):
         output = "Return code is: [%s].\nCommand output: %s" % (returnCode, cmdOutput)
@@ -35,25 +41,25 @@ class ApktoolInterface:
     
     
     def decode(self, apkPath, dirToDecompile, quiet=True, noSrc=False, noRes=False, debug=True, noDebugInfo=False, force=True, frameworkTag="", frameworkDir="", keepBrokenRes=True):
-        options = "decode"
+        options = ["decode"]
         if noSrc:
-            options += " --no-src"
+            options.append("--no-src")
         if noRes:
-            options += " --no-res"
+            options.append("--no-res")
         if debug:
-            options += " --debug"
+            options.append("--debug")
         if noDebugInfo:
-            options += " --no-debug-info"
+            options.append("--no-debug-info")
         if force:
-            options += " --force"
+            options.append("--force")
         if frameworkTag:
-            options += " --frame-tag '%s'" % frameworkTag
+            options += ["--frame-tag", frameworkTag]
         if frameworkDir:
-            options += " --frame-path '%s'" % frameworkDir  
+            options += ["--frame-path", frameworkDir]
         if keepBrokenRes:
-            options += " --keep-broken-res" 
+            options.append("--keep-broken-res")
         
-        options = "%s '%s' '%s'" % (options, apkPath, dirToDecompile)
+        options += [apkPath, dirToDecompile]
         cmd = self._previewApktoolCommand(options, quiet)
         (returnCode, cmdOutput) = self._runApktoolCommand(cmd)
         return self._interpResultsDecodeCmd(returnCode, cmdOutput)
@@ -69,15 +75,15 @@ class ApktoolInterface:
     
     
     def build(self, srcPath, finalApk, quiet=True, forceAll=False, debug=True, aaptPath=""):
-        options = "build"
+        options = ["build"]
         if forceAll:
-            options += " --force-all"
+            options.append("--force-all")
         if debug:
-            options += " --debug"
+            options.append("--debug")
         if aaptPath:
-            options += " --aapt '%s'" % aaptPath
+            options += ["--aapt", aaptPath]
         
-        options = "%s '%s' '%s'" % (options, srcPath, finalApk)
+        options += [srcPath, finalApk]
         cmd = self._previewApktoolCommand(options, quiet)
         (returnCode, outputStr) = self._runApktoolCommand(cmd)
         return self._interpResultsBuildCmd(returnCode, outputStr)
@@ -92,7 +98,7 @@ class ApktoolInterface:
     
     
     def version(self, quiet=True):
-        options = " --version"
+        options = ["--version"]
         cmd = self._previewApktoolCommand(options, quiet)
         (returnCode, outputStr) = self._runApktoolCommand(cmd)
         return self._interpResultsVersionCmd(returnCode, outputStr.strip('\n'))
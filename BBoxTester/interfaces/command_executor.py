@@ -0,0 +1,355 @@
+'''
+Executor of the external commands.
+
+The commands belong to resource classes (JVM tools, adb commands of a
+device, disk-heavy steps, other processes); each class has its own limit of
+the commands run at the same time. The limit of the adb class applies to
+every device separately. The commands waiting for a free slot are started in
+the order of their priority, then in the order they have been added.
+
+submit runs a command in a separate thread and returns a CommandFuture.
+call runs a command in the calling thread as soon as a slot is free; the
+synchronous functions of commander are built on it. The futures can be
+awaited in an asyncio (or trollius) event loop through toAsyncioFuture.
+'''
+import sys
+import time
+import heapq
+import itertools
+import threading
+
+from bbox_core.general_exceptions import MsgException
+
+
+RESOURCE_JVM = "jvm"
+RESOURCE_ADB = "adb"
+RESOURCE_DISK = "disk"
+RESOURCE_PROCESS = "process"
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+#maximum number of the commands of a class run at the same time; 0 - no limit
+DEFAULT_LIMITS = {
+    RESOURCE_JVM : 4,
+    RESOURCE_ADB : 4,
+    RESOURCE_DISK : 2,
+    RESOURCE_PROCESS : 0,
+}
+
+_PENDING = "pending"
+_RUNNING = "running"
+_CANCELLED = "cancelled"
+_FINISHED = "finished"
+
+
+def deviceResource(device):
+    '''
+    Returns the resource of the adb commands sent to the device.
+    '''
+    return "%s:%s" % (RESOURCE_ADB, device)
+
+
+class CommandFuture:
+    '''
+    Result of a command submitted to CommandExecutor. The methods follow the
+    ones of the futures of concurrent.futures.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = _PENDING
+        self._result = None
+        self._excInfo = None
+        self._callbacks = []
+
+    def cancel(self):
+        '''
+        Cancels the command if it has not been started yet.
+
+        Returns:
+            :ret True if the command has been cancelled
+        '''
+        with self._condition:
+            if self._state == _CANCELLED:
+                return True
+            if self._state != _PENDING:
+                return False
+            self._state = _CANCELLED
+            self._condition.notify_all()
+        self._runCallbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == _CANCELLED
+
+    def running(self):
+        return self._state == _RUNNING
+
+    def done(self):
+        return self._state in (_CANCELLED, _FINISHED)
+
+    def result(self, timeout=None):
+        '''
+        Waits until the command finishes and returns its result.
+
+        Raises:
+            CommandCancelledException: if the command has been cancelled
+            FutureTimeoutException: if the command has not finished within
+                timeout seconds
+            the exception raised by the command
+        '''
+        self._wait(timeout)
+        if self._excInfo:
+            (excType, excValue, excTraceback) = self._excInfo
+            raise excType, excValue, excTraceback
+        return self._result
+
+    def exception(self, timeout=None):
+        '''
+        Waits until the command finishes and returns the exception it has
+        raised or None.
+        '''
+        self._wait(timeout)
+        if self._excInfo:
+            return self._excInfo[1]
+        return None
+
+    def addDoneCallback(self, callback):
+        '''
+        Registers a function called as callback(future) when the command
+        finishes or is cancelled: in the thread that has run the command, or
+        at once if the command is already done.
+        '''
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def _wait(self, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            while not self.done():
+                if deadline is None:
+                    self._condition.wait()
+                elif deadline > time.time():
+                    self._condition.wait(deadline - time.time())
+                else:
+                    break
+            if self._state == _CANCELLED:
+                raise CommandCancelledException("The command has been cancelled")
+            if self._state != _FINISHED:
+                raise FutureTimeoutException("The command has not finished in %s seconds" % timeout)
+
+    def _setRunning(self):
+        with self._condition:
+            if self._state != _PENDING:
+                return False
+            self._state = _RUNNING
+            return True
+
+    def _setResult(self, result, excInfo=None):
+        with self._condition:
+            self._result = result
+            self._excInfo = excInfo
+            self._state = _FINISHED
+            self._condition.notify_all()
+        self._runCallbacks()
+
+    def _runCallbacks(self):
+        with self._condition:
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class CommandExecutor:
+    def __init__(self, limits=None):
+        '''
+        Args:
+            :param limits: dictionary resource class -> maximum number of the
+                commands of the class run at the same time (0 - no limit);
+                the classes not given get DEFAULT_LIMITS
+        '''
+        self._limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self._limits.update(limits)
+        self._running = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def setLimit(self, resourceClass, limit):
+        with self._condition:
+            self._limits[resourceClass] = limit
+            self._dispatch()
+
+    def getLimit(self, resourceClass):
+        return self._limits.get(resourceClass, 0)
+
+    def submit(self, function, resource=RESOURCE_PROCESS, priority=PRIORITY_NORMAL):
+        '''
+        Runs the function in a separate thread as soon as a slot of the
+        resource is free.
+
+        Args:
+            :param function: function without arguments running the command
+            :param resource: resource class or a resource of the class (e.g.,
+                deviceResource(serial))
+            :param priority: lower values are started first
+
+        Returns:
+            :ret CommandFuture of the value returned by the function
+        '''
+        future = CommandFuture()
+        def start():
+            thread = threading.Thread(target=self._runSubmitted, args=(function, resource, future),
+                                      name="command-%s" % resource)
+            thread.daemon = True
+            thread.start()
+        with self._condition:
+            self._enqueue(resource, priority, future, start)
+        return future
+
+    def call(self, function, resource=RESOURCE_PROCESS, priority=PRIORITY_NORMAL):
+        '''
+        Waits for a free slot of the resource and runs the function in the
+        calling thread (see submit).
+
+        Returns:
+            :ret the value returned by the function
+        '''
+        future = CommandFuture()
+        try:
+            with self._condition:
+                self._enqueue(resource, priority, future, lambda: None)
+                while not future.running():
+                    self._condition.wait()
+        except BaseException:
+            #interrupted while waiting: give the slot back if it has been taken
+            if not future.cancel():
+                self._release(resource)
+            raise
+        try:
+            return function()
+        finally:
+            self._release(resource)
+
+
+    def _enqueue(self, resource, priority, future, start):
+        heapq.heappush(self._queue, (priority, next(self._sequence), resource, future, start))
+        self._dispatch()
+
+    def _dispatch(self):
+        '''
+        Starts the waiting commands that have free slots. Called with the
+        lock held.
+        '''
+        blocked = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            (_, _, resource, future, start) = entry
+            if future.cancelled():
+                continue
+            if not self._hasFreeSlot(resource):
+                blocked.append(entry)
+                continue
+            if not future._setRunning():
+                continue
+            self._running[resource] = self._running.get(resource, 0) + 1
+            start()
+        for entry in blocked:
+            heapq.heappush(self._queue, entry)
+        self._condition.notify_all()
+
+    def _hasFreeSlot(self, resource):
+        limit = self._limits.get(resource.split(":", 1)[0], 0)
+        return not limit or self._running.get(resource, 0) < limit
+
+    def _release(self, resource):
+        with self._condition:
+            self._running[resource] -= 1
+            if not self._running[resource]:
+                del self._running[resource]
+            self._dispatch()
+
+    def _runSubmitted(self, function, resource, future):
+        try:
+            result = function()
+        except BaseException:
+            excInfo = sys.exc_info()
+            self._release(resource)
+            future._setResult(None, excInfo)
+        else:
+            self._release(resource)
+            future._setResult(result)
+
+
+def toAsyncioFuture(future, loop=None):
+    '''
+    Returns an asyncio (trollius on python 2) future of the event loop that
+    gets the result of the CommandFuture, so that commands can be awaited
+    in coroutines. Cancelling the returned future cancels the command if it
+    has not been started yet.
+
+    Raises:
+        AsyncioUnavailableException: if neither asyncio nor trollius is
+            installed
+    '''
+    asyncio = _importAsyncio()
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    asyncioFuture = asyncio.Future(loop=loop)
+
+    def setState(commandFuture):
+        if asyncioFuture.cancelled():
+            return
+        if commandFuture.cancelled():
+            asyncioFuture.cancel()
+            return
+        exception = commandFuture.exception()
+        if exception is not None:
+            asyncioFuture.set_exception(exception)
+        else:
+            asyncioFuture.set_result(commandFuture.result())
+
+    def cancelCommand(asyncioFuture):
+        if asyncioFuture.cancelled():
+            future.cancel()
+
+    #the callbacks of the loop must be called in the thread of the loop
+    future.addDoneCallback(lambda commandFuture: loop.call_soon_threadsafe(setState, commandFuture))
+    asyncioFuture.add_done_callback(cancelCommand)
+    return asyncioFuture
+
+def _importAsyncio():
+    try:
+        import asyncio
+    except ImportError:
+        try:
+            import trollius as asyncio
+        except ImportError:
+            raise AsyncioUnavailableException("Neither asyncio nor trollius is installed")
+    return asyncio
+
+
+#Exceptions
+class CommandCancelledException(MsgException):
+    '''
+    The command has been cancelled before it has been started.
+    '''
+
+class FutureTimeoutException(MsgException):
+    '''
+    The command has not finished in the given time.
+    '''
+
+class AsyncioUnavailableException(MsgException):
+    '''
+    Neither asyncio nor trollius can be imported.
+    '''
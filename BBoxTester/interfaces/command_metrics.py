@@ -0,0 +1,244 @@
+'''
+Metrics of the external commands.
+
+commander records every command with its category (the resource class, see
+command_executor), tool, device (adb commands), exit code, wall time, user
+and system CPU time and peak RSS. The values are aggregated into histograms
+per series (category, tool, device); the series can be summed up per
+category, tool or device. The metrics can be written as JSON or in the
+Prometheus text exposition format, and the metrics collected in other
+processes (e.g., parallel workers) can be merged in through getState.
+
+CPU time and peak RSS are known only for the commands run in subprocesses;
+the java tools run in the tool server have only the wall time.
+'''
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict
+
+
+METRICS_FILENAME = "command_metrics.json"
+PROMETHEUS_FILENAME = "command_metrics.prom"
+PROMETHEUS_PREFIX = "bboxtester"
+
+METRIC_WALL_TIME = "wall_seconds"
+METRIC_USER_CPU = "user_cpu_seconds"
+METRIC_SYSTEM_CPU = "system_cpu_seconds"
+METRIC_MAX_RSS = "max_rss_bytes"
+
+TIME_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+#16 MB .. 8 GB
+RSS_BUCKETS = [2 ** i * 1024 * 1024 for i in range(4, 14)]
+
+METRICS = OrderedDict([
+    (METRIC_WALL_TIME, (TIME_BUCKETS, "Wall time of the commands")),
+    (METRIC_USER_CPU, (TIME_BUCKETS, "User CPU time of the commands")),
+    (METRIC_SYSTEM_CPU, (TIME_BUCKETS, "System CPU time of the commands")),
+    (METRIC_MAX_RSS, (RSS_BUCKETS, "Peak RSS of the commands")),
+])
+
+LABELS = ["category", "tool", "device"]
+
+
+class CommandMetrics:
+    def __init__(self):
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, category, tool, device, exitCode, timedOut, wallTime, rusage=None):
+        '''
+        Records a finished command.
+
+        Args:
+            :param category: resource class of the command (e.g., jvm, adb)
+            :param tool: name of the tool (e.g., dx, adb)
+            :param device: the device of adb commands, "" for the others
+            :param exitCode: return code of the command
+            :param timedOut: True if the command has been killed after the
+                timeout
+            :param wallTime: wall time of the command in seconds
+            :param rusage: resource usage of the command (see
+                resource.getrusage) or None if it is not available
+        '''
+        values = {METRIC_WALL_TIME : wallTime}
+        if rusage is not None:
+            values[METRIC_USER_CPU] = rusage.ru_utime
+            values[METRIC_SYSTEM_CPU] = rusage.ru_stime
+            values[METRIC_MAX_RSS] = maxRssToBytes(rusage.ru_maxrss)
+        with self._lock:
+            series = self._getSeries((category, tool, device))
+            series["count"] += 1
+            if timedOut:
+                series["timeouts"] += 1
+            exitCode = str(exitCode)
+            series["exitCodes"][exitCode] = series["exitCodes"].get(exitCode, 0) + 1
+            for (metric, value) in values.iteritems():
+                _observe(series["histograms"][metric], value)
+
+    def getSeries(self):
+        '''
+        Returns:
+            :ret list of dicts (category, tool, device, count, timeouts,
+                exitCodes, histograms); a histogram is a dict (buckets - the
+                upper bounds, counts - the number of the values in each bucket
+                and above the last bound, count, sum)
+        '''
+        with self._lock:
+            return json.loads(json.dumps(self._series.values()))
+
+    def summarize(self, by):
+        '''
+        Sums up the series per value of one label.
+
+        Args:
+            :param by: "category", "tool" or "device"
+
+        Returns:
+            :ret dict label value -> dict (count, timeouts, exitCodes,
+                histograms)
+        '''
+        summary = OrderedDict()
+        for series in self.getSeries():
+            if series[by] not in summary:
+                summary[series[by]] = _createSeries(None)
+            _mergeSeries(summary[series[by]], series)
+        for series in summary.values():
+            for label in LABELS:
+                del series[label]
+        return summary
+
+    def getState(self):
+        '''
+        Returns the metrics as a picklable object for merge.
+        '''
+        return self.getSeries()
+
+    def merge(self, state):
+        '''
+        Adds the metrics returned by getState (e.g., of another process).
+        '''
+        with self._lock:
+            for series in state:
+                _mergeSeries(self._getSeries(tuple([series[label] for label in LABELS])), series)
+
+    def reset(self):
+        with self._lock:
+            self._series = OrderedDict()
+
+    def toJson(self):
+        return json.dumps(OrderedDict([("series", self.getSeries()),
+                                       ("categories", self.summarize("category")),
+                                       ("tools", self.summarize("tool")),
+                                       ("devices", self.summarize("device"))]), indent=2)
+
+    def writeJson(self, path):
+        with open(path, "w") as f:
+            f.write(self.toJson())
+
+    def toPrometheus(self):
+        '''
+        Returns the metrics in Prometheus text exposition format.
+        '''
+        seriesList = self.getSeries()
+        lines = []
+        name = "%s_commands_total" % PROMETHEUS_PREFIX
+        lines.append("# HELP %s Number of the commands run." % name)
+        lines.append("# TYPE %s counter" % name)
+        for series in seriesList:
+            for (exitCode, count) in sorted(series["exitCodes"].items()):
+                lines.append("%s{%s} %d" % (name, formatPrometheusLabels(_getLabels(series) + [("exit_code", exitCode)]), count))
+        name = "%s_command_timeouts_total" % PROMETHEUS_PREFIX
+        lines.append("# HELP %s Number of the commands killed after the timeout." % name)
+        lines.append("# TYPE %s counter" % name)
+        for series in seriesList:
+            lines.append("%s{%s} %d" % (name, formatPrometheusLabels(_getLabels(series)), series["timeouts"]))
+        for (metric, (_, description)) in METRICS.iteritems():
+            name = "%s_command_%s" % (PROMETHEUS_PREFIX, metric)
+            lines.append("# HELP %s %s." % (name, description))
+            lines.append("# TYPE %s histogram" % name)
+            for series in seriesList:
+                histogram = series["histograms"][metric]
+                if not histogram["count"]:
+                    continue
+                labels = _getLabels(series)
+                cumulativeCount = 0
+                for (bound, count) in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                    cumulativeCount += count
+                    lines.append("%s_bucket{%s} %d" % (name, formatPrometheusLabels(labels + [("le", bound)]), cumulativeCount))
+                lines.append("%s_sum{%s} %s" % (name, formatPrometheusLabels(labels), repr(histogram["sum"])))
+                lines.append("%s_count{%s} %d" % (name, formatPrometheusLabels(labels), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self, path):
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            f.write(self.toPrometheus())
+        #scrapers must not see a partially written file
+        os.rename(tmpPath, path)
+
+
+    def _getSeries(self, key):
+        if key not in self._series:
+            self._series[key] = _createSeries(key)
+        return self._series[key]
+
+
+def maxRssToBytes(maxRss):
+    #ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxRss
+    return maxRss * 1024
+
+def formatPrometheusLabels(labels):
+    '''
+    Formats the list of (name, value) pairs as Prometheus labels.
+    '''
+    formatted = []
+    for (name, value) in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        formatted.append("%s=\"%s\"" % (name, value))
+    return ",".join(formatted)
+
+
+def _createSeries(key):
+    series = OrderedDict()
+    if key is not None:
+        for (label, value) in zip(LABELS, key):
+            series[label] = value
+    else:
+        for label in LABELS:
+            series[label] = None
+    series["count"] = 0
+    series["timeouts"] = 0
+    series["exitCodes"] = {}
+    series["histograms"] = OrderedDict()
+    for (metric, (buckets, _)) in METRICS.iteritems():
+        series["histograms"][metric] = OrderedDict([("buckets", list(buckets)),
+                                                    ("counts", [0] * (len(buckets) + 1)),
+                                                    ("count", 0),
+                                                    ("sum", 0.0)])
+    return series
+
+def _mergeSeries(series, other):
+    series["count"] += other["count"]
+    series["timeouts"] += other["timeouts"]
+    for (exitCode, count) in other["exitCodes"].iteritems():
+        series["exitCodes"][exitCode] = series["exitCodes"].get(exitCode, 0) + count
+    for (metric, histogram) in other["histograms"].iteritems():
+        target = series["histograms"][metric]
+        target["counts"] = [a + b for (a, b) in zip(target["counts"], histogram["counts"])]
+        target["count"] += histogram["count"]
+        target["sum"] += histogram["sum"]
+
+def _observe(histogram, value):
+    index = 0
+    while index < len(histogram["buckets"]) and value > histogram["buckets"][index]:
+        index += 1
+    histogram["counts"][index] += 1
+    histogram["count"] += 1
+    histogram["sum"] += value
+
+def _getLabels(series):
+    return [(label, series[label]) for label in LABELS]
@@ -1,91 +1,580 @@
 import os
+import gzip
+import pipes
+import errno
+import select
 import signal
 import subprocess
 import threading
 import time
+from collections import deque
+from distutils.spawn import find_executable
 
 from bbox_core.general_exceptions import MsgException
+from interfaces.toolserver_interface import ToolServerUnavailableException
+from interfaces.command_executor import CommandExecutor, RESOURCE_JVM, \
+    RESOURCE_PROCESS, PRIORITY_NORMAL
+from interfaces.command_metrics import CommandMetrics, maxRssToBytes
 from logconfig import logger
 
 
 TIMEOUT_ERROR_VALUE = 1111
+STREAM_STDOUT = "stdout"
+STREAM_STDERR = "stderr"
+#number of the last output lines kept by runStreaming
+DEFAULT_TAIL_LINES = 200
+#longer lines (e.g., progress output without newlines) are split
+MAX_LINE_LENGTH = 64 * 1024
+#number of the last output characters written to the debug log
+LOGGED_OUTPUT_LIMIT = 64 * 1024
+READ_SIZE = 65536
+#return codes of the commands which cannot be executed
+EXEC_ERROR_CODES = {errno.ENOENT : 127, errno.EACCES : 126}
+#starts the commands in sessions (and process groups) of their own; the child
+#of Popen is not a process group leader, so setsid execs the command in place
+SETSID_PATH = find_executable("setsid")
 
-def runOnce(cmd, timeout_time=None, return_output=True, stdin_input=None):
-    """Spawns a subprocess to run the given shell command.
+_toolServer = None
+_usageListeners = []
+_executor = CommandExecutor()
+#process groups of the commands running in this process
+_runningGroups = set()
+_runningGroupsLock = threading.Lock()
+_metrics = CommandMetrics()
+
+def setToolServer(toolServer):
+    """Sets the tool server used by runJavaTool. None - do not use a server.
+    """
+    global _toolServer
+    _toolServer = toolServer
+
+def getToolServer():
+    return _toolServer
+
+def setExecutor(executor):
+    """Sets the CommandExecutor limiting the commands run at the same time.
+    """
+    global _executor
+    _executor = executor
+
+def getExecutor():
+    return _executor
+
+def setCommandMetrics(metrics):
+    """Sets the CommandMetrics every finished command is recorded in.
+    """
+    global _metrics
+    _metrics = metrics
+
+def getCommandMetrics():
+    return _metrics
+
+def addUsageListener(listener):
+    """Registers a function called as listener(cmd, wallTime, rusage) after
+    each command run in a subprocess, in the thread that has run the command
+    (the calling thread of runCommand). cmd is the command as a string (see
+    formatCommand), rusage is the resource usage of the command (see 
+    resource.getrusage) or None if it is not available.
+    """
+    _usageListeners.append(listener)
+
+def removeUsageListener(listener):
+    if listener in _usageListeners:
+        _usageListeners.remove(listener)
+
+def runJavaTool(cmd, classpath, mainClass, args, timeout_time=None, tail_lines=None,
+                priority=PRIORITY_NORMAL, tool=None):
+    """Runs a java tool in the tool server if it is set. Falls back to running
+    the given shell command in a subprocess if the server is unavailable.
 
     Args:
-        cmd: shell command to run
+        cmd: command (argv list or shell command string, see runCommand) 
+            that starts the tool in a separate JVM
+        classpath: list of jar files of the tool
+        mainClass: the name of the main class of the tool. If None, the class
+            is taken from the manifest of the first classpath entry.
+        args: list of arguments of the tool
+        timeout_time: time in seconds to wait for command to run before 
+            aborting (subprocess mode only).
+        tail_lines: if set, only the last tail_lines lines of each output 
+            stream are kept (subprocess mode only, see runStreaming)
+        priority: priority of the subprocess among the waiting JVM tools
+        tool: name of the tool in the command metrics (default: the name of
+            the main class or of the first classpath entry, see runCommand)
+    Returns:
+        tuple (return code, output of command)
+    """
+    if tool is None and mainClass:
+        tool = mainClass.split(".")[-1]
+    elif tool is None and classpath:
+        tool = os.path.splitext(os.path.basename(classpath[0]))[0]
+    toolServer = _toolServer
+    if toolServer:
+        start_time = time.time()
+        try:
+            (returnCode, output) = toolServer.runJavaTool(classpath, mainClass, args)
+        except ToolServerUnavailableException as e:
+            logger.warning("[COMMANDER] Tool server is unavailable, running in a subprocess. %s" % e.msg)
+        else:
+            #the server JVM is shared, so the tool has no resource usage of its own
+            _recordMetrics(cmd, RESOURCE_JVM, tool, returnCode, False, time.time() - start_time, None)
+            return (returnCode, output)
+    if tail_lines:
+        return _toReturnCodeAndOutput(runStreaming(cmd, timeout_time=timeout_time, tail_lines=tail_lines,
+                                                   resource=RESOURCE_JVM, priority=priority, tool=tool))
+    return runOnce(cmd, timeout_time=timeout_time, resource=RESOURCE_JVM, priority=priority, tool=tool)
+
+def runOnce(cmd, timeout_time=None, return_output=True, stdin_input=None, 
+            resource=RESOURCE_PROCESS, priority=PRIORITY_NORMAL, tool=None):
+    """Spawns a subprocess to run the given command.
+
+    Args:
+        cmd: command to run (argv list or shell command string, see runCommand)
         timeout_time: time in seconds to wait for command to run before aborting.
         return_output: if True return output of command as string. Otherwise,
             direct output of command to stdout.
         stdin_input: data to feed to stdin
+        resource, priority, tool: see runCommand
+    Returns:
+        tuple (return code, output of command). The output is the standard
+        output followed by the standard error. The return code is
+        TIMEOUT_ERROR_VALUE if the command has been killed after the timeout.
+    """
+    result = runCommand(cmd, timeout_time=timeout_time, return_output=return_output, 
+                        stdin_input=stdin_input, resource=resource, priority=priority, tool=tool)
+    return _toReturnCodeAndOutput(result)
+
+def runCommand(cmd, timeout_time=None, return_output=True, stdin_input=None, 
+               resource=RESOURCE_PROCESS, priority=PRIORITY_NORMAL, tool=None):
+    """Runs the given command in its own process group and waits until it
+    finishes or the timeout expires. The output pipes are read as the data
+    arrive, so the end of the command is noticed without polling. After the
+    timeout the whole process group (the command and the tools started by 
+    it) is killed.
+    
+    The command is run in the calling thread once the executor (see 
+    setExecutor) has a free slot of the resource. Its exit code, wall time,
+    CPU time and peak RSS are recorded in the command metrics (see 
+    getCommandMetrics).
+
+    Args:
+        cmd: argv list of the command, executed directly without a shell; or
+            a shell command string, run by /bin/bash (only for the commands
+            that need shell features such as pipes or redirections)
+        timeout_time: time in seconds to wait for command to run before 
+            killing it. The time waited for a slot is not counted.
+        return_output: if True collect standard output and standard error of
+            the command. Otherwise, they go to the ones of this process.
+        stdin_input: data to feed to stdin
+        resource: resource class of the command (e.g., RESOURCE_JVM) or a 
+            resource of a class (e.g., the device of adb commands, see
+            command_executor.deviceResource)
+        priority: commands waiting for the resource are started in the order
+            of their priority (lower values first)
+        tool: name of the tool in the command metrics (default: the name of
+            the executable)
+    Returns:
+        CommandResult
+    """
+    return _executor.call(lambda: _runCollected(cmd, timeout_time, return_output, stdin_input,
+                                                resource, tool),
+                          resource, priority)
+
+def submitCommand(cmd, timeout_time=None, return_output=True, stdin_input=None, 
+                  resource=RESOURCE_PROCESS, priority=PRIORITY_NORMAL, tool=None):
+    """Runs the given command like runCommand but in a thread of the executor,
+    so independent commands can overlap.
+
+    Returns:
+        CommandFuture of CommandResult (see command_executor.toAsyncioFuture 
+        for awaiting it in an event loop)
+    """
+    return _executor.submit(lambda: _runCollected(cmd, timeout_time, return_output, stdin_input,
+                                                  resource, tool),
+                            resource, priority)
+
+def runStreaming(cmd, lineCallback=None, timeout_time=None, tail_lines=DEFAULT_TAIL_LINES, 
+                 tee_path=None, stdin_input=None, resource=RESOURCE_PROCESS, 
+                 priority=PRIORITY_NORMAL, tool=None):
+    """Runs the given command like runCommand but does not keep its whole
+    output. The lines are passed to the callback as they arrive, only
+    the last ones are kept for error messages, so the memory used does not
+    grow with the length of the output.
+
+    Args:
+        cmd: argv list or shell command string (see runCommand)
+        lineCallback: function called as lineCallback(stream, line) for each
+            line (without the line break) of the output; stream is 
+            STREAM_STDOUT or STREAM_STDERR
+        timeout_time: time in seconds to wait for command to run before 
+            killing it.
+        tail_lines: number of the last lines of each stream kept in the result
+        tee_path: path to a gzip file the whole output (both streams, 
+            interleaved by lines) is written to
+        stdin_input: data to feed to stdin
+        resource, priority, tool: see runCommand
     Returns:
-        output of command
+        CommandResult with the last lines of standard output and standard 
+        error
     """
+    return _executor.call(lambda: _runStreaming(cmd, lineCallback, timeout_time, tail_lines, 
+                                                tee_path, stdin_input, resource, tool), 
+                          resource, priority)
+
+def submitStreaming(cmd, lineCallback=None, timeout_time=None, tail_lines=DEFAULT_TAIL_LINES, 
+                    tee_path=None, stdin_input=None, resource=RESOURCE_PROCESS, 
+                    priority=PRIORITY_NORMAL, tool=None):
+    """Runs the given command like runStreaming but in a thread of the 
+    executor; the callback is called in that thread.
 
+    Returns:
+        CommandFuture of CommandResult
+    """
+    return _executor.submit(lambda: _runStreaming(cmd, lineCallback, timeout_time, tail_lines, 
+                                                  tee_path, stdin_input, resource, tool), 
+                            resource, priority)
+
+def killRunningCommands():
+    """Kills the process groups of all commands running in this process, 
+    e.g., when the threads that have started them are abandoned after an
+    interrupt. The killed commands return as if they had been killed after 
+    a timeout.
+    """
+    with _runningGroupsLock:
+        for pgid in _runningGroups:
+            _killProcessGroup(pgid)
+
+def formatCommand(cmd):
+    """Returns the command as a string that can be pasted into a shell (e.g.,
+    for logging). Shell command strings are returned unchanged.
+    """
+    if isinstance(cmd, basestring):
+        return cmd
+    return " ".join([pipes.quote(arg) for arg in cmd])
+
+def killSession(leaderPid):
+    """Kills all processes of the session led by the given process (e.g., a
+    worker which has called os.setsid) including the sessions or process
+    groups created by runCommand for the commands the worker has run.
+    """
+    pids = []
+    try:
+        output = subprocess.Popen(["ps", "-e", "-o", "pid=,ppid=,sess="], 
+                                  stdout=subprocess.PIPE).communicate()[0]
+        processes = [line.split() for line in output.splitlines() if len(line.split()) == 3]
+        children = {}
+        sessions = {}
+        for (pid, ppid, sess) in processes:
+            children.setdefault(ppid, []).append(pid)
+            sessions[pid] = sess
+        #the sessions of the leader and of the commands started by it
+        killedSessions = set()
+        visited = set()
+        pending = [str(leaderPid)]
+        while pending:
+            pid = pending.pop()
+            if pid in visited:
+                continue
+            visited.add(pid)
+            if pid in sessions:
+                killedSessions.add(sessions[pid])
+            pending.extend(children.get(pid, []))
+        killedSessions.discard(str(os.getsid(0)))
+        pids = [int(pid) for (pid, _, sess) in processes if sess in killedSessions]
+    except (OSError, ValueError):
+        pass
+    _killProcessGroup(leaderPid)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            # process already dead. No action required.
+            pass
+
+
+class CommandResult:
+    """Result of a command run by runCommand or runStreaming. stdout and 
+    stderr are empty if the output has not been collected.
+    """
+    def __init__(self, returnCode, stdout, stderr, timedOut):
+        self.returnCode = returnCode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timedOut = timedOut
+
+
+def _runCollected(cmd, timeout_time, return_output, stdin_input, resource, tool):
+    if not return_output:
+        return _runCommand(cmd, timeout_time, stdin_input, None, None, resource, tool)
+    return _runCommand(cmd, timeout_time, stdin_input, _CollectedOutput(), _CollectedOutput(),
+                       resource, tool)
+
+def _runStreaming(cmd, lineCallback, timeout_time, tail_lines, tee_path, stdin_input, resource, tool):
+    tee = gzip.open(tee_path, "wb") if tee_path else None
+    try:
+        return _runCommand(cmd, timeout_time, stdin_input,
+                           _LineStream(STREAM_STDOUT, lineCallback, tail_lines, tee),
+                           _LineStream(STREAM_STDERR, lineCallback, tail_lines, tee),
+                           resource, tool)
+    finally:
+        if tee:
+            tee.close()
+
+def _runCommand(cmd, timeout_time, stdin_input, stdoutSink, stderrSink, resource, tool):
     start_time = time.time()
-    so = []
-    pid = []
-    return_code = [] # hack to store results from a nested function
+    deadline = None
+    if timeout_time is not None:
+        deadline = start_time + timeout_time
     
-    #TODO: Need to refactor this part. Subprocess need to return separate output
-    #      for standard output and standard error.
-    def Run():
-        if return_output:
-            output_dest = subprocess.PIPE
-        else:
-            # None means direct to stdout
-            output_dest = None
-        if stdin_input:
-            stdin_dest = subprocess.PIPE
-        else:
-            stdin_dest = None
-        
-        pipe = subprocess.Popen(
-                cmd,
-                executable='/bin/bash',
+    shell = isinstance(cmd, basestring)
+    cmdString = formatCommand(cmd)
+    logger.debug("[COMMANDER] About to run cmd: %s" % cmdString)
+    output_dest = subprocess.PIPE if stdoutSink else None
+    stdin_dest = subprocess.PIPE if stdin_input else None
+    args = ["/bin/bash", "-c", cmd] if shell else cmd
+    preexec_fn = None
+    if SETSID_PATH:
+        args = [SETSID_PATH] + args
+    else:
+        #preexec_fn runs python code in the forked child, which can deadlock
+        #on the locks held by other threads at the fork; os.setpgrp takes
+        #no locks, but setsid is preferred whenever it is installed
+        preexec_fn = os.setpgrp
+    try:
+        pipe = _RusagePopen(
+                args,
                 stdin=stdin_dest,
                 stdout=output_dest,
-                stderr=subprocess.STDOUT,
-                shell=True)
-        pid.append(pipe.pid)
+                stderr=output_dest,
+                close_fds=True,
+                preexec_fn=preexec_fn)
+    except OSError as e:
+        if shell or e.errno not in EXEC_ERROR_CODES:
+            raise
+        #the same result as the one of bash
+        logger.debug("[COMMANDER] Cannot execute %s: %s" % (cmd[0], e.strerror))
+        _recordMetrics(cmd, resource, tool, EXEC_ERROR_CODES[e.errno], False, time.time() - start_time, None)
+        return CommandResult(EXEC_ERROR_CODES[e.errno], "", "%s: %s\n" % (cmd[0], e.strerror), False)
+    
+    sinks = {}
+    if stdoutSink:
+        sinks = {pipe.stdout : stdoutSink, pipe.stderr : stderrSink}
+    with _runningGroupsLock:
+        _runningGroups.add(pipe.pid)
+    try:
+        timedOut = _communicate(pipe, stdin_input, deadline, sinks)
+        if timedOut:
+            _killProcessGroup(pipe.pid)
+        else:
+            timedOut = not pipe.waitUntil(deadline)
+        pipe.wait()
+    except BaseException:
+        #the tools must not outlive an interrupted run
+        _killProcessGroup(pipe.pid)
+        pipe.wait()
+        raise
+    finally:
+        with _runningGroupsLock:
+            _runningGroups.discard(pipe.pid)
+    
+    stdout = stdoutSink.getvalue() if stdoutSink else ""
+    stderr = stderrSink.getvalue() if stderrSink else ""
+    result = CommandResult(pipe.returncode, stdout, stderr, timedOut)
+    wallTime = time.time() - start_time
+    logger.debug("[COMMANDER] Finished! Return code: %d, %s, Output: %s" % 
+                 (result.returnCode, _formatUsage(wallTime, pipe.rusage), _truncateOutput(stdout + stderr)))
+    _recordMetrics(cmd, resource, tool, result.returnCode, timedOut, wallTime, pipe.rusage)
+    for listener in list(_usageListeners):
+        listener(cmdString, wallTime, pipe.rusage)
+    return result
+
+def _communicate(pipe, stdin_input, deadline, sinks):
+    """Feeds stdin and passes the data read from stdout and stderr of the 
+    process to their sinks until the pipes are closed or the deadline is 
+    reached.
+
+    Returns:
+        True if the deadline has been reached
+    """
+    readers = list(sinks.keys())
+    writers = [pipe.stdin] if pipe.stdin else []
+    written = 0
+    timedOut = False
+    while readers or writers:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                timedOut = True
+                break
         try:
-            output = pipe.communicate(input=stdin_input)[0]
-            if output is not None and len(output) > 0:
-                so.append(output)
-        except OSError, e:
-            so.append("ERROR: OSError!")
-        return_code.append(pipe.returncode)
+            (readable, writable, _) = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for f in writable:
+            try:
+                written += os.write(f.fileno(), stdin_input[written:written + select.PIPE_BUF])
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                written = len(stdin_input)
+            if written >= len(stdin_input):
+                f.close()
+                writers.remove(f)
+        for f in readable:
+            data = os.read(f.fileno(), READ_SIZE)
+            if data:
+                sinks[f].write(data)
+            else:
+                f.close()
+                readers.remove(f)
+    for f in readers + writers:
+        f.close()
+    for sink in sinks.values():
+        sink.close()
+    return timedOut
+
+def _recordMetrics(cmd, resource, tool, returnCode, timedOut, wallTime, rusage):
+    #the category is the resource class, the device - the rest of the resource
+    (category, _, device) = resource.partition(":")
+    if tool is None:
+        args = cmd.split() if isinstance(cmd, basestring) else cmd
+        tool = os.path.basename(args[0]) if args else ""
+    _metrics.record(category, tool, device, returnCode, timedOut, wallTime, rusage)
+
+def _formatUsage(wallTime, rusage):
+    if rusage is None:
+        return "wall: %.3fs" % wallTime
+    return "wall: %.3fs, user: %.3fs, sys: %.3fs, max RSS: %d KB" % \
+        (wallTime, rusage.ru_utime, rusage.ru_stime, maxRssToBytes(rusage.ru_maxrss) // 1024)
+
+def _toReturnCodeAndOutput(result):
+    output = result.stdout + result.stderr
+    if result.timedOut:
+        output += "ERROR: Timeout!"
+        return (TIMEOUT_ERROR_VALUE, output)
+    return (result.returnCode, output)
+
+def _truncateOutput(output):
+    if len(output) <= LOGGED_OUTPUT_LIMIT:
+        return output
+    return "[%d characters skipped]...%s" % (len(output) - LOGGED_OUTPUT_LIMIT, output[-LOGGED_OUTPUT_LIMIT:])
+
+def _killProcessGroup(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        # process already dead. No action required.
+        pass
+
+
+class _CollectedOutput:
+    """Sink of _communicate keeping the whole output.
+    """
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(data)
     
-    logger.debug("[COMMANDER] About to run cmd: %s" % cmd) 
+    def close(self):
+        pass
     
-    t = threading.Thread(target=Run)
-    t.start()
+    def getvalue(self):
+        return "".join(self._chunks)
+
+
+class _LineStream:
+    """Sink of _communicate splitting the output into lines. Each line is
+    passed to the callback and written to the tee file, only the last 
+    maxLines lines are kept.
+    """
+    def __init__(self, stream, lineCallback, maxLines, tee):
+        self.stream = stream
+        self.lineCallback = lineCallback
+        self.tee = tee
+        self._tail = deque(maxlen=maxLines)
+        self._partial = ""
     
-    break_loop = False
-    while not break_loop:
-        if not t.isAlive():
-            break_loop = True
-
-        # Check the timeout
-        if (not break_loop and timeout_time is not None
-                and time.time() > start_time + timeout_time):
+    def write(self, data):
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        while len(self._partial) > MAX_LINE_LENGTH:
+            lines.append(self._partial[:MAX_LINE_LENGTH])
+            self._partial = self._partial[MAX_LINE_LENGTH:]
+        for line in lines:
+            self._addLine(line)
+    
+    def close(self):
+        if self._partial:
+            self._addLine(self._partial)
+            self._partial = ""
+    
+    def getvalue(self):
+        return "".join(["%s\n" % line for line in self._tail])
+    
+    def _addLine(self, line):
+        line = line.rstrip("\r")
+        self._tail.append(line)
+        if self.tee:
+            self.tee.write("%s\n" % line)
+        if self.lineCallback:
+            self.lineCallback(self.stream, line)
+
+
+class _RusagePopen(subprocess.Popen):
+    """Popen that collects the resource usage of the finished process.
+    """
+    rusage = None
+    
+    def wait(self):
+        while self.returncode is None:
             try:
-                os.kill(pid[0], signal.SIGKILL)
-            except OSError:
-                # process already dead. No action required.
-                pass
-            so.append("ERROR: Timeout!")
-            return_code[0] = TIMEOUT_ERROR_VALUE
-        if not break_loop:
-            time.sleep(0.1)
-
-    t.join()
-    output = "".join(so)
+                (_, sts, self.rusage) = os.wait4(self.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                #the process has been reaped by somebody else
+                sts = 0
+            self._handle_exitstatus(sts)
+        return self.returncode
     
-    logger.debug("[COMMANDER] Finished! Return code: %d, Output: %s" % (return_code[0], output))
-    #TODO: Add throw timeout exception    
-    return (return_code[0], output)
+    def waitUntil(self, deadline):
+        """Waits for the process until the deadline (None - no deadline). The
+        process has normally exited when its output is closed; otherwise a
+        timer kills its process group at the deadline.
+        
+        Returns:
+            False if the process has been killed at the deadline
+        """
+        if deadline is None or self.returncode is not None:
+            self.wait()
+            return True
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            (pid, sts, rusage) = (self.pid, 0, None)
+        if pid:
+            self.rusage = rusage
+            self._handle_exitstatus(sts)
+            return True
+        timedOut = threading.Event()
+        def kill():
+            timedOut.set()
+            _killProcessGroup(self.pid)
+        timer = threading.Timer(max(0, deadline - time.time()), kill)
+        timer.start()
+        try:
+            self.wait()
+        finally:
+            timer.cancel()
+        return not timedOut.is_set()
 
 
 #Exceptions
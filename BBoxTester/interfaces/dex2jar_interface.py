@@ -1,4 +1,5 @@
 import os
+import shlex
 import commander
 
 
@@ -16,12 +17,13 @@ class Dex2JarInterface:
         return ":".join(classpathList)
     
     def _previewDex2JarCommand(self, className, parameters):
-        cmd = "%s %s" % (className, parameters)
+        cmd = [className] + parameters
         return cmd
     
-    def _runCommand(self, cmdString):
-        cmd = "'%s' %s -classpath '%s' %s" % (self.javaPath, self.javaOpts, self.classpath, cmdString)
-        return commander.runOnce(cmd)
+    def _runCommand(self, args):
+        cmd = [self.javaPath] + shlex.split(self.javaOpts) + ["-classpath", self.classpath] + args
+        return commander.runJavaTool(cmd, classpath=self.classpath.split(":"), mainClass=args[0], args=args[1:],
+                                     tool="dex2jar")
     
     def _interpResultsDex2JarCmd(self, returnCode, outputStr):
         '''
@@ -49,15 +51,15 @@ class Dex2JarInterface:
             force:
         Returns:
         '''
-        options=""
+        options = []
         if output:
-            options += " -o '%s'" % output
+            options += ["-o", output]
         if force:
-            options += " -f"
+            options.append("-f")
         if debug_info:
-            options += " -d"
+            options.append("-d")
         
-        opts = "%s '%s'" % (options, source)
+        opts = options + [source]
         cmd = self._previewDex2JarCommand(self.classDex2Jar, opts)
         
         (returnCode, outputStr) = self._runCommand(cmd)
@@ -85,13 +87,13 @@ class Dex2JarInterface:
     
     
     def apkSign(self, source, output=None, force=True):
-        options=""
+        options = []
         if output:
-            options += " -o '%s'" % output
+            options += ["-o", output]
         if force:
-            options += " -f"
+            options.append("-f")
         
-        opts = "%s %s" % (options, source)
+        opts = options + [source]
         cmd = self._previewDex2JarCommand(self.classApksign, opts)
         (returnCode, outputStr) = self._runCommand(cmd)
         
@@ -1,4 +1,5 @@
 import os
+import shlex
 import commander
 
 
@@ -12,7 +13,7 @@ class DxInterface:
 
     def _previewDexCmd(self, action, options):
         path = os.path.join(self.pathDx, self.jarDx)
-        cmd = "%s %s %s" % (path, action, options)
+        cmd = [path, action] + options
         return cmd
     
     
@@ -25,23 +26,28 @@ class DxInterface:
         return (True, None)
     
     
-    def dex(self, inFiles, output, noLocals=False):
+    def dex(self, inFiles, output, noLocals=False, multiDex=False, mainDexList=None):
         """
         There are a number of other options of dx tool. However, here we do not
         use them, because we do not need them
+        
+        In multidex mode the output must be a directory; the classes listed in
+        the mainDexList file are put into the primary dex file.
         """
-        options = ""
+        options = []
         if noLocals:
-            options += " --no-locals"
+            options.append("--no-locals")
+        if multiDex:
+            options.append("--multi-dex")
+        if mainDexList:
+            options.append("--main-dex-list=" + mainDexList)
         
         # TODO: dx does not create folder. Thus, if you specify the folder that do not exist
         # dx tool will not create it and you will receive and error. This can be corrected by 
         # adding additional code for folder creation 
-        options += " --output='" + output + "'"
+        options.append("--output=" + output)
         
-        options += " "
-        for inFile in inFiles:
-            options += "'" + inFile + "' "
+        options += inFiles
         
         dexCmd = self._previewDexCmd("--dex", options)
         (result_code, outputStr) = self._runDxCommand(dexCmd)
@@ -49,7 +55,8 @@ class DxInterface:
         return self._interpResultsDexCmd(result_code, outputStr)
         
     
-    def _runDxCommand(self, commandString):
-        cmd = "'%s' %s -jar %s" % (self.javaPath, self.javaOpts, commandString)
-        return commander.runOnce(cmd)
+    def _runDxCommand(self, args):
+        cmd = [self.javaPath] + shlex.split(self.javaOpts) + ["-jar"] + args
+        return commander.runJavaTool(cmd, classpath=[args[0]], mainClass=None, args=args[1:],
+                                     tool="dx")
     
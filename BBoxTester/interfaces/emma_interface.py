@@ -1,4 +1,5 @@
 import os
+import shlex
 import commander
 
 class EMMA_OUTMODE:
@@ -23,14 +24,15 @@ class EmmaInterface:
         self.jarEmma = jarEmma
         self.jarEmmaDevice = jarEmmaDevice
     
-    def _runEmmaCommand(self, commandString):
-        cmd = "'%s' %s -cp %s" % (self.javaPath, self.javaOpts, commandString)
-        return commander.runOnce(cmd)
+    def _runEmmaCommand(self, args):
+        cmd = [self.javaPath] + shlex.split(self.javaOpts) + ["-cp"] + args
+        return commander.runJavaTool(cmd, classpath=[args[0]], mainClass=args[1], args=args[2:],
+                                     tool="emma")
     
 
     def _previewEmmaCmd(self, action, options):
         path = os.path.join(self.pathEmma, self.jarEmma)
-        cmd = "'%s' %s %s" % (path, action, options)
+        cmd = [path, "emma", action] + options
         return cmd
     
     
@@ -63,38 +65,73 @@ class EmmaInterface:
         
         Returns:
         '''
-        options = ""
+        options = []
         if instrpaths:
-            options += " -instrpath "
-            for pth in instrpaths:
-                options += "'%s'," % pth
-            options = options[0:-1]
+            options += ["-instrpath", ",".join(instrpaths)]
         
         if outdir:
-            options += " -outdir '%s'" % outdir
+            options += ["-outdir", outdir]
         
         if emmaMetadataFile:
-            options +=  " -outfile '%s'" % emmaMetadataFile
+            options += ["-outfile", emmaMetadataFile]
         
-        options += " -merge %s" % merge
-        options += " -outmode %s" % outmode
+        options += ["-merge", merge]
+        options += ["-outmode", outmode]
         
         if commonOptions:
             for entry in commonOptions.iteritems():
-                options += " -D%s=%s" % entry
+                options.append("-D%s=%s" % entry)
         
         if filters:
-            options += " -filter "
-            for fltr in filters:
-                options += "%s," % fltr
-            options = options[0:-1]
+            options += ["-filter", ",".join(filters)]
         
-        cmd = self._previewEmmaCmd("emma instr", options)
+        cmd = self._previewEmmaCmd("instr", options)
         (returnCode, outputStr) = self._runEmmaCommand(cmd)
         
         return self._interpResultsEmmaInstrCmd(returnCode, outputStr)
     
     
+    def _interpResultsEmmaMergeCmd(self, returnCode, outputStr):
+        retCode = "Return code is: %s" % returnCode
+        #NOTE: later we can select different routines to process different errors
+        if returnCode == 1:
+            output = "%s\n%s\n%s" % (retCode, "Failure due to incorrect option usage. This error code is also returned when command line usage (-h) is requested explicitly.", outputStr)
+            return (False, output)
+        if returnCode == 2:
+            output = "%s\n%s\n%s" % (retCode, "Unknown failure happened.", outputStr)
+            return (False, output)
+        return (True, None)
+
+
+    def merge(self, inputs=[], outfile=None, commonOptions={}):
+        '''
+        Merges several metadata (or runtime coverage) files into one. The
+        description of the command can be found here:
+        http://emma.sourceforge.net/reference/ch02s05s03.html
+
+        Args:
+            :param inputs: list of metadata/coverage files to merge
+            :param outfile: the path to the resulting merged file
+            :param commonOptions:
+
+        Returns:
+        '''
+        options = []
+        if inputs:
+            options += ["-input", ",".join(inputs)]
+
+        if outfile:
+            options += ["-outfile", outfile]
+
+        if commonOptions:
+            for entry in commonOptions.iteritems():
+                options.append("-D%s=%s" % entry)
+
+        cmd = self._previewEmmaCmd("merge", options)
+        (returnCode, outputStr) = self._runEmmaCommand(cmd)
+        return self._interpResultsEmmaMergeCmd(returnCode, outputStr)
+
+
     def _interpResultsEmmaReportCmd(self, returnCode, outputStr):
         retCode = "Return code is: %s" % returnCode
         #NOTE: later we can select different routines to process different errors
@@ -116,26 +153,20 @@ class EmmaInterface:
         :param commonOptions:
         '''
         """Genoptions can be seen here: http://emma.sourceforge.net/reference/ch03s02.html#prop-ref.report.out.file"""
-        options = ""
+        options = []
         if inputs:
-            options += " -input "
-            for f in inputs:
-                options += f + ","
-            options = options[0:-1]
+            options += ["-input", ",".join(inputs)]
         
-        options += " -report " + report
+        options += ["-report", report]
         
         if sourcepath:
-            options +=  " -sourcepath "
-            for src in sourcepath:
-                options += src + ","
-            options = options[0:-1]
+            options += ["-sourcepath", ",".join(sourcepath)]
         
         if commonOptions:
             for entry in commonOptions.iteritems():
-                options += " -D" + entry[0] + "=" + entry[1]
+                options.append("-D%s=%s" % entry)
         
-        cmd = self._previewEmmaCmd("emma report", options)
+        cmd = self._previewEmmaCmd("report", options)
         (returnCode, outputStr) = self._runEmmaCommand(cmd)
         return self._interpResultsEmmaReportCmd(returnCode, outputStr)
     
@@ -152,20 +183,14 @@ class EmmaInterface:
         
         Returns:
         '''
-        options = ""
+        options = []
         if inputs:
-            options += " -input "
-            for f in inputs:
-                options += f + ","
-            options = options[0:-1]
+            options += ["-input", ",".join(inputs)]
         
-        options += " -report " + report
+        options += ["-report", report]
         
         if sourcepath:
-            options +=  " -sourcepath "
-            for src in sourcepath:
-                options += src + ","
-            options = options[0:-1]
+            options += ["-sourcepath", ",".join(sourcepath)]
         
         if toDir:
             if report == EMMA_REPORT.HTML:
@@ -177,13 +202,13 @@ class EmmaInterface:
             elif report == EMMA_REPORT.TXT:
                 opt = "report.txt.out.file"
                 value = os.path.join(toDir, "coverage.txt")
-            options  += " -D%s=%s" % (opt, value)
+            options.append("-D%s=%s" % (opt, value))
         
         if commonoptions:
             for entry in commonoptions.iteritems():
-                options += " -D" + entry[0] + "=" + entry[1]
+                options.append("-D%s=%s" % entry)
         
-        cmd = self._previewEmmaCmd("emma report", options)
+        cmd = self._previewEmmaCmd("report", options)
         (returnCode, outputStr) = self._runEmmaCommand(cmd)
         return self._interpResultsEmmaReportCmd(returnCode, outputStr)
 
@@ -202,20 +227,14 @@ class EmmaInterface:
         
         Returns:
         '''
-        options = ""
+        options = []
         if inputs:
-            options += " -input "
-            for f in inputs:
-                options += f + ","
-            options = options[0:-1]
+            options += ["-input", ",".join(inputs)]
         
-        options += " -report " + report
+        options += ["-report", report]
         
         if sourcepath:
-            options +=  " -sourcepath "
-            for src in sourcepath:
-                options += src + ","
-            options = options[0:-1]
+            options += ["-sourcepath", ",".join(sourcepath)]
         
         if not mainFileName:
             mainFileName = "coverage"
@@ -231,13 +250,13 @@ class EmmaInterface:
         elif report == EMMA_REPORT.TXT:
             opt = "report.txt.out.file"
             value = os.path.join(toDir, "%s.txt" % mainFileName)
-        options  += " -D%s=%s" % (opt, value)
+        options.append("-D%s=%s" % (opt, value))
         
         if commonoptions:
             for entry in commonoptions.iteritems():
-                options += " -D" + entry[0] + "=" + entry[1]
+                options.append("-D%s=%s" % entry)
         
-        cmd = self._previewEmmaCmd("emma report", options)
+        cmd = self._previewEmmaCmd("report", options)
         (returnCode, outputStr) = self._runEmmaCommand(cmd)
         return self._interpResultsEmmaReportCmd(returnCode, outputStr)
 
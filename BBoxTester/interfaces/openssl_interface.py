@@ -0,0 +1,40 @@
+import os
+from interfaces import commander
+
+
+class OpenSslInterface:
+    def __init__(self, exeOpenssl="openssl"):
+        self.exeOpenssl = exeOpenssl
+
+
+    def signPkcs7(self, dataFile, certFile, keyFile, outFile, digest="sha1"):
+        '''
+        Creates detached PKCS#7 signature of the data file without signed
+        attributes (the format of the signature block of jar files).
+
+        Args:
+            :param dataFile: path to the file to sign
+            :param certFile: path to the signer certificate (PEM)
+            :param keyFile: path to the private key (PEM)
+            :param outFile: path to the DER encoded signature
+            :param digest: name of the digest algorithm
+        '''
+        options = ["smime", "-sign", "-binary", "-noattr", "-md", digest, "-outform", "DER"]
+        options += ["-in", dataFile, "-signer", certFile, "-inkey", keyFile, "-out", outFile]
+        cmd = self._previewOpensslCmd(options)
+        (returnCode, output) = self._runOpensslCommand(cmd)
+        return self._interpretOpensslCmdResults(returnCode, output, outFile)
+
+
+    def _previewOpensslCmd(self, options):
+        opensslCommand = [self.exeOpenssl] + options
+        return opensslCommand
+
+    def _runOpensslCommand(self, cmd):
+        return commander.runOnce(cmd)
+
+    def _interpretOpensslCmdResults(self, returnCode, output, outFile):
+        output = "Return code is: [%s].\nCommand output: %s" % (returnCode, output)
+        if returnCode or not os.path.isfile(outFile):
+            return (False, output)
+        return (True, output)
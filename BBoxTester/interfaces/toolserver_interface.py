@@ -0,0 +1,263 @@
+'''
+Client for the long-living JVM tool server (see BBoxTester_ToolServer_Sources).
+
+The server loads the jars of the java tools (apktool, dex2jar, dx, Emma) once
+and runs their main methods on request, so the subsequent invocations do not
+pay for the JVM start and JIT warm-up. Every start of the server gets a new
+random token (passed to it through its standard input); the server rejects
+the requests without the token, so other local users cannot run code in it.
+'''
+import os
+import binascii
+import select
+import shlex
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from bbox_core.general_exceptions import MsgException
+from logconfig import logger
+
+
+CMD_PING = "__ping__"
+CMD_SHUTDOWN = "__shutdown__"
+
+RESPONSE_HEADER = ">iqi" #return code, used heap, output length
+TOKEN_BYTES = 16
+
+
+class ToolServerInterface:
+    def __init__(self, javaPath="java", javaOpts="-Xms512m -Xmx2048m", pathToolServer="./auxiliary/toolserver", jarToolServer="toolserver.jar", memoryThreshold=1536, startTimeout=60):
+        '''
+        Args:
+            :param javaPath: java executable used to start the server
+            :param javaOpts: options of the server JVM
+            :param pathToolServer: directory with the server jar
+            :param jarToolServer: name of the server jar
+            :param memoryThreshold: the server is restarted when its used heap
+                exceeds this value (in MB) after a request
+            :param startTimeout: time in seconds to wait for the server start
+        '''
+        self.javaPath = javaPath
+        self.javaOpts = javaOpts
+        self.pathToToolServer = os.path.join(pathToolServer, jarToolServer)
+        self.memoryThreshold = memoryThreshold * 1024 * 1024
+        self.startTimeout = startTimeout
+
+        self._process = None
+        self._port = None
+        self._token = None
+        self._ownerPid = None
+        self._activeRequests = 0
+        self._restartRequested = False
+        self._lock = threading.Condition()
+
+    def isAvailable(self):
+        return os.path.isfile(self.pathToToolServer)
+
+    def isRunning(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        '''
+        Starts the server and waits until it reports the port it listens to.
+
+        Raises:
+            ToolServerUnavailableException: if the server cannot be started
+        '''
+        with self._lock:
+            self._start()
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def restart(self):
+        with self._lock:
+            while self._activeRequests > 0:
+                self._lock.wait()
+            self._stop()
+            self._start()
+
+    def runJavaTool(self, classpath, mainClass, args):
+        '''
+        Runs the main method of a java tool in the server JVM.
+
+        Args:
+            :param classpath: list of jar files of the tool
+            :param mainClass: the name of the main class. If None, the class is
+                taken from the manifest of the first classpath entry
+            :param args: list of the arguments passed to the main method
+
+        Returns:
+            :ret tuple (returnCode, output) similar to commander.runOnce
+
+        Raises:
+            ToolServerUnavailableException: if the server does not respond
+                and cannot be restarted
+        '''
+        logger.debug("[TOOLSERVER] About to run: %s %s" % (mainClass, " ".join(args)))
+        with self._lock:
+            #new requests would keep a requested restart waiting forever
+            while self._restartRequested:
+                self._lock.wait()
+            if not self.isRunning():
+                self._restartCrashed()
+            self._activeRequests += 1
+            (port, token) = (self._port, self._token)
+        try:
+            try:
+                (returnCode, usedHeap, output) = self._request(port, token, classpath, mainClass, args)
+            except (socket.error, EOFError) as e:
+                #the server has probably crashed: restart it and try once again
+                logger.warning("[TOOLSERVER] Request failed: %s" % str(e))
+                with self._lock:
+                    self._restartCrashed()
+                    (port, token) = (self._port, self._token)
+                try:
+                    (returnCode, usedHeap, output) = self._request(port, token, classpath, mainClass, args)
+                except (socket.error, EOFError) as e:
+                    raise ToolServerUnavailableException("Tool server does not respond: %s" % str(e))
+        finally:
+            with self._lock:
+                self._activeRequests -= 1
+                self._lock.notifyAll()
+
+        if usedHeap > self.memoryThreshold:
+            logger.debug("[TOOLSERVER] Used heap %d exceeds the threshold. Restarting the server..." % usedHeap)
+            self._requestRestart()
+
+        logger.debug("[TOOLSERVER] Finished! Return code: %d, Output: %s" % (returnCode, output))
+        return (returnCode, output)
+
+
+    def _request(self, port, token, classpath, mainClass, args):
+        sock = socket.create_connection(("127.0.0.1", port))
+        try:
+            request = [self._packUTF(token),
+                       self._packUTF(os.pathsep.join(classpath)),
+                       self._packUTF(mainClass or ""),
+                       struct.pack(">i", len(args))]
+            for arg in args:
+                request.append(self._packUTF(arg))
+            sock.sendall("".join(request))
+
+            header = self._recvExactly(sock, struct.calcsize(RESPONSE_HEADER))
+            (returnCode, usedHeap, outputLength) = struct.unpack(RESPONSE_HEADER, header)
+            output = self._recvExactly(sock, outputLength)
+        finally:
+            sock.close()
+        return (returnCode, usedHeap, output)
+
+    def _packUTF(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return struct.pack(">H", len(value)) + value
+
+    def _recvExactly(self, sock, length):
+        chunks = []
+        while length > 0:
+            chunk = sock.recv(min(length, 65536))
+            if not chunk:
+                raise EOFError("Connection closed by the tool server")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return "".join(chunks)
+
+    def _requestRestart(self):
+        with self._lock:
+            if self._restartRequested:
+                return
+            self._restartRequested = True
+            try:
+                while self._activeRequests > 0:
+                    self._lock.wait()
+                self._stop()
+                self._start()
+            finally:
+                self._restartRequested = False
+                self._lock.notifyAll()
+
+    def _restartCrashed(self):
+        if self._ownerPid != os.getpid():
+            #the server is owned by another (parent) process
+            raise ToolServerUnavailableException("Tool server is owned by process %s" % str(self._ownerPid))
+        if self._process is not None:
+            logger.warning("[TOOLSERVER] Tool server is not running. Restarting...")
+        self._stop()
+        self._start()
+
+    def _start(self):
+        if not self.isAvailable():
+            raise ToolServerUnavailableException("Cannot find tool server jar: %s" % self.pathToToolServer)
+
+        cmd = [self.javaPath] + shlex.split(self.javaOpts) + ["-jar", self.pathToToolServer, "0"]
+        logger.debug("[TOOLSERVER] Starting tool server: %s" % " ".join(cmd))
+        token = binascii.hexlify(os.urandom(TOKEN_BYTES))
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise ToolServerUnavailableException("Cannot start tool server: %s" % str(e))
+        try:
+            #not on the command line, which is visible to other users
+            process.stdin.write(token + "\n")
+            process.stdin.close()
+        except IOError as e:
+            process.kill()
+            raise ToolServerUnavailableException("Cannot pass the token to tool server: %s" % str(e))
+
+        deadline = time.time() + self.startTimeout
+        line = ""
+        while not line.endswith("\n"):
+            remaining = deadline - time.time()
+            ready = select.select([process.stdout], [], [], max(remaining, 0))[0]
+            if not ready:
+                process.kill()
+                raise ToolServerUnavailableException("Tool server has not started in %d seconds!" % self.startTimeout)
+            char = process.stdout.read(1)
+            if not char:
+                raise ToolServerUnavailableException("Tool server has exited during start: %s" % line)
+            line += char
+
+        if not line.startswith("PORT "):
+            process.kill()
+            raise ToolServerUnavailableException("Unexpected tool server output: %s" % line)
+
+        self._process = process
+        self._port = int(line.split()[1])
+        self._token = token
+        self._ownerPid = os.getpid()
+        self._restartRequested = False
+
+        #the output of the server not related to requests goes to the log
+        drainer = threading.Thread(target=self._drainOutput, args=(process,))
+        drainer.daemon = True
+        drainer.start()
+        logger.debug("[TOOLSERVER] Tool server is listening on port %d" % self._port)
+
+    def _stop(self):
+        if self._ownerPid != os.getpid():
+            return
+        if self.isRunning():
+            try:
+                self._request(self._port, self._token, [], CMD_SHUTDOWN, [])
+                self._process.wait()
+            except (socket.error, EOFError):
+                self._process.kill()
+                self._process.wait()
+        self._process = None
+        self._port = None
+        self._token = None
+
+    def _drainOutput(self, process):
+        for line in iter(process.stdout.readline, ""):
+            logger.debug("[TOOLSERVER] %s" % line.rstrip())
+
+
+#Exceptions
+class ToolServerUnavailableException(MsgException):
+    '''
+    Tool server cannot be started or does not respond.
+    '''
@@ -5,6 +5,7 @@ Created on Oct 1, 2014
 '''
 import os
 from interfaces import commander
+from interfaces.command_executor import RESOURCE_DISK
 
 
 
@@ -17,13 +18,13 @@ class ZipalignInterface:
     
     
     def align(self, inFile, outFile, alignment=4, verbose=True, overwrite=True):
-        options = ""
+        options = []
         if verbose:
-            options += " -v"
+            options.append("-v")
         if overwrite:
-            options += " -f"
+            options.append("-f")
         
-        options += " %d '%s' '%s'" % (alignment, inFile, outFile)
+        options += [str(alignment), inFile, outFile]
         cmd = self._previewZipalignCmd(options)
         (returnCode, output) = self._runZipalignCommand(cmd)
         (successfulRun, cmdOutput) = self._interpretAlignCmdResults(returnCode, output)
@@ -44,11 +45,11 @@ class ZipalignInterface:
 #         return (successfulRun, cmdOutput)
         
     def _previewZipalignCmd(self, options):
-        zipalignCommand = "'%s' %s" % (self.pathToZipalign, options)
+        zipalignCommand = [self.pathToZipalign] + options
         return zipalignCommand
     
     def _runZipalignCommand(self, cmd):
-        return commander.runOnce(cmd)
+        return commander.runOnce(cmd, resource=RESOURCE_DISK)
     
     def _interpretAlignCmdResults(self, returnCode, output):
         output = "Return code is: [%s].\nCommand output: %s" % (returnCode, output)
@@ -0,0 +1,81 @@
+'''
+Command line tool to inspect and prune the cache of instrumented apk files.
+
+Usage examples:
+    python manage_instr_cache.py list
+    python manage_instr_cache.py stats
+    python manage_instr_cache.py prune --max-size 2048 --older-than-days 30
+    python manage_instr_cache.py clear
+'''
+import sys
+import time
+import argparse
+
+from bbox_core.bbox_config import BBoxConfig
+from bbox_core.bboxcache import BBoxInstrCache
+
+
+def formatSize(size):
+    return "%.1f MB" % (float(size) / (1024 * 1024))
+
+def formatTime(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+def listEntries(cache, args):
+    entries = cache.listEntries()
+    for entry in reversed(entries):
+        print "%s  %10s  last used: %s  %s" % (entry["key"], formatSize(entry["size"]),
+                                              formatTime(entry["lastAccess"]), entry.get("apkName") or "")
+    print "%d entries" % len(entries)
+
+def printStats(cache, args):
+    entries = cache.listEntries()
+    print "Cache dir:             %s" % cache.cacheDir
+    print "Toolchain fingerprint: %s" % cache.getToolchainFingerprint()
+    print "Entries:               %d" % len(entries)
+    print "Total size:            %s (limit %s)" % (formatSize(sum(e["size"] for e in entries)), formatSize(cache.maxSize))
+    if entries:
+        print "Least recently used:   %s" % formatTime(entries[0]["lastAccess"])
+        print "Most recently used:    %s" % formatTime(entries[-1]["lastAccess"])
+
+def pruneEntries(cache, args):
+    maxSize = cache.maxSize
+    if args.max_size is not None:
+        maxSize = args.max_size * 1024 * 1024
+    olderThan = None
+    if args.older_than_days is not None:
+        olderThan = args.older_than_days * 24 * 3600
+    removed = cache.evict(maxSize=maxSize, olderThan=olderThan)
+    print "Removed %d entries (%s)" % (len(removed), formatSize(sum(e["size"] for e in removed)))
+
+def clearEntries(cache, args):
+    removed = cache.clear()
+    print "Removed %d entries (%s)" % (len(removed), formatSize(sum(e["size"] for e in removed)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Inspect and prune the cache of instrumented apk files.")
+    parser.add_argument("--config", default="./config/bbox_config.ini", help="path to BBoxTester config file")
+    subparsers = parser.add_subparsers()
+
+    listParser = subparsers.add_parser("list", help="list cache entries")
+    listParser.set_defaults(func=listEntries)
+
+    statsParser = subparsers.add_parser("stats", help="show cache statistics")
+    statsParser.set_defaults(func=printStats)
+
+    pruneParser = subparsers.add_parser("prune", help="remove least recently used entries")
+    pruneParser.add_argument("--max-size", type=int, default=None, help="size limit in MB (default: INSTR_CACHE_MAX_SIZE_MB)")
+    pruneParser.add_argument("--older-than-days", type=float, default=None, help="remove entries not used during this number of days")
+    pruneParser.set_defaults(func=pruneEntries)
+
+    clearParser = subparsers.add_parser("clear", help="remove all entries")
+    clearParser.set_defaults(func=clearEntries)
+
+    args = parser.parse_args(argv)
+    cache = BBoxInstrCache(BBoxConfig(args.config))
+    args.func(cache, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
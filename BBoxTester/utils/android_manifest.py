@@ -3,17 +3,54 @@ Created on Jul 8, 2014
 
 @author: Yury Zhauniarovich <y.zhalnerovich{at}gmail.com>
 '''
+import zipfile
 from xml.dom import minidom
 from bbox_core.general_exceptions import MsgException
+from utils import apk_utils
+from utils.axml import AxmlDocument, AxmlElement, AxmlAttribute, ANDROID_ATTR_IDS
 
 
 
 class AndroidManifest:
-    def __init__(self, pathAndroidManifest):
+    def __init__(self, pathAndroidManifest=None, data=None):
+        '''
+        Loads text or binary (as stored in apk files) AndroidManifest.xml. The
+        format is detected automatically; a binary manifest is exported back
+        in the binary form.
+        
+        Args:
+            :param pathAndroidManifest: path to the manifest file
+            :param data: content of the manifest file (if pathAndroidManifest
+                is not provided)
+        '''
         self.pathAndroidManifest = pathAndroidManifest
-        self.xml = minidom.parse(pathAndroidManifest)
+        if data is None:
+            with open(pathAndroidManifest, "rb") as f:
+                data = f.read()
+        self.binary = apk_utils.is_android_raw(data) == "AXML"
+        if self.binary:
+            self.axml = AxmlDocument.parse(data)
+            self.xml = _AxmlDocumentView(self.axml)
+        else:
+            self.axml = None
+            self.xml = minidom.parseString(data)
         self.packageName = self.getElement("manifest", "package")
     
+    @staticmethod
+    def fromApk(pathToApk):
+        '''
+        Reads binary AndroidManifest.xml directly from the apk file.
+        
+        Raises:
+            NoManifestFoundException: if the apk has no manifest
+        '''
+        try:
+            with zipfile.ZipFile(pathToApk, "r") as apk:
+                data = apk.read("AndroidManifest.xml")
+        except (zipfile.BadZipfile, KeyError, IOError) as e:
+            raise NoManifestFoundException("Cannot read AndroidManifest.xml from [%s]: %s" % (pathToApk, str(e)))
+        return AndroidManifest(data=data)
+    
     def getUsesPermissions(self):
         return self.getElements("uses-permission", "android:name")
     
@@ -128,11 +165,16 @@ class AndroidManifest:
                             "android:targetPackage" : targetPackage})
     
     def removeExistingInstrumentation(self):
-        instr = self.getElements("instrumentation", "android:name")
+        instr = self.xml.getElementsByTagName("instrumentation")
         if len(instr) <= 0:
             raise NoInstrumentationTagFound()
-        for elem in instr:
-            self.xml.removeChild(elem)
+        if self.binary:
+            for parent in list(self.axml.root.iterElements()):
+                for elem in parent.getChildElements("instrumentation"):
+                    parent.removeChild(elem)
+        else:
+            for elem in instr:
+                elem.parentNode.removeChild(elem)
     
         
     def getPackageName(self):
@@ -144,6 +186,16 @@ class AndroidManifest:
     def getInstrumentationTargetPackage(self):
         return self.getElement("instrumentation", "android:targetPackage")
     
+    def getMinSdkVersion(self):
+        '''
+        Returns android:minSdkVersion of uses-sdk or None if it is not set 
+        (or is the codename of a preview platform).
+        '''
+        try:
+            return int(self.getElement("uses-sdk", "android:minSdkVersion"))
+        except (TypeError, ValueError):
+            return None
+    
     def getElement(self, tag_name, attribute):
         """
             Return element in xml files which matches with the tag name and the specific attribute
@@ -194,25 +246,101 @@ class AndroidManifest:
         where = self.xml.getElementsByTagName(under_tag) #adding after the first occurrence
         if len(where) <= 0:
             raise NoTagException("Cannot find tag: %s" % under_tag)
+        if self.binary:
+            self._createBinaryElement(where[0].element, tag, attributes)
+            return
         elem = self.xml.createElement(tag)
         if attributes:
             for entry in attributes.iteritems():
                 elem.setAttribute(entry[0], entry[1])
         where[0].appendChild(elem)
     
+    def _createBinaryElement(self, parent, tag, attributes):
+        elem = AxmlElement(None, tag, parent.endLineNumber)
+        if attributes:
+            for (qualifiedName, value) in attributes.iteritems():
+                (namespaceUri, name) = self.xml.splitName(qualifiedName)
+                resourceId = None
+                if namespaceUri:
+                    #attributes of android namespace are recognized by resource id
+                    resourceId = ANDROID_ATTR_IDS.get(name)
+                    if resourceId is None:
+                        raise UnknownAttributeException("Resource id of attribute [%s] is unknown" % qualifiedName)
+                elem.addAttribute(AxmlAttribute.createString(namespaceUri, name, resourceId, value))
+        parent.appendChild(elem)
+    
     def getAndroidManifestXml(self):
+        if self.binary:
+            return self.axml.toXml()
         return self.xml.toprettyxml()
     
     def exportManifest(self, path=None):
+        '''
+        Writes the manifest in its original (text or binary) format.
+        '''
         if not path:
-            with open(self.pathAndroidManifest, "wb") as f:
+            path = self.pathAndroidManifest
+        if not path:
+            raise NoManifestPathException("Manifest is not loaded from a file, the path must be provided!")
+        with open(path, "wb") as f:
+            if self.binary:
+                f.write(self.axml.serialize())
+            else:
                 self.xml.writexml(f)
-        else:
-            with open(path, "wb") as f:
+    
+    def exportXml(self, path):
+        '''
+        Writes the text representation of the manifest.
+        '''
+        with open(path, "wb") as f:
+            if self.binary:
+                f.write(self.axml.toXml().encode("utf-8"))
+            else:
                 self.xml.writexml(f)
 
 
 
+class _AxmlElementView:
+    '''
+    Minimal minidom-like view of a binary XML element used by the queries of
+    AndroidManifest.
+    '''
+    def __init__(self, element, documentView):
+        self.element = element
+        self.documentView = documentView
+    
+    def getElementsByTagName(self, tagName):
+        return [_AxmlElementView(elem, self.documentView)
+                for child in self.element.getChildElements()
+                for elem in child.iterElements(tagName)]
+    
+    def getAttribute(self, qualifiedName):
+        (namespaceUri, name) = self.documentView.splitName(qualifiedName)
+        value = self.element.getAttributeValue(namespaceUri, name)
+        if value is None:
+            return ""
+        return value
+
+
+class _AxmlDocumentView:
+    def __init__(self, document):
+        self.document = document
+        self.prefixes = {}
+        for elem in document.root.iterElements():
+            for namespace in elem.namespaces:
+                self.prefixes[namespace.prefix] = namespace.uri
+    
+    def splitName(self, qualifiedName):
+        if ":" in qualifiedName:
+            (prefix, name) = qualifiedName.split(":", 1)
+            return (self.prefixes.get(prefix), name)
+        return (None, qualifiedName)
+    
+    def getElementsByTagName(self, tagName):
+        return [_AxmlElementView(elem, self) for elem in self.document.root.iterElements(tagName)]
+
+
+
 # Exception classes
 class NoTagException(MsgException):
     '''
@@ -229,6 +357,21 @@ class NoInstrumentationTagFound(MsgException):
     No instrumentation tag found.
     '''
 
+class NoManifestFoundException(MsgException):
+    '''
+    No AndroidManifest.xml found in the apk file.
+    '''
+
+class NoManifestPathException(MsgException):
+    '''
+    The path to store the manifest is not known.
+    '''
+
+class UnknownAttributeException(MsgException):
+    '''
+    The attribute cannot be added to the binary manifest.
+    '''
+
    
 #===============================================================================
 # androidManifest = AndroidManifest("/home/yury/research_tmp/BBTester_tst/notepad/AndroidManifest.xml")
@@ -0,0 +1,202 @@
+'''
+Pre-scan of apk files.
+
+The scan reads only the central directory of the zip file and the headers of
+the dex files (memory mapped; only the first bytes of compressed dex files
+are inflated). It finds broken apk files and apk files that cannot be
+instrumented before the JVM tools are run, and estimates the cost of the
+instrumentation.
+'''
+import os
+import json
+import mmap
+import zlib
+import struct
+import zipfile
+import tempfile
+
+from bbox_core.general_exceptions import MsgException
+from utils import apk_utils
+from utils.apk_writer import getEntryDataOffset, getDecompressor, ApkWriterException
+
+
+SCAN_VERSION = 1
+
+DEX_HEADER_SIZE = 0x70
+DEX_MAGIC_PREFIX = "dex\n"
+#offsets of the header fields (uint32, little endian)
+DEX_FILE_SIZE_OFFSET = 0x20
+DEX_STRING_IDS_SIZE_OFFSET = 0x38
+DEX_TYPE_IDS_SIZE_OFFSET = 0x40
+DEX_FIELD_IDS_SIZE_OFFSET = 0x50
+DEX_METHOD_IDS_SIZE_OFFSET = 0x58
+DEX_CLASS_DEFS_SIZE_OFFSET = 0x60
+
+#the number of method references a dex file can hold
+DEX_METHOD_LIMIT = 65536
+
+NATIVE_LIB_PREFIX = "lib/"
+READ_CHUNK_SIZE = 4096
+
+
+def scanApk(pathToApk):
+    '''
+    Scans the apk file.
+
+    Returns:
+        :ret dict with the keys: entries (number of zip entries), size (size of
+            the apk file), hasManifest, dexFiles (list of dicts with name,
+            size, compressedSize, methods, fields, classes, strings, types),
+            nativeLibs (list of entry names), totalDexSize, totalMethods,
+            totalClasses
+
+    Raises:
+        ApkScanException: if the apk file is broken
+    '''
+    try:
+        with open(pathToApk, "rb") as f:
+            apkZip = zipfile.ZipFile(f, "r")
+            zinfos = apkZip.infolist()
+            dexInfos = [zinfo for zinfo in zinfos if apk_utils.isDexEntry(zinfo.filename)]
+            dexFiles = []
+            if dexInfos:
+                mappedApk = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for zinfo in dexInfos:
+                        dexFiles.append(_scanDexEntry(mappedApk, zinfo))
+                finally:
+                    mappedApk.close()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        raise ApkScanException("[%s] is not a valid zip file: %s" % (pathToApk, str(e)))
+    except (IOError, ValueError, ApkWriterException) as e:
+        raise ApkScanException("Cannot read [%s]: %s" % (pathToApk, str(e)))
+
+    names = [zinfo.filename for zinfo in zinfos]
+    return {
+        "version" : SCAN_VERSION,
+        "size" : os.path.getsize(pathToApk),
+        "entries" : len(zinfos),
+        "hasManifest" : "AndroidManifest.xml" in names,
+        "dexFiles" : dexFiles,
+        "nativeLibs" : [name for name in names if name.startswith(NATIVE_LIB_PREFIX) and name.endswith(".so")],
+        "totalDexSize" : sum([dex["size"] for dex in dexFiles]),
+        "totalMethods" : sum([dex["methods"] for dex in dexFiles]),
+        "totalClasses" : sum([dex["classes"] for dex in dexFiles]),
+    }
+
+
+def checkScan(scan, methodLimit=DEX_METHOD_LIMIT, methodsPerClass=0):
+    '''
+    Checks if the scanned apk file can be instrumented.
+
+    Args:
+        :param scan: result of scanApk
+        :param methodLimit: maximum number of methods of a dex file (0 - no
+            limit)
+        :param methodsPerClass: number of methods the instrumentation adds to
+            each class
+
+    Returns:
+        :ret list of problems (empty if the apk can be instrumented)
+    '''
+    problems = []
+    if not scan["hasManifest"]:
+        problems.append("There is no AndroidManifest.xml")
+    dexNames = [dex["name"] for dex in scan["dexFiles"]]
+    if "classes.dex" not in dexNames:
+        problems.append("There is no classes.dex")
+    for dex in scan["dexFiles"]:
+        if methodLimit and estimateInstrumentedMethods(dex, methodsPerClass) > methodLimit:
+            problems.append("[%s] would have more than %d methods after instrumentation (%d methods, %d classes)" %
+                            (dex["name"], methodLimit, dex["methods"], dex["classes"]))
+    return problems
+
+
+def estimateInstrumentedMethods(dex, methodsPerClass):
+    return dex["methods"] + methodsPerClass * dex["classes"]
+
+
+class ApkScanCache:
+    '''
+    Scans of apk files stored by the hash of the apk file.
+    '''
+    def __init__(self, cacheDir):
+        self.cacheDir = os.path.abspath(cacheDir)
+
+    def getScan(self, pathToApk, apkHash):
+        '''
+        Returns the scan of the apk file, scanning it if it is not cached.
+
+        Raises:
+            ApkScanException: if the apk file is broken
+        '''
+        scanPath = os.path.join(self.cacheDir, apkHash[:2], "%s.json" % apkHash)
+        try:
+            with open(scanPath, "r") as f:
+                scan = json.load(f)
+            if scan.get("version") == SCAN_VERSION:
+                return scan
+        except (IOError, ValueError):
+            pass
+
+        scan = scanApk(pathToApk)
+        try:
+            if not os.path.isdir(os.path.dirname(scanPath)):
+                os.makedirs(os.path.dirname(scanPath))
+            (fd, tmpPath) = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(scanPath))
+            with os.fdopen(fd, "w") as f:
+                json.dump(scan, f)
+            os.rename(tmpPath, scanPath)
+        except (OSError, IOError):
+            #the scan is only cached
+            pass
+        return scan
+
+
+def _scanDexEntry(mappedApk, zinfo):
+    header = _readEntryHead(mappedApk, zinfo, DEX_HEADER_SIZE)
+    if len(header) < DEX_HEADER_SIZE or not header.startswith(DEX_MAGIC_PREFIX):
+        raise ApkScanException("[%s] is not a valid dex file" % zinfo.filename)
+    fileSize = _readUInt(header, DEX_FILE_SIZE_OFFSET)
+    if fileSize != zinfo.file_size:
+        raise ApkScanException("[%s] is truncated: the header declares %d bytes, the entry has %d" %
+                               (zinfo.filename, fileSize, zinfo.file_size))
+    return {
+        "name" : zinfo.filename,
+        "size" : zinfo.file_size,
+        "compressedSize" : zinfo.compress_size,
+        "methods" : _readUInt(header, DEX_METHOD_IDS_SIZE_OFFSET),
+        "fields" : _readUInt(header, DEX_FIELD_IDS_SIZE_OFFSET),
+        "classes" : _readUInt(header, DEX_CLASS_DEFS_SIZE_OFFSET),
+        "strings" : _readUInt(header, DEX_STRING_IDS_SIZE_OFFSET),
+        "types" : _readUInt(header, DEX_TYPE_IDS_SIZE_OFFSET),
+    }
+
+def _readEntryHead(mappedApk, zinfo, size):
+    '''
+    Returns the first bytes of the uncompressed data of the entry.
+    '''
+    offset = getEntryDataOffset(mappedApk, zinfo)
+    end = min(offset + zinfo.compress_size, len(mappedApk))
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        return mappedApk[offset:min(offset + size, end)]
+    decompressor = getDecompressor(zinfo)
+    head = ""
+    try:
+        while len(head) < size and offset < end:
+            chunk = mappedApk[offset:min(offset + READ_CHUNK_SIZE, end)]
+            offset += len(chunk)
+            head += decompressor.decompress(decompressor.unconsumed_tail + chunk, size - len(head))
+    except zlib.error as e:
+        raise ApkScanException("Cannot inflate [%s]: %s" % (zinfo.filename, str(e)))
+    return head
+
+def _readUInt(data, offset):
+    return struct.unpack_from("<I", data, offset)[0]
+
+
+#Exceptions
+class ApkScanException(MsgException):
+    '''
+    The apk file is broken.
+    '''
@@ -4,6 +4,7 @@ Created on Oct 13, 2014
 @author: Yury Zhauniarovich <y.zhalnerovich{at}gmail.com>
 '''
 import os
+import re
 
 
 def checkInputApkFile(inputPath):
@@ -19,6 +20,28 @@ def checkInputApkFile(inputPath):
     return (True, None)
                 
 
+SIGNATURE_FILE_EXTENSIONS = (".SF", ".RSA", ".DSA", ".EC")
+DEX_ENTRY_PATTERN = re.compile(r"^classes\d*\.dex$")
+
+def isSignatureEntry(entryName):
+    '''
+    Checks if the zip entry belongs to the jar signature of an apk file.
+    '''
+    if not entryName.upper().startswith("META-INF/"):
+        return False
+    baseName = entryName[len("META-INF/"):].upper()
+    if "/" in baseName:
+        return False
+    return baseName == "MANIFEST.MF" or baseName.endswith(SIGNATURE_FILE_EXTENSIONS)
+
+def isDexEntry(entryName):
+    '''
+    Checks if the zip entry is a dex file loaded by Android (classes.dex, 
+    classes2.dex, ...).
+    '''
+    return DEX_ENTRY_PATTERN.match(entryName) is not None
+
+
 def is_android(filename) :
     """Return the type of the file
 
@@ -0,0 +1,333 @@
+'''
+Zip writer used to patch apk files.
+
+Unlike zipfile.ZipFile, the writer can copy entries of another zip file raw,
+i.e., without decompressing and compressing their data again. The writer can
+also align the data of uncompressed entries (as zipalign does) while writing:
+the padding is put into the extra field of the local file header.
+'''
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+from bbox_core.general_exceptions import MsgException
+
+
+LOCAL_FILE_HEADER = "<IHHHHHIIIHH"
+LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_DIR_HEADER = "<IHHHHHHIIIHHHHHII"
+CENTRAL_DIR_HEADER_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIR = "<IHHHHIIH"
+END_OF_CENTRAL_DIR_SIGNATURE = 0x06054b50
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+#extra field used by Android tools to pad the data of an entry
+ALIGNMENT_EXTRA_ID = 0xD935
+ALIGNMENT_EXTRA_HEADER = "<HHH"
+SHARED_LIB_ALIGNMENT = 4096
+
+ZIP_VERSION = 20
+ZIP_MAX_SIZE = 0xFFFFFFFF
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ZipEntryRecord:
+    '''
+    Information about an entry written into the archive needed to build the
+    central directory.
+    '''
+    def __init__(self, name, flags, compressType, dosTime, dosDate, crc,
+                 compressSize, fileSize, headerOffset, externalAttr=0,
+                 internalAttr=0, createVersion=ZIP_VERSION, createSystem=0):
+        self.name = name
+        self.flags = flags
+        self.compressType = compressType
+        self.dosTime = dosTime
+        self.dosDate = dosDate
+        self.crc = crc
+        self.compressSize = compressSize
+        self.fileSize = fileSize
+        self.headerOffset = headerOffset
+        self.externalAttr = externalAttr
+        self.internalAttr = internalAttr
+        self.createVersion = createVersion
+        self.createSystem = createSystem
+
+
+class ApkWriter:
+    def __init__(self, path, alignment=None, pageAlignSharedLibs=False):
+        '''
+        Args:
+            :param path: path to the zip file to write
+            :param alignment: if provided, the data of uncompressed entries 
+                starts at offsets that are multiples of this value
+            :param pageAlignSharedLibs: if True, uncompressed .so files are
+                aligned to 4096 bytes
+        '''
+        self.path = path
+        self.alignment = alignment
+        self.pageAlignSharedLibs = pageAlignSharedLibs
+        self._file = open(path, "wb")
+        self._offset = 0
+        self._records = []
+        self._names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def getEntryNames(self):
+        return [record.name for record in self._records]
+
+    def copyRawEntry(self, srcFile, zinfo, dataListener=None):
+        '''
+        Copies the compressed data of an entry of another zip file.
+
+        Args:
+            :param srcFile: file object of the source zip file opened for
+                reading in binary mode
+            :param zinfo: zipfile.ZipInfo of the entry (taken from the central
+                directory of the source file)
+            :param dataListener: if provided, callable that receives the 
+                uncompressed data of the entry chunk by chunk while it is 
+                copied (e.g., to compute a digest in the same pass)
+        '''
+        srcFile.seek(zinfo.header_offset)
+        header = srcFile.read(struct.calcsize(LOCAL_FILE_HEADER))
+        fields = struct.unpack(LOCAL_FILE_HEADER, header)
+        if fields[0] != LOCAL_FILE_HEADER_SIGNATURE:
+            raise ApkWriterException("Bad local file header of entry [%s]" % zinfo.filename)
+        (nameLength, extraLength) = fields[9:11]
+        srcFile.seek(nameLength + extraLength, os.SEEK_CUR)
+
+        name = _encodeName(zinfo.filename)
+        #sizes and crc are taken from the central directory, so the data
+        #descriptor is not needed
+        flags = zinfo.flag_bits & ~FLAG_DATA_DESCRIPTOR
+        (dosTime, dosDate) = _toDosDateTime(zinfo.date_time)
+        record = ZipEntryRecord(name, flags, zinfo.compress_type, dosTime, dosDate,
+                                zinfo.CRC, zinfo.compress_size, zinfo.file_size,
+                                self._offset, zinfo.external_attr, zinfo.internal_attr,
+                                zinfo.create_version, zinfo.create_system)
+        self._writeLocalHeader(record)
+        decompressor = None
+        if dataListener:
+            decompressor = getDecompressor(zinfo)
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = srcFile.read(min(remaining, COPY_BUFFER_SIZE))
+            if not chunk:
+                raise ApkWriterException("Unexpected end of data of entry [%s]" % zinfo.filename)
+            self._write(chunk)
+            remaining -= len(chunk)
+            if decompressor:
+                dataListener(decompressor.decompress(chunk))
+        if decompressor:
+            dataListener(decompressor.flush())
+        self._addRecord(record)
+
+    def writeBytes(self, name, data, compressType=zipfile.ZIP_DEFLATED, dateTime=None, dataListener=None):
+        '''
+        Writes the data as a new entry of the archive. If dataListener is
+        provided, it receives the data.
+        '''
+        if dataListener:
+            dataListener(data)
+        if dateTime is None:
+            dateTime = time.localtime(time.time())[:6]
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+        if compressType == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        elif compressType == zipfile.ZIP_STORED:
+            compressed = data
+        else:
+            raise ApkWriterException("Unsupported compression type: %d" % compressType)
+
+        name = _encodeName(name)
+        flags = 0
+        if isinstance(name, str) and _isUtf8Name(name):
+            flags |= FLAG_UTF8
+        (dosTime, dosDate) = _toDosDateTime(dateTime)
+        #regular file with rw-r--r-- permissions
+        record = ZipEntryRecord(name, flags, compressType, dosTime, dosDate, crc,
+                                len(compressed), len(data), self._offset,
+                                (0100644 << 16), 0, ZIP_VERSION, 3)
+        self._writeLocalHeader(record)
+        self._write(compressed)
+        self._addRecord(record)
+
+    def writeFile(self, name, path, compressType=zipfile.ZIP_DEFLATED, dataListener=None):
+        '''
+        Writes the file as a new entry of the archive.
+        '''
+        with open(path, "rb") as f:
+            data = f.read()
+        dateTime = time.localtime(os.path.getmtime(path))[:6]
+        self.writeBytes(name, data, compressType, dateTime, dataListener)
+
+    def close(self):
+        '''
+        Writes the central directory and closes the file.
+        '''
+        centralDirOffset = self._offset
+        for record in self._records:
+            header = struct.pack(CENTRAL_DIR_HEADER, CENTRAL_DIR_HEADER_SIGNATURE,
+                                 (record.createSystem << 8) | (record.createVersion & 0xFF),
+                                 ZIP_VERSION, record.flags, record.compressType,
+                                 record.dosTime, record.dosDate, record.crc,
+                                 record.compressSize, record.fileSize, len(record.name),
+                                 0, 0, 0, record.internalAttr, record.externalAttr,
+                                 record.headerOffset)
+            self._write(header + record.name)
+        centralDirSize = self._offset - centralDirOffset
+        if len(self._records) > 0xFFFF or self._offset > ZIP_MAX_SIZE:
+            raise ApkWriterException("Zip64 archives are not supported")
+        self._write(struct.pack(END_OF_CENTRAL_DIR, END_OF_CENTRAL_DIR_SIGNATURE, 0, 0,
+                                len(self._records), len(self._records),
+                                centralDirSize, centralDirOffset, 0))
+        self._file.close()
+
+
+    def _writeLocalHeader(self, record):
+        if record.name in self._names:
+            raise ApkWriterException("Duplicate entry: %s" % record.name)
+        if record.compressSize > ZIP_MAX_SIZE or record.fileSize > ZIP_MAX_SIZE:
+            raise ApkWriterException("Entry [%s] is too large" % record.name)
+        headerLength = struct.calcsize(LOCAL_FILE_HEADER) + len(record.name)
+        extra = self._getAlignmentExtra(record, self._offset + headerLength)
+        header = struct.pack(LOCAL_FILE_HEADER, LOCAL_FILE_HEADER_SIGNATURE, ZIP_VERSION,
+                             record.flags, record.compressType, record.dosTime,
+                             record.dosDate, record.crc, record.compressSize,
+                             record.fileSize, len(record.name), len(extra))
+        self._write(header + record.name + extra)
+
+    def _getAlignmentExtra(self, record, extraOffset):
+        alignment = getRequiredAlignment(record.name, record.compressType, 
+                                         self.alignment, self.pageAlignSharedLibs)
+        if not alignment:
+            return ""
+        headerSize = struct.calcsize(ALIGNMENT_EXTRA_HEADER)
+        padding = (alignment - (extraOffset + headerSize) % alignment) % alignment
+        return struct.pack(ALIGNMENT_EXTRA_HEADER, ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + "\0" * padding
+
+    def _addRecord(self, record):
+        self._names.add(record.name)
+        self._records.append(record)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+
+def getRequiredAlignment(name, compressType, alignment, pageAlignSharedLibs=False):
+    '''
+    Returns the alignment required for the data of an entry or None if the
+    entry does not need to be aligned (compressed entries).
+    '''
+    if not alignment or compressType != zipfile.ZIP_STORED:
+        return None
+    if pageAlignSharedLibs and name.endswith(".so"):
+        return SHARED_LIB_ALIGNMENT
+    return alignment
+
+
+def alignZip(srcPath, dstPath, alignment=4, pageAlignSharedLibs=False):
+    '''
+    Copies all entries of the zip file raw and aligns the uncompressed ones.
+    '''
+    with zipfile.ZipFile(srcPath, "r") as src, open(srcPath, "rb") as srcFile, \
+            ApkWriter(dstPath, alignment, pageAlignSharedLibs) as writer:
+        for zinfo in src.infolist():
+            writer.copyRawEntry(srcFile, zinfo)
+
+
+def getEntryDataOffset(fileObj, zinfo):
+    '''
+    Returns the offset of the data of the entry reading its local file header.
+
+    Args:
+        :param fileObj: file object (or mmap) of the zip file
+        :param zinfo: zipfile.ZipInfo of the entry
+    '''
+    headerSize = struct.calcsize(LOCAL_FILE_HEADER)
+    fileObj.seek(zinfo.header_offset)
+    header = fileObj.read(headerSize)
+    if len(header) != headerSize:
+        raise ApkWriterException("Bad local file header of entry [%s]" % zinfo.filename)
+    fields = struct.unpack(LOCAL_FILE_HEADER, header)
+    if fields[0] != LOCAL_FILE_HEADER_SIGNATURE:
+        raise ApkWriterException("Bad local file header of entry [%s]" % zinfo.filename)
+    return zinfo.header_offset + headerSize + fields[9] + fields[10]
+
+
+def checkZipAlignment(path, alignment=4, pageAlignSharedLibs=False):
+    '''
+    Checks the alignment of uncompressed entries reading only the central
+    directory and the local file headers of the zip file.
+    
+    Returns:
+        :ret list of names of misaligned entries
+    '''
+    misaligned = []
+    with zipfile.ZipFile(path, "r") as zf, open(path, "rb") as f:
+        for zinfo in zf.infolist():
+            required = getRequiredAlignment(zinfo.filename, zinfo.compress_type, 
+                                            alignment, pageAlignSharedLibs)
+            if not required:
+                continue
+            dataOffset = getEntryDataOffset(f, zinfo)
+            if dataOffset % required != 0:
+                misaligned.append(zinfo.filename)
+    return misaligned
+
+
+class _StoredDataDecompressor:
+    def decompress(self, data):
+        return data
+    
+    def flush(self):
+        return ""
+
+def getDecompressor(zinfo):
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        return _StoredDataDecompressor()
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    raise ApkWriterException("Unsupported compression type of entry [%s]: %d" % (zinfo.filename, zinfo.compress_type))
+
+def _encodeName(name):
+    if isinstance(name, unicode):
+        return name.encode("utf-8")
+    return name
+
+def _isUtf8Name(name):
+    try:
+        name.decode("ascii")
+        return False
+    except UnicodeDecodeError:
+        return True
+
+def _toDosDateTime(dateTime):
+    (year, month, day, hour, minute, second) = dateTime[:6]
+    if year < 1980:
+        (year, month, day, hour, minute, second) = (1980, 1, 1, 0, 0, 0)
+    dosTime = (hour << 11) | (minute << 5) | (second // 2)
+    dosDate = ((year - 1980) << 9) | (month << 5) | day
+    return (dosTime, dosDate)
+
+
+#Exceptions
+class ApkWriterException(MsgException):
+    '''
+    The apk file cannot be written.
+    '''
@@ -4,6 +4,9 @@ Created on Jul 4, 2014
 @author: Yury Zhauniarovich <y.zhalnerovich{at}gmail.com>
 '''
 import os, errno, shutil
+import hashlib
+
+HASH_BLOCK_SIZE = 1024 * 1024
 
 
 def mkdir(path, mode=0777, overwrite=False):
@@ -37,8 +40,13 @@ def ensureDirExists(path, mode=0777):
         :param mode: permissions to the directory
     '''
     if not os.path.exists(path):
-        os.makedirs(path, mode)
-        
+        try:
+            os.makedirs(path, mode)
+        except OSError as e:
+            #the directory may have been created by a concurrent stage
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+
 def searchFiles(where, extension):
     searched_files = []
     searched_extension = ".%s" % extension.lower()
@@ -68,6 +76,74 @@ def searchFilesRelativeToDir(target, extension):
                 searched_files.append(os.path.join(root[len(target):], f))
     return searched_files
 
+def getFileHash(path, algorithm="sha256"):
+    '''
+    Computes the hex digest of the file content.
+    
+    Args:
+        :param path: path to the file
+        :param algorithm: the name of the hashlib algorithm
+    Returns:
+        :ret hex digest of the file content
+    '''
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ""):
+            h.update(block)
+    return h.hexdigest()
+
+def getDirHash(path, algorithm="sha256", excludes=()):
+    '''
+    Computes the hex digest of a directory tree. The digest covers relative
+    paths and contents of all files in the tree. If the path points to a file,
+    the digest of the file is returned.
+    
+    Args:
+        :param path: path to the directory
+        :param algorithm: the name of the hashlib algorithm
+        :param excludes: paths of files that are not taken into account
+    Returns:
+        :ret hex digest of the directory tree
+    '''
+    if os.path.isfile(path):
+        return getFileHash(path, algorithm)
+    h = hashlib.new(algorithm)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            absPath = os.path.join(root, f)
+            if absPath in excludes:
+                continue
+            h.update(os.path.relpath(absPath, path))
+            h.update(getFileHash(absPath, algorithm))
+    return h.hexdigest()
+
+def getDirSize(path):
+    '''
+    Returns the total size in bytes of all files in the directory tree.
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            absPath = os.path.join(root, f)
+            if not os.path.islink(absPath):
+                size += os.path.getsize(absPath)
+    return size
+
+def linkOrCopyFile(src, dst):
+    '''
+    Creates a hard link dst to src. If a hard link cannot be created (e.g., 
+    files are on different file systems), copies the file.
+    '''
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
 def to_bool(value):
     """
        Converts 'something' to boolean. Raises exception for invalid formats
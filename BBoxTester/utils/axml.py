@@ -0,0 +1,581 @@
+'''
+Reader and writer of binary Android XML (AXML) files, e.g., the
+AndroidManifest.xml file stored in apk files.
+
+The file is parsed into a tree of elements where all string references are
+resolved, so the tree can be modified freely. The string pool and the resource
+map are rebuilt when the tree is serialized back.
+'''
+import struct
+
+from bbox_core.general_exceptions import MsgException
+
+
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+
+#resource ids of the attributes of android namespace
+ANDROID_ATTR_LABEL = 0x01010001
+ANDROID_ATTR_ICON = 0x01010002
+ANDROID_ATTR_NAME = 0x01010003
+ANDROID_ATTR_TARGET_PACKAGE = 0x01010021
+ANDROID_ATTR_IDS = {
+    "label" : ANDROID_ATTR_LABEL,
+    "icon" : ANDROID_ATTR_ICON,
+    "name" : ANDROID_ATTR_NAME,
+    "targetPackage" : ANDROID_ATTR_TARGET_PACKAGE,
+}
+
+#chunk types
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_NAMESPACE_TYPE = 0x0100
+RES_XML_END_NAMESPACE_TYPE = 0x0101
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_CDATA_TYPE = 0x0104
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+#string pool flags
+SORTED_FLAG = 0x1
+UTF8_FLAG = 0x100
+#lengths of the strings of a UTF-8 pool are encoded in at most 15 bits
+MAX_UTF8_LENGTH = 0x7fff
+
+#types of typed values
+TYPE_NULL = 0x00
+TYPE_REFERENCE = 0x01
+TYPE_ATTRIBUTE = 0x02
+TYPE_STRING = 0x03
+TYPE_FLOAT = 0x04
+TYPE_DIMENSION = 0x05
+TYPE_FRACTION = 0x06
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+TYPE_FIRST_COLOR_INT = 0x1c
+TYPE_LAST_COLOR_INT = 0x1f
+
+NO_INDEX = 0xFFFFFFFF
+
+CHUNK_HEADER = "<HHI"
+NODE_HEADER = "<HHIII"
+STRING_POOL_HEADER = "<HHIIIIII"
+NAMESPACE_EXT = "<II"
+ATTR_EXT = "<IIHHHHHH"
+ATTRIBUTE = "<IIIHBBI"
+END_ELEMENT_EXT = "<II"
+CDATA_EXT = "<IHBBI"
+
+DIMENSION_UNITS = ["px", "dip", "sp", "pt", "in", "mm"]
+FRACTION_UNITS = ["%", "%p"]
+RADIX_MULTS = [0.00390625, 3.051758E-005, 1.192093E-007, 4.656613E-010]
+
+
+class AxmlNamespace:
+    def __init__(self, prefix, uri, lineNumber=0, comment=None):
+        self.prefix = prefix
+        self.uri = uri
+        self.lineNumber = lineNumber
+        self.comment = comment
+        self.endLineNumber = lineNumber
+        self.endComment = None
+
+
+class AxmlAttribute:
+    def __init__(self, namespaceUri, name, resourceId=None, rawValue=None, valueType=TYPE_NULL, data=0):
+        '''
+        Args:
+            :param namespaceUri: uri of the attribute namespace or None
+            :param name: name of the attribute
+            :param resourceId: id of the attribute resource (e.g., 0x01010003
+                for android:name) or None
+            :param rawValue: original string value of the attribute or None
+            :param valueType: one of TYPE_* constants
+            :param data: the value. For TYPE_STRING it is a string, for other
+                types it is an integer
+        '''
+        self.namespaceUri = namespaceUri
+        self.name = name
+        self.resourceId = resourceId
+        self.rawValue = rawValue
+        self.valueType = valueType
+        self.data = data
+
+    @staticmethod
+    def createString(namespaceUri, name, resourceId, value):
+        return AxmlAttribute(namespaceUri, name, resourceId, value, TYPE_STRING, value)
+
+    def getValue(self):
+        '''
+        Returns the string representation of the attribute value.
+        '''
+        if self.valueType == TYPE_STRING:
+            return self.data
+        if self.rawValue is not None:
+            return self.rawValue
+        return formatTypedValue(self.valueType, self.data)
+
+
+class AxmlCData:
+    def __init__(self, text, lineNumber=0, comment=None):
+        self.text = text
+        self.lineNumber = lineNumber
+        self.comment = comment
+
+
+class AxmlElement:
+    def __init__(self, namespaceUri, name, lineNumber=0, comment=None):
+        self.namespaceUri = namespaceUri
+        self.name = name
+        self.lineNumber = lineNumber
+        self.comment = comment
+        self.endLineNumber = lineNumber
+        self.endComment = None
+        self.attributes = []
+        self.children = []
+        #namespaces declared right before the element
+        self.namespaces = []
+        self.idAttribute = None
+        self.classAttribute = None
+        self.styleAttribute = None
+
+    def getChildElements(self, name=None):
+        return [child for child in self.children
+                if isinstance(child, AxmlElement) and (name is None or child.name == name)]
+
+    def iterElements(self, name=None):
+        '''
+        Iterates over the element and all its descendant elements in document
+        order.
+        '''
+        if name is None or self.name == name:
+            yield self
+        for child in self.getChildElements():
+            for element in child.iterElements(name):
+                yield element
+
+    def getAttribute(self, namespaceUri, name):
+        for attribute in self.attributes:
+            if attribute.namespaceUri == namespaceUri and attribute.name == name:
+                return attribute
+        return None
+
+    def getAttributeValue(self, namespaceUri, name):
+        attribute = self.getAttribute(namespaceUri, name)
+        if attribute is None:
+            return None
+        return attribute.getValue()
+
+    def addAttribute(self, attribute):
+        '''
+        Adds the attribute keeping the attributes with resource ids sorted as
+        the Android framework expects.
+        '''
+        existing = self.getAttribute(attribute.namespaceUri, attribute.name)
+        if existing:
+            self.attributes.remove(existing)
+        position = len(self.attributes)
+        if attribute.resourceId is not None:
+            for i, attr in enumerate(self.attributes):
+                if attr.resourceId is not None and attr.resourceId > attribute.resourceId:
+                    position = i
+                    break
+        self.attributes.insert(position, attribute)
+
+    def appendChild(self, child):
+        self.children.append(child)
+
+    def removeChild(self, child):
+        self.children.remove(child)
+
+
+class AxmlDocument:
+    def __init__(self, root=None, utf8=False):
+        self.root = root
+        self.utf8 = utf8
+        #strings of the original pool: kept to preserve their order
+        self._poolStrings = []
+
+    @staticmethod
+    def parse(data):
+        '''
+        Parses binary AXML data.
+
+        Raises:
+            AxmlException: if the data is not a valid binary XML
+        '''
+        return _AxmlParser(data).parse()
+
+    def serialize(self):
+        '''
+        Returns the binary AXML representation of the document.
+        '''
+        return _AxmlSerializer(self).serialize()
+
+    def toXml(self):
+        '''
+        Returns the text XML representation of the document (similar to the
+        one produced by apktool).
+        '''
+        lines = ['<?xml version="1.0" encoding="utf-8"?>']
+        if self.root is not None:
+            self._elementToXml(self.root, {}, 0, lines)
+        return "\n".join(lines) + "\n"
+
+    def _elementToXml(self, element, prefixes, level, lines):
+        prefixes = dict(prefixes)
+        for namespace in element.namespaces:
+            prefixes[namespace.uri] = namespace.prefix
+
+        parts = [_qualifiedName(element.namespaceUri, element.name, prefixes)]
+        for namespace in element.namespaces:
+            parts.append('xmlns:%s="%s"' % (namespace.prefix, _escapeXml(namespace.uri)))
+        for attribute in element.attributes:
+            parts.append('%s="%s"' % (_qualifiedName(attribute.namespaceUri, attribute.name, prefixes),
+                                      _escapeXml(attribute.getValue())))
+        indent = "    " * level
+        if not element.children:
+            lines.append("%s<%s/>" % (indent, " ".join(parts)))
+            return
+        lines.append("%s<%s>" % (indent, " ".join(parts)))
+        for child in element.children:
+            if isinstance(child, AxmlElement):
+                self._elementToXml(child, prefixes, level + 1, lines)
+            else:
+                lines.append("%s%s" % ("    " * (level + 1), _escapeXml(child.text)))
+        lines.append("%s</%s>" % (indent, parts[0]))
+
+
+def formatTypedValue(valueType, data):
+    if valueType == TYPE_NULL:
+        return ""
+    if valueType == TYPE_REFERENCE:
+        return "@0x%08X" % data
+    if valueType == TYPE_ATTRIBUTE:
+        return "?0x%08X" % data
+    if valueType == TYPE_FLOAT:
+        return repr(struct.unpack("<f", struct.pack("<I", data))[0])
+    if valueType == TYPE_DIMENSION:
+        return "%s%s" % (_complexToFloat(data), DIMENSION_UNITS[data & 0xf] if (data & 0xf) < len(DIMENSION_UNITS) else "")
+    if valueType == TYPE_FRACTION:
+        return "%s%s" % (_complexToFloat(data) * 100, FRACTION_UNITS[data & 0xf] if (data & 0xf) < len(FRACTION_UNITS) else "")
+    if valueType == TYPE_INT_HEX:
+        return "0x%08x" % data
+    if valueType == TYPE_INT_BOOLEAN:
+        return "true" if data != 0 else "false"
+    if TYPE_FIRST_COLOR_INT <= valueType <= TYPE_LAST_COLOR_INT:
+        return "#%08x" % data
+    #TYPE_INT_DEC and unknown types
+    return str(struct.unpack("<i", struct.pack("<I", data))[0])
+
+
+def _complexToFloat(data):
+    return float(struct.unpack("<i", struct.pack("<I", data & 0xFFFFFF00))[0]) * RADIX_MULTS[(data >> 4) & 3]
+
+def _qualifiedName(namespaceUri, name, prefixes):
+    if namespaceUri and namespaceUri in prefixes:
+        return "%s:%s" % (prefixes[namespaceUri], name)
+    return name
+
+def _escapeXml(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+class _AxmlParser:
+    def __init__(self, data):
+        self.data = data
+        self.strings = []
+        self.resourceIds = []
+
+    def parse(self):
+        if len(self.data) < 8:
+            raise AxmlException("The data is too short to be a binary XML")
+        (chunkType, headerSize, size) = struct.unpack_from(CHUNK_HEADER, self.data, 0)
+        if chunkType != RES_XML_TYPE:
+            raise AxmlException("Not a binary XML: chunk type 0x%04x" % chunkType)
+        size = min(size, len(self.data))
+
+        document = AxmlDocument()
+        stack = []
+        pendingNamespaces = []
+        openNamespaces = []
+        offset = headerSize
+        while offset + 8 <= size:
+            (chunkType, chunkHeaderSize, chunkSize) = struct.unpack_from(CHUNK_HEADER, self.data, offset)
+            if chunkSize < 8 or offset + chunkSize > size:
+                raise AxmlException("Corrupted chunk at offset %d" % offset)
+
+            if chunkType == RES_STRING_POOL_TYPE:
+                document.utf8 = self._parseStringPool(offset)
+            elif chunkType == RES_XML_RESOURCE_MAP_TYPE:
+                count = (chunkSize - chunkHeaderSize) / 4
+                self.resourceIds = list(struct.unpack_from("<%dI" % count, self.data, offset + chunkHeaderSize))
+            elif RES_XML_START_NAMESPACE_TYPE <= chunkType <= RES_XML_CDATA_TYPE:
+                (_, _, _, lineNumber, comment) = struct.unpack_from(NODE_HEADER, self.data, offset)
+                comment = self._getString(comment)
+                ext = offset + chunkHeaderSize
+                if chunkType == RES_XML_START_NAMESPACE_TYPE:
+                    (prefix, uri) = struct.unpack_from(NAMESPACE_EXT, self.data, ext)
+                    namespace = AxmlNamespace(self._getString(prefix), self._getString(uri), lineNumber, comment)
+                    pendingNamespaces.append(namespace)
+                    openNamespaces.append(namespace)
+                elif chunkType == RES_XML_END_NAMESPACE_TYPE:
+                    if openNamespaces:
+                        namespace = openNamespaces.pop()
+                        namespace.endLineNumber = lineNumber
+                        namespace.endComment = comment
+                elif chunkType == RES_XML_START_ELEMENT_TYPE:
+                    element = self._parseStartElement(ext, lineNumber, comment)
+                    element.namespaces = pendingNamespaces
+                    pendingNamespaces = []
+                    if stack:
+                        stack[-1].appendChild(element)
+                    elif document.root is None:
+                        document.root = element
+                    else:
+                        raise AxmlException("More than one root element")
+                    stack.append(element)
+                elif chunkType == RES_XML_END_ELEMENT_TYPE:
+                    if not stack:
+                        raise AxmlException("Unbalanced end element at offset %d" % offset)
+                    element = stack.pop()
+                    element.endLineNumber = lineNumber
+                    element.endComment = comment
+                elif chunkType == RES_XML_CDATA_TYPE:
+                    (data, _, _, _, _) = struct.unpack_from(CDATA_EXT, self.data, ext)
+                    if stack:
+                        stack[-1].appendChild(AxmlCData(self._getString(data), lineNumber, comment))
+            else:
+                raise AxmlException("Unsupported chunk type 0x%04x at offset %d" % (chunkType, offset))
+            offset += chunkSize
+
+        if document.root is None:
+            raise AxmlException("No root element found")
+        mappedCount = len(self.resourceIds)
+        document._poolStrings = self.strings[mappedCount:]
+        return document
+
+    def _parseStringPool(self, offset):
+        (_, headerSize, size, stringCount, styleCount, flags, stringsStart, stylesStart) = \
+            struct.unpack_from(STRING_POOL_HEADER, self.data, offset)
+        if styleCount > 0:
+            raise AxmlException("Styled strings are not supported in binary XML")
+        utf8 = (flags & UTF8_FLAG) != 0
+        offsets = struct.unpack_from("<%dI" % stringCount, self.data, offset + headerSize)
+        base = offset + stringsStart
+        self.strings = []
+        for stringOffset in offsets:
+            if utf8:
+                self.strings.append(self._decodeUtf8String(base + stringOffset))
+            else:
+                self.strings.append(self._decodeUtf16String(base + stringOffset))
+        return utf8
+
+    def _decodeUtf8String(self, pos):
+        #the first length is in utf-16 units, the second one is in bytes
+        (_, pos) = self._decodeUtf8Length(pos)
+        (length, pos) = self._decodeUtf8Length(pos)
+        return self.data[pos:pos + length].decode("utf-8", "replace")
+
+    def _decodeUtf8Length(self, pos):
+        length = ord(self.data[pos])
+        if length & 0x80:
+            return (((length & 0x7f) << 8) | ord(self.data[pos + 1]), pos + 2)
+        return (length, pos + 1)
+
+    def _decodeUtf16String(self, pos):
+        (length,) = struct.unpack_from("<H", self.data, pos)
+        pos += 2
+        if length & 0x8000:
+            (low,) = struct.unpack_from("<H", self.data, pos)
+            length = ((length & 0x7fff) << 16) | low
+            pos += 2
+        return self.data[pos:pos + length * 2].decode("utf-16-le", "replace")
+
+    def _getString(self, index):
+        if index == NO_INDEX:
+            return None
+        if index >= len(self.strings):
+            raise AxmlException("String index %d is out of range" % index)
+        return self.strings[index]
+
+    def _getResourceId(self, index):
+        if index < len(self.resourceIds):
+            return self.resourceIds[index]
+        return None
+
+    def _parseStartElement(self, ext, lineNumber, comment):
+        (ns, name, attributeStart, attributeSize, attributeCount, idIndex, classIndex, styleIndex) = \
+            struct.unpack_from(ATTR_EXT, self.data, ext)
+        element = AxmlElement(self._getString(ns), self._getString(name), lineNumber, comment)
+        pos = ext + attributeStart
+        for _ in range(attributeCount):
+            (attrNs, attrName, rawValue, _, _, valueType, data) = struct.unpack_from(ATTRIBUTE, self.data, pos)
+            if valueType == TYPE_STRING:
+                data = self._getString(data)
+            attribute = AxmlAttribute(self._getString(attrNs), self._getString(attrName),
+                                      self._getResourceId(attrName), self._getString(rawValue),
+                                      valueType, data)
+            element.attributes.append(attribute)
+            pos += attributeSize
+        element.idAttribute = self._getSpecialAttribute(element, idIndex)
+        element.classAttribute = self._getSpecialAttribute(element, classIndex)
+        element.styleAttribute = self._getSpecialAttribute(element, styleIndex)
+        return element
+
+    def _getSpecialAttribute(self, element, index):
+        #indexes are 1-based, 0 means no attribute
+        if 0 < index <= len(element.attributes):
+            return element.attributes[index - 1]
+        return None
+
+
+class _AxmlSerializer:
+    def __init__(self, document):
+        self.document = document
+        self.mappedNames = []
+        self.mappedIndexes = {}
+        self.strings = []
+        self.stringIndexes = {}
+
+    def serialize(self):
+        #attribute names with resource ids occupy the beginning of the pool
+        for element in self.document.root.iterElements():
+            for attribute in element.attributes:
+                if attribute.resourceId is not None:
+                    key = (attribute.name, attribute.resourceId)
+                    if key not in self.mappedIndexes:
+                        self.mappedIndexes[key] = len(self.mappedNames)
+                        self.mappedNames.append(key)
+        for string in self.document._poolStrings:
+            self._addString(string)
+
+        nodes = []
+        self._serializeElement(self.document.root, nodes)
+        nodesData = "".join(nodes)
+
+        stringPool = self._serializeStringPool()
+        resourceMap = ""
+        if self.mappedNames:
+            ids = [resourceId for (_, resourceId) in self.mappedNames]
+            resourceMap = struct.pack(CHUNK_HEADER, RES_XML_RESOURCE_MAP_TYPE, 8, 8 + 4 * len(ids)) + \
+                struct.pack("<%dI" % len(ids), *ids)
+        body = stringPool + resourceMap + nodesData
+        return struct.pack(CHUNK_HEADER, RES_XML_TYPE, 8, 8 + len(body)) + body
+
+    def _addString(self, string):
+        if string not in self.stringIndexes:
+            self.stringIndexes[string] = len(self.strings)
+            self.strings.append(string)
+
+    def _ref(self, string):
+        if string is None:
+            return NO_INDEX
+        self._addString(string)
+        return len(self.mappedNames) + self.stringIndexes[string]
+
+    def _attrNameRef(self, attribute):
+        if attribute.resourceId is not None:
+            return self.mappedIndexes[(attribute.name, attribute.resourceId)]
+        return self._ref(attribute.name)
+
+    def _node(self, chunkType, lineNumber, comment, ext):
+        header = struct.pack(NODE_HEADER, chunkType, 16, 16 + len(ext), lineNumber, self._ref(comment))
+        return header + ext
+
+    def _serializeElement(self, element, nodes):
+        for namespace in element.namespaces:
+            nodes.append(self._node(RES_XML_START_NAMESPACE_TYPE, namespace.lineNumber, namespace.comment,
+                                    struct.pack(NAMESPACE_EXT, self._ref(namespace.prefix), self._ref(namespace.uri))))
+
+        attributes = []
+        for attribute in element.attributes:
+            data = attribute.data
+            if attribute.valueType == TYPE_STRING:
+                data = self._ref(data)
+            attributes.append(struct.pack(ATTRIBUTE, self._ref(attribute.namespaceUri),
+                                          self._attrNameRef(attribute), self._ref(attribute.rawValue),
+                                          8, 0, attribute.valueType, data & 0xFFFFFFFF))
+        ext = struct.pack(ATTR_EXT, self._ref(element.namespaceUri), self._ref(element.name),
+                          20, 20, len(attributes),
+                          self._specialIndex(element, element.idAttribute),
+                          self._specialIndex(element, element.classAttribute),
+                          self._specialIndex(element, element.styleAttribute))
+        nodes.append(self._node(RES_XML_START_ELEMENT_TYPE, element.lineNumber, element.comment, ext + "".join(attributes)))
+
+        for child in element.children:
+            if isinstance(child, AxmlElement):
+                self._serializeElement(child, nodes)
+            else:
+                ext = struct.pack(CDATA_EXT, self._ref(child.text), 8, 0, TYPE_NULL, 0)
+                nodes.append(self._node(RES_XML_CDATA_TYPE, child.lineNumber, child.comment, ext))
+
+        nodes.append(self._node(RES_XML_END_ELEMENT_TYPE, element.endLineNumber, element.endComment,
+                                struct.pack(END_ELEMENT_EXT, self._ref(element.namespaceUri), self._ref(element.name))))
+
+        for namespace in reversed(element.namespaces):
+            nodes.append(self._node(RES_XML_END_NAMESPACE_TYPE, namespace.endLineNumber, namespace.endComment,
+                                    struct.pack(NAMESPACE_EXT, self._ref(namespace.prefix), self._ref(namespace.uri))))
+
+    def _specialIndex(self, element, attribute):
+        if attribute is None or attribute not in element.attributes:
+            return 0
+        return element.attributes.index(attribute) + 1
+
+    def _serializeStringPool(self):
+        allStrings = [name for (name, _) in self.mappedNames] + self.strings
+        utf8 = self.document.utf8
+        if utf8 and not all([self._fitsUtf8Pool(string) for string in allStrings]):
+            #a string is too long for the 15 bit lengths of a UTF-8 pool
+            utf8 = False
+        offsets = []
+        data = []
+        length = 0
+        for string in allStrings:
+            offsets.append(length)
+            encoded = self._encodeString(string, utf8)
+            data.append(encoded)
+            length += len(encoded)
+        data = "".join(data)
+        data += "\0" * ((4 - len(data) % 4) % 4)
+
+        headerSize = struct.calcsize(STRING_POOL_HEADER)
+        stringsStart = headerSize + 4 * len(allStrings)
+        size = stringsStart + len(data)
+        flags = UTF8_FLAG if utf8 else 0
+        header = struct.pack(STRING_POOL_HEADER, RES_STRING_POOL_TYPE, headerSize, size,
+                             len(allStrings), 0, flags, stringsStart, 0)
+        return header + struct.pack("<%dI" % len(offsets), *offsets) + data
+
+    def _fitsUtf8Pool(self, string):
+        if not isinstance(string, unicode):
+            string = string.decode("utf-8")
+        return max(len(string.encode("utf-16-le")) / 2, len(string.encode("utf-8"))) <= MAX_UTF8_LENGTH
+
+    def _encodeString(self, string, utf8):
+        if not isinstance(string, unicode):
+            string = string.decode("utf-8")
+        utf16 = string.encode("utf-16-le")
+        units = len(utf16) / 2
+        if utf8:
+            encoded = string.encode("utf-8")
+            return self._encodeUtf8Length(units) + self._encodeUtf8Length(len(encoded)) + encoded + "\0"
+        if units > 0x7fff:
+            prefix = struct.pack("<HH", 0x8000 | (units >> 16), units & 0xffff)
+        else:
+            prefix = struct.pack("<H", units)
+        return prefix + utf16 + "\0\0"
+
+    def _encodeUtf8Length(self, length):
+        if length > MAX_UTF8_LENGTH:
+            raise AxmlException("String of %d characters does not fit into a UTF-8 string pool" % length)
+        if length > 0x7f:
+            return chr(0x80 | ((length >> 8) & 0x7f)) + chr(length & 0xff)
+        return chr(length)
+
+
+#Exceptions
+class AxmlException(MsgException):
+    '''
+    The data is not a valid (or supported) binary XML.
+    '''
@@ -0,0 +1,185 @@
+'''
+Estimation of the number of method and field references of java classes.
+
+dx puts every method and field that a class declares or references into the
+method_ids and field_ids tables of the dex file. Both tables are indexed with
+16 bits, so a dex file cannot hold more than 65536 entries in each of them.
+The references are collected from the constant pools of the class files, so
+the estimation of the dex file is available before dx is run.
+'''
+import os
+import struct
+import zipfile
+
+from bbox_core.general_exceptions import MsgException
+
+
+CONSTANT_UTF8 = 1
+CONSTANT_CLASS = 7
+CONSTANT_FIELDREF = 9
+CONSTANT_METHODREF = 10
+CONSTANT_INTERFACE_METHODREF = 11
+CONSTANT_NAME_AND_TYPE = 12
+
+#sizes of the constant pool entries that are not used for the estimation
+CONSTANT_SIZES = {
+    3 : 4,  #Integer
+    4 : 4,  #Float
+    5 : 8,  #Long
+    6 : 8,  #Double
+    8 : 2,  #String
+    15 : 3, #MethodHandle
+    16 : 2, #MethodType
+    17 : 4, #Dynamic
+    18 : 4, #InvokeDynamic
+    19 : 2, #Module
+    20 : 2, #Package
+}
+
+CLASS_FILE_MAGIC = 0xCAFEBABE
+
+
+class ReferenceCounter:
+    '''
+    Collects unique method and field references of class files.
+    '''
+    def __init__(self):
+        self.methods = set()
+        self.fields = set()
+        self.classes = set()
+
+    def addPath(self, path):
+        '''
+        Adds the classes of a jar file, a directory or a class file.
+
+        Raises:
+            ClassFileException: if a class file cannot be parsed
+        '''
+        for (name, data) in iterClassFiles(path):
+            self.addClass(data, name)
+
+    def addClass(self, data, name="<class>"):
+        (className, methods, fields) = parseClassReferences(data, name)
+        self.classes.add(className)
+        self.methods.update(methods)
+        self.fields.update(fields)
+
+    def getMethodCount(self):
+        return len(self.methods)
+
+    def getFieldCount(self):
+        return len(self.fields)
+
+
+def iterClassFiles(path):
+    '''
+    Yields (class file name relative to the classpath root, bytes) of the
+    classes of a jar file, a directory or a class file.
+    '''
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.endswith(".class"):
+                    absPath = os.path.join(root, fn)
+                    with open(absPath, "rb") as f:
+                        yield (os.path.relpath(absPath, path).replace(os.sep, "/"), f.read())
+    elif path.endswith(".class"):
+        with open(path, "rb") as f:
+            yield (os.path.basename(path), f.read())
+    else:
+        with zipfile.ZipFile(path, "r") as jar:
+            for zinfo in jar.infolist():
+                if zinfo.filename.endswith(".class"):
+                    yield (zinfo.filename, jar.read(zinfo))
+
+
+def listClassFiles(path):
+    '''
+    Returns the names of the class files (e.g., com/example/Main.class) of a
+    jar file, a directory or a class file.
+    '''
+    return [name for (name, _) in iterClassFiles(path)]
+
+
+def parseClassReferences(data, name="<class>"):
+    '''
+    Returns the tuple (class name, set of method references, set of field
+    references). A reference is a tuple (class name, member name, descriptor);
+    the members declared by the class are references too.
+
+    Raises:
+        ClassFileException: if the data is not a valid class file
+    '''
+    try:
+        return _parseClassReferences(data, name)
+    except (struct.error, IndexError, KeyError) as e:
+        raise ClassFileException("Cannot parse class file [%s]: %s" % (name, str(e)))
+
+
+def _parseClassReferences(data, name):
+    (magic,) = struct.unpack_from(">I", data, 0)
+    if magic != CLASS_FILE_MAGIC:
+        raise ClassFileException("[%s] is not a class file" % name)
+    (cpCount,) = struct.unpack_from(">H", data, 8)
+    offset = 10
+    utf8 = {}
+    classes = {}
+    nameAndTypes = {}
+    memberRefs = []
+    index = 1
+    while index < cpCount:
+        tag = ord(data[offset])
+        offset += 1
+        if tag == CONSTANT_UTF8:
+            (length,) = struct.unpack_from(">H", data, offset)
+            utf8[index] = data[offset+2:offset+2+length]
+            offset += 2 + length
+        elif tag == CONSTANT_CLASS:
+            (classes[index],) = struct.unpack_from(">H", data, offset)
+            offset += 2
+        elif tag in (CONSTANT_FIELDREF, CONSTANT_METHODREF, CONSTANT_INTERFACE_METHODREF):
+            memberRefs.append((tag,) + struct.unpack_from(">HH", data, offset))
+            offset += 4
+        elif tag == CONSTANT_NAME_AND_TYPE:
+            nameAndTypes[index] = struct.unpack_from(">HH", data, offset)
+            offset += 4
+        elif tag in CONSTANT_SIZES:
+            offset += CONSTANT_SIZES[tag]
+        else:
+            raise ClassFileException("Unknown constant pool tag %d in [%s]" % (tag, name))
+        #long and double take two entries
+        index += 2 if tag in (5, 6) else 1
+
+    methods = set()
+    fields = set()
+    for (tag, classIndex, nameAndTypeIndex) in memberRefs:
+        (nameIndex, descIndex) = nameAndTypes[nameAndTypeIndex]
+        ref = (utf8[classes[classIndex]], utf8[nameIndex], utf8[descIndex])
+        if tag == CONSTANT_FIELDREF:
+            fields.add(ref)
+        else:
+            methods.add(ref)
+
+    (thisClassIndex,) = struct.unpack_from(">H", data, offset + 2)
+    className = utf8[classes[thisClassIndex]]
+    (interfacesCount,) = struct.unpack_from(">H", data, offset + 6)
+    offset += 8 + 2 * interfacesCount
+    for members in (fields, methods):
+        (count,) = struct.unpack_from(">H", data, offset)
+        offset += 2
+        for _ in range(count):
+            (nameIndex, descIndex, attributesCount) = struct.unpack_from(">HHH", data, offset + 2)
+            members.add((className, utf8[nameIndex], utf8[descIndex]))
+            offset += 8
+            for _ in range(attributesCount):
+                (length,) = struct.unpack_from(">I", data, offset + 2)
+                offset += 6 + length
+    return (className, methods, fields)
+
+
+#Exceptions
+class ClassFileException(MsgException):
+    '''
+    The class file cannot be parsed.
+    '''
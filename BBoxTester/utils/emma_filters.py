@@ -0,0 +1,144 @@
+'''
+Class filters of Emma instrumentation.
+
+Emma instruments only the classes that match one of the inclusion patterns
+(all classes if there is none) and do not match any exclusion pattern. The
+patterns are class names with "*" wildcards, e.g., com.example.* covers the
+package com.example and its subpackages.
+
+The automatic filters include the package of the application and the
+packages of its components (declared in AndroidManifest.xml) and exclude
+well-known third-party libraries bundled into apps.
+'''
+
+#well-known libraries bundled into apps (support libraries, ad and analytics
+#SDKs, common java libraries)
+THIRD_PARTY_PACKAGES = [
+    "android.support",
+    "androidx",
+    "android.arch",
+    "com.google.android.gms",
+    "com.google.android.exoplayer2",
+    "com.google.ads",
+    "com.google.firebase",
+    "com.google.common",
+    "com.google.gson",
+    "com.google.protobuf",
+    "com.google.zxing",
+    "com.facebook",
+    "com.squareup",
+    "okhttp3",
+    "okio",
+    "retrofit2",
+    "io.reactivex",
+    "rx",
+    "kotlin",
+    "kotlinx",
+    "dagger",
+    "butterknife",
+    "javax",
+    "org.apache",
+    "org.json",
+    "org.greenrobot",
+    "org.jsoup",
+    "com.fasterxml.jackson",
+    "com.bumptech.glide",
+    "com.nostra13.universalimageloader",
+    "com.crashlytics",
+    "io.fabric",
+    "com.flurry",
+    "com.mopub",
+    "com.unity3d",
+    "com.applovin",
+    "com.inmobi",
+    "com.chartboost",
+    "com.millennialmedia",
+    "com.startapp",
+    "com.amazon.device.ads",
+    "com.adjust.sdk",
+    "com.appsflyer",
+    "twitter4j",
+]
+
+#manifest elements declaring classes of the app
+COMPONENT_TAGS = ["application", "activity", "activity-alias", "service", "receiver", "provider", "instrumentation"]
+
+
+def getAutoFilterPackages(androidManifest):
+    '''
+    Derives the packages to instrument from the manifest.
+
+    Args:
+        :param androidManifest: AndroidManifest of the app
+
+    Returns:
+        :ret tuple (included packages, excluded packages)
+    '''
+    appPackage = androidManifest.getPackageName()
+    packages = set()
+    if appPackage:
+        packages.add(appPackage)
+    for tag in COMPONENT_TAGS:
+        for className in androidManifest.getElements(tag, "android:name"):
+            if "." not in className:
+                continue
+            package = className.rsplit(".", 1)[0]
+            #components of bundled libraries are not instrumented
+            if not _isThirdPartyPackage(package) or _isSubpackage(appPackage, package):
+                packages.add(package)
+
+    includes = _removeSubpackages(packages)
+    #a library package must not exclude the app itself (e.g., com.facebook.katana)
+    excludes = [pkg for pkg in THIRD_PARTY_PACKAGES
+                if not any(_isSubpackage(include, pkg) for include in includes)]
+    return (includes, excludes)
+
+
+def buildEmmaFilters(includes=[], excludes=[]):
+    '''
+    Returns the list of Emma filters (e.g., ["+com.example.*", "-com.example.ads.*"]).
+    The items are packages or class patterns; a package covers its
+    subpackages. Excluded packages that do not overlap any included package
+    are dropped: such classes are not instrumented anyway.
+    '''
+    filters = []
+    for pattern in includes:
+        filters.append("+%s" % _toPattern(pattern))
+    for pattern in excludes:
+        if includes and not _overlapsAny(pattern, includes):
+            continue
+        filters.append("-%s" % _toPattern(pattern))
+    return filters
+
+
+def parseFilterList(value):
+    '''
+    Splits the comma (or whitespace) separated list of packages or patterns.
+    '''
+    return [item for item in value.replace(",", " ").split() if item]
+
+
+def _toPattern(package):
+    if "*" in package:
+        return package
+    return "%s.*" % package
+
+def _isThirdPartyPackage(package):
+    return any(_isSubpackage(package, thirdParty) for thirdParty in THIRD_PARTY_PACKAGES)
+
+def _isSubpackage(package, parent):
+    '''
+    Checks if the package is the parent package or one of its subpackages.
+    '''
+    if not package or not parent:
+        return False
+    return package == parent or package.startswith(parent + ".")
+
+def _overlapsAny(pattern, packages):
+    if "*" in pattern or any("*" in pkg for pkg in packages):
+        return True
+    return any(_isSubpackage(pattern, pkg) or _isSubpackage(pkg, pattern) for pkg in packages)
+
+def _removeSubpackages(packages):
+    return sorted([pkg for pkg in packages
+                   if not any(other != pkg and _isSubpackage(pkg, other) for other in packages)])
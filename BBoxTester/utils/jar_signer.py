@@ -0,0 +1,270 @@
+'''
+Computation of the jar signature (v1 apk signature scheme) of apk files.
+
+The builder collects the digests of the entries (either while the apk file
+is being written or computed in parallel over the existing apk file) and
+produces the contents of META-INF/MANIFEST.MF and of the signature file (.SF).
+The signature block (.RSA) that signs the signature file is created by an
+external function, so the builder does not depend on a crypto implementation.
+
+The manifests do not contain timestamps and list the entries sorted by name,
+so signing the same apk file always gives the same bytes.
+'''
+import os
+import zlib
+import mmap
+import base64
+import hashlib
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from bbox_core.general_exceptions import MsgException
+from utils import apk_utils
+from utils.apk_writer import getEntryDataOffset, getDecompressor, \
+    ApkWriterException
+
+
+MANIFEST_ENTRY_NAME = "META-INF/MANIFEST.MF"
+SIGNATURE_FILE_ENTRY_NAME = "META-INF/CERT.SF"
+SIGNATURE_BLOCK_ENTRY_NAME = "META-INF/CERT.RSA"
+
+DEFAULT_CREATED_BY = "1.0 (BBoxTester)"
+MANIFEST_LINE_LENGTH = 72
+#fixed modification time of the signature entries (reproducible apk files)
+SIGNATURE_ENTRY_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+#jar digest name : hashlib algorithm name
+DIGEST_ALGORITHMS = {
+    "SHA1" : "sha1",
+    "SHA-256" : "sha256",
+}
+
+#location of the test key used by dex2jar ApkSign tool
+DEX2JAR_TEST_KEY_ENTRY = "com/googlecode/dex2jar/tools/ApkSign.private"
+DEX2JAR_TEST_CERT_ENTRY = "com/googlecode/dex2jar/tools/ApkSign.cer"
+
+
+class JarSignatureBuilder:
+    def __init__(self, digestAlgorithm="SHA1", createdBy=DEFAULT_CREATED_BY):
+        '''
+        Args:
+            :param digestAlgorithm: name of the digest algorithm used in the
+                manifest (SHA1 is supported by all Android versions)
+            :param createdBy: value of Created-By attribute
+        '''
+        if digestAlgorithm not in DIGEST_ALGORITHMS:
+            raise JarSignerException("Unsupported digest algorithm: %s" % digestAlgorithm)
+        self.digestAlgorithm = digestAlgorithm
+        self.createdBy = createdBy
+        self._digests = {}
+        self._pendingDigests = {}
+
+    def createDigest(self):
+        '''
+        Returns a new hashlib object to compute the digest of an entry.
+        '''
+        return hashlib.new(DIGEST_ALGORITHMS[self.digestAlgorithm])
+
+    def createEntryListener(self, name):
+        '''
+        Registers an entry of the apk file.
+
+        Returns:
+            :ret callable that receives the uncompressed data of the entry 
+                chunk by chunk; the digest is taken when the manifest is built
+        '''
+        digest = self.createDigest()
+        if isSignedEntry(name):
+            self._pendingDigests[name] = digest
+        return digest.update
+
+    def addEntryDigest(self, name, digest):
+        '''
+        Records the binary digest of the uncompressed data of an entry.
+        '''
+        if isSignedEntry(name):
+            self._digests[name] = digest
+
+    def buildManifest(self):
+        '''
+        Returns:
+            :ret tuple (contents of the manifest, main section of the 
+                manifest, list of (entry name, manifest section of the entry))
+        '''
+        header = self._formatSection([("Manifest-Version", "1.0"),
+                                      ("Created-By", self.createdBy)])
+        digests = dict(self._digests)
+        for (name, digest) in self._pendingDigests.iteritems():
+            digests[name] = digest.digest()
+        sections = []
+        for name in sorted(digests):
+            section = self._formatSection([("Name", name),
+                                           (self._getDigestAttributeName(), base64.b64encode(digests[name]))])
+            sections.append((name, section))
+        manifest = header + "".join([section for (_, section) in sections])
+        return (manifest, header, sections)
+
+    def buildSignatureFile(self, manifest, manifestHeader, manifestSections):
+        '''
+        Returns the contents of the signature file that covers the manifest.
+        '''
+        attrName = self._getDigestAttributeName()
+        signatureFile = self._formatSection([("Signature-Version", "1.0"),
+                                             ("Created-By", self.createdBy),
+                                             ("%s-Manifest" % attrName, self._digestB64(manifest)),
+                                             ("%s-Manifest-Main-Attributes" % attrName, self._digestB64(manifestHeader))])
+        for (name, section) in manifestSections:
+            signatureFile += self._formatSection([("Name", name),
+                                                  (attrName, self._digestB64(section))])
+        return signatureFile
+
+    def getSignatureEntries(self, createSignatureBlock):
+        '''
+        Builds the signature entries of the apk file.
+
+        Args:
+            :param createSignatureBlock: function that receives the contents of
+                the signature file and returns detached PKCS#7 signature of it
+                (DER encoded)
+
+        Returns:
+            :ret list of tuples (entry name, data) in the order they should be
+                written
+        '''
+        (manifest, header, sections) = self.buildManifest()
+        signatureFile = self.buildSignatureFile(manifest, header, sections)
+        signatureBlock = createSignatureBlock(signatureFile)
+        return [(MANIFEST_ENTRY_NAME, manifest),
+                (SIGNATURE_FILE_ENTRY_NAME, signatureFile),
+                (SIGNATURE_BLOCK_ENTRY_NAME, signatureBlock)]
+
+
+    def _getDigestAttributeName(self):
+        return "%s-Digest" % self.digestAlgorithm
+
+    def _digestB64(self, data):
+        digest = self.createDigest()
+        digest.update(data)
+        return base64.b64encode(digest.digest())
+
+    def _formatSection(self, attributes):
+        lines = []
+        for (name, value) in attributes:
+            lines.append(_wrapManifestLine(_encodeValue("%s: %s" % (name, value))))
+        return "".join(lines) + "\r\n"
+
+
+def isSignedEntry(name):
+    '''
+    Checks if the entry has to be listed in the manifest: directories and the
+    signature entries are not.
+    '''
+    return not name.endswith("/") and not apk_utils.isSignatureEntry(name)
+
+
+def computeEntryDigests(pathToApk, zinfos, createDigest, workers=4):
+    '''
+    Computes the digests of the uncompressed data of the entries in a thread
+    pool. The apk file is memory-mapped, so the threads do not share a file
+    position; zlib and hashlib release the GIL on large buffers.
+
+    Args:
+        :param pathToApk: path to the apk file
+        :param zinfos: list of zipfile.ZipInfo of the entries
+        :param createDigest: function that returns a new hashlib object
+        :param workers: number of threads
+
+    Returns:
+        :ret dict {entry name : binary digest}
+    '''
+    if not zinfos:
+        return {}
+    with open(pathToApk, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        #local headers are read sequentially, the data is processed in parallel
+        tasks = [(zinfo, getEntryDataOffset(data, zinfo)) for zinfo in zinfos]
+        
+        def digestEntry(task):
+            (zinfo, offset) = task
+            digest = createDigest()
+            decompressor = getDecompressor(zinfo)
+            end = offset + zinfo.compress_size
+            while offset < end:
+                chunkEnd = min(offset + DIGEST_CHUNK_SIZE, end)
+                digest.update(decompressor.decompress(data[offset:chunkEnd]))
+                offset = chunkEnd
+            digest.update(decompressor.flush())
+            return (zinfo.filename, digest.digest())
+        
+        if workers > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                results = pool.map(digestEntry, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [digestEntry(task) for task in tasks]
+    except ApkWriterException as e:
+        raise JarSignerException("Cannot compute digests of entries of [%s]. ERRSTR: %s" % (pathToApk, e.msg))
+    except (zlib.error, ValueError) as e:
+        raise JarSignerException("Cannot compute digests of entries of [%s]. ERRSTR: %s" % (pathToApk, str(e)))
+    finally:
+        data.close()
+    return dict(results)
+
+
+def loadDex2JarTestKey(pathDex2JarLibs):
+    '''
+    Reads the test key and certificate used by dex2jar ApkSign tool.
+
+    Returns:
+        :ret tuple (PKCS#8 DER encoded private key, DER encoded certificate)
+    '''
+    if os.path.isdir(pathDex2JarLibs):
+        for fn in sorted(os.listdir(pathDex2JarLibs)):
+            if not fn.endswith(".jar"):
+                continue
+            try:
+                with zipfile.ZipFile(os.path.join(pathDex2JarLibs, fn), "r") as jar:
+                    names = jar.namelist()
+                    if DEX2JAR_TEST_KEY_ENTRY in names and DEX2JAR_TEST_CERT_ENTRY in names:
+                        return (jar.read(DEX2JAR_TEST_KEY_ENTRY), jar.read(DEX2JAR_TEST_CERT_ENTRY))
+            except zipfile.BadZipfile:
+                continue
+    raise JarSignerException("Cannot find dex2jar test key in [%s]" % pathDex2JarLibs)
+
+
+def derToPem(der, label):
+    '''
+    Converts DER encoded data into PEM format (label is, e.g., CERTIFICATE or
+    PRIVATE KEY).
+    '''
+    b64 = base64.b64encode(der)
+    lines = [b64[i:i + 64] for i in range(0, len(b64), 64)]
+    return "-----BEGIN %s-----\n%s\n-----END %s-----\n" % (label, "\n".join(lines), label)
+
+
+def _encodeValue(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def _wrapManifestLine(line):
+    #lines of manifest cannot be longer than 72 bytes, the continuation lines
+    #start with a space
+    wrapped = line[:MANIFEST_LINE_LENGTH] + "\r\n"
+    rest = line[MANIFEST_LINE_LENGTH:]
+    while rest:
+        wrapped += " " + rest[:MANIFEST_LINE_LENGTH - 1] + "\r\n"
+        rest = rest[MANIFEST_LINE_LENGTH - 1:]
+    return wrapped
+
+
+#Exceptions
+class JarSignerException(MsgException):
+    '''
+    The jar signature cannot be created.
+    '''
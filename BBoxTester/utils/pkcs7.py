@@ -0,0 +1,257 @@
+'''
+Minimal PKCS#7 support needed to sign jar files without external tools.
+
+Only what the signature block of a jar file requires is implemented: reading
+an RSA private key (PKCS#8 or PKCS#1, DER encoded), reading the issuer and the
+serial number of an X.509 certificate and creating a detached SignedData
+structure without signed attributes (RSA PKCS#1 v1.5 signature).
+'''
+import hashlib
+
+from bbox_core.general_exceptions import MsgException
+
+
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+TAG_CONTEXT_0 = 0xA0
+
+OID_DATA = "1.2.840.113549.1.7.1"
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_RSA_ENCRYPTION = "1.2.840.113549.1.1.1"
+
+#hashlib algorithm name : oid
+DIGEST_OIDS = {
+    "sha1" : "1.3.14.3.2.26",
+    "sha256" : "2.16.840.1.101.3.4.2.1",
+}
+
+
+class RsaPrivateKey:
+    def __init__(self, modulus, publicExponent, privateExponent,
+                 prime1=None, prime2=None, exponent1=None, exponent2=None, coefficient=None):
+        self.modulus = modulus
+        self.publicExponent = publicExponent
+        self.privateExponent = privateExponent
+        self.prime1 = prime1
+        self.prime2 = prime2
+        self.exponent1 = exponent1
+        self.exponent2 = exponent2
+        self.coefficient = coefficient
+
+    @staticmethod
+    def fromDer(der):
+        '''
+        Reads PKCS#8 PrivateKeyInfo or PKCS#1 RSAPrivateKey structure.
+        '''
+        (tag, content, _) = _readTlv(der, 0)
+        if tag != TAG_SEQUENCE:
+            raise Pkcs7Exception("Private key is not a DER sequence")
+        items = _readSequence(content)
+        if len(items) >= 3 and items[1][0] == TAG_SEQUENCE and items[2][0] == TAG_OCTET_STRING:
+            #PKCS#8: version, algorithm, privateKey
+            algorithm = _readSequence(items[1][1])
+            if _decodeOid(algorithm[0][1]) != OID_RSA_ENCRYPTION:
+                raise Pkcs7Exception("Only RSA private keys are supported")
+            return RsaPrivateKey.fromDer(items[2][1])
+        if len(items) < 9 or any(itemTag != TAG_INTEGER for (itemTag, _) in items[:9]):
+            raise Pkcs7Exception("Unknown format of private key")
+        values = [_decodeInteger(value) for (_, value) in items[1:9]]
+        return RsaPrivateKey(*values)
+
+    def getModulusLength(self):
+        return (self.modulus.bit_length() + 7) // 8
+
+    def sign(self, digestInfo):
+        '''
+        Creates RSA PKCS#1 v1.5 signature of the DER encoded DigestInfo.
+        '''
+        length = self.getModulusLength()
+        if len(digestInfo) > length - 11:
+            raise Pkcs7Exception("Key is too short for the digest")
+        encoded = "\x00\x01" + "\xff" * (length - len(digestInfo) - 3) + "\x00" + digestInfo
+        message = _bytesToInt(encoded)
+        if self.prime1 and self.prime2 and self.exponent1 and self.exponent2 and self.coefficient:
+            #Chinese remainder theorem is ~3 times faster
+            m1 = pow(message, self.exponent1, self.prime1)
+            m2 = pow(message, self.exponent2, self.prime2)
+            h = (self.coefficient * (m1 - m2)) % self.prime1
+            signature = m2 + h * self.prime2
+        else:
+            signature = pow(message, self.privateExponent, self.modulus)
+        return _intToBytes(signature, length)
+
+
+def getIssuerAndSerialNumber(certDer):
+    '''
+    Returns DER encoded IssuerAndSerialNumber structure of the certificate.
+    '''
+    (tag, content, _) = _readTlv(certDer, 0)
+    if tag != TAG_SEQUENCE:
+        raise Pkcs7Exception("Certificate is not a DER sequence")
+    (tbsTag, tbsContent, _) = _readTlv(content, 0)
+    if tbsTag != TAG_SEQUENCE:
+        raise Pkcs7Exception("Unknown format of certificate")
+    items = _readRawSequence(tbsContent)
+    #version is optional explicitly tagged field
+    if items[0][0] == TAG_CONTEXT_0:
+        items = items[1:]
+    (serialTag, serial) = items[0]
+    (issuerTag, issuer) = items[2]
+    if serialTag != TAG_INTEGER or issuerTag != TAG_SEQUENCE:
+        raise Pkcs7Exception("Unknown format of certificate")
+    return encodeSequence(issuer, serial)
+
+
+def createSignedData(data, key, certDer, digestAlgorithm="sha1"):
+    '''
+    Creates detached PKCS#7 SignedData (ContentInfo) of the data without
+    signed attributes, i.e., the signature block of a jar file.
+
+    Args:
+        :param data: signed data (contents of the .SF file)
+        :param key: RsaPrivateKey
+        :param certDer: DER encoded certificate of the key
+        :param digestAlgorithm: hashlib name of the digest algorithm
+    '''
+    if digestAlgorithm not in DIGEST_OIDS:
+        raise Pkcs7Exception("Unsupported digest algorithm: %s" % digestAlgorithm)
+    digestAlgorithmId = encodeSequence(encodeOid(DIGEST_OIDS[digestAlgorithm]), encodeNull())
+    digest = hashlib.new(digestAlgorithm, data).digest()
+    digestInfo = encodeSequence(digestAlgorithmId, encodeOctetString(digest))
+    signature = key.sign(digestInfo)
+
+    signerInfo = encodeSequence(encodeInteger(1),
+                                getIssuerAndSerialNumber(certDer),
+                                digestAlgorithmId,
+                                encodeSequence(encodeOid(OID_RSA_ENCRYPTION), encodeNull()),
+                                encodeOctetString(signature))
+    signedData = encodeSequence(encodeInteger(1),
+                                encodeSet(digestAlgorithmId),
+                                encodeSequence(encodeOid(OID_DATA)),
+                                _encodeTlv(TAG_CONTEXT_0, certDer),
+                                encodeSet(signerInfo))
+    return encodeSequence(encodeOid(OID_SIGNED_DATA), _encodeTlv(TAG_CONTEXT_0, signedData))
+
+
+#DER encoding
+def encodeSequence(*items):
+    return _encodeTlv(TAG_SEQUENCE, "".join(items))
+
+def encodeSet(*items):
+    #DER requires the elements of SET OF to be sorted
+    return _encodeTlv(TAG_SET, "".join(sorted(items)))
+
+def encodeInteger(value):
+    if value < 0:
+        raise Pkcs7Exception("Negative integers are not supported")
+    encoded = _intToBytes(value, (value.bit_length() + 7) // 8 or 1)
+    if ord(encoded[0]) & 0x80:
+        encoded = "\x00" + encoded
+    return _encodeTlv(TAG_INTEGER, encoded)
+
+def encodeOctetString(value):
+    return _encodeTlv(TAG_OCTET_STRING, value)
+
+def encodeNull():
+    return _encodeTlv(TAG_NULL, "")
+
+def encodeOid(oid):
+    parts = [int(part) for part in oid.split(".")]
+    encoded = chr(40 * parts[0] + parts[1])
+    for part in parts[2:]:
+        chunk = chr(part & 0x7F)
+        part >>= 7
+        while part:
+            chunk = chr(0x80 | (part & 0x7F)) + chunk
+            part >>= 7
+        encoded += chunk
+    return _encodeTlv(TAG_OID, encoded)
+
+
+def _encodeTlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        encodedLength = chr(length)
+    else:
+        lengthBytes = _intToBytes(length, (length.bit_length() + 7) // 8)
+        encodedLength = chr(0x80 | len(lengthBytes)) + lengthBytes
+    return chr(tag) + encodedLength + content
+
+
+#DER decoding
+def _readTlv(data, offset):
+    '''
+    Returns:
+        :ret tuple (tag, content, offset of the next element)
+    '''
+    try:
+        tag = ord(data[offset])
+        length = ord(data[offset + 1])
+        offset += 2
+        if length & 0x80:
+            lengthSize = length & 0x7F
+            length = _bytesToInt(data[offset:offset + lengthSize])
+            offset += lengthSize
+    except IndexError:
+        raise Pkcs7Exception("Truncated DER data")
+    if offset + length > len(data):
+        raise Pkcs7Exception("Truncated DER data")
+    return (tag, data[offset:offset + length], offset + length)
+
+def _readSequence(content):
+    '''
+    Returns the list of (tag, content) of the elements.
+    '''
+    items = []
+    offset = 0
+    while offset < len(content):
+        (tag, value, offset) = _readTlv(content, offset)
+        items.append((tag, value))
+    return items
+
+def _readRawSequence(content):
+    '''
+    Returns the list of (tag, DER encoding) of the elements.
+    '''
+    items = []
+    offset = 0
+    while offset < len(content):
+        (tag, _, nextOffset) = _readTlv(content, offset)
+        items.append((tag, content[offset:nextOffset]))
+        offset = nextOffset
+    return items
+
+def _decodeInteger(content):
+    return _bytesToInt(content)
+
+def _decodeOid(content):
+    first = ord(content[0])
+    parts = [first // 40, first % 40]
+    value = 0
+    for c in content[1:]:
+        value = (value << 7) | (ord(c) & 0x7F)
+        if not ord(c) & 0x80:
+            parts.append(value)
+            value = 0
+    return ".".join([str(part) for part in parts])
+
+def _bytesToInt(data):
+    if not data:
+        return 0
+    return int(data.encode("hex"), 16)
+
+def _intToBytes(value, length):
+    encoded = "%x" % value
+    encoded = ("0" * (2 * length - len(encoded))) + encoded
+    return encoded.decode("hex")
+
+
+#Exceptions
+class Pkcs7Exception(MsgException):
+    '''
+    The key, the certificate or the signature cannot be processed.
+    '''
@@ -21,6 +21,14 @@ class StateMachine:
         '''
         self._states = states
         self.currentState = None
+        self._transitionListeners = []
+    
+    def addTransitionListener(self, listener):
+        '''
+        Registers a function called after each transition as 
+        listener(fromState, toState).
+        '''
+        self._transitionListeners.append(listener)
         
     def start(self, startState):
         '''
@@ -80,7 +88,10 @@ class StateMachine:
         if (toState == self.currentState):
             return False
         
+        fromState = self.currentState
         self.currentState = toState
+        for listener in self._transitionListeners:
+            listener(fromState, toState)
         return True
     
     def getCurrentState(self):
@@ -0,0 +1,360 @@
+package com.zhauniarovich.bbtester.toolserver;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.security.MessageDigest;
+import java.security.Permission;
+import java.util.HashMap;
+import java.util.HashSet;
+import java.util.Map;
+import java.util.Set;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.jar.JarFile;
+import java.util.jar.Manifest;
+
+/**
+ * Long-living JVM that runs the main methods of the java tools used by
+ * BBoxTester (apktool, dex2jar, dx, Emma) on request. The jars of a tool are
+ * loaded only once, thus, the subsequent invocations do not pay for the JVM
+ * start and JIT warm-up.
+ *
+ * Protocol (one request per connection, all values in DataOutput format):
+ *   request:  UTF token, UTF classpath, UTF mainClass (empty - take Main-Class
+ *             from the manifest of the first classpath entry), int argc,
+ *             UTF[argc] args
+ *   response: int returnCode, long usedHeapBytes, int outputLength,
+ *             byte[outputLength] output (stdout and stderr of the tool)
+ *
+ * Usage: java -jar toolserver.jar [port]
+ * The token is read from the first line of the standard input; the requests
+ * with another token are rejected, so other local users cannot run code in
+ * the server. The port the server listens to is printed as "PORT <port>" on
+ * the first line of the standard output.
+ *
+ * The tools keep their state in static fields (e.g., dx), so the requests of
+ * one main class are run one at a time; the tools listed in the
+ * toolserver.reentrant property are run concurrently. The output of the
+ * threads started by a tool goes to the request the tool is running for;
+ * for a reentrant tool, the output of the threads started in an earlier
+ * request (e.g., a static thread pool) goes to the standard output of the
+ * server.
+ */
+public class ToolServer {
+    public static final String CMD_PING = "__ping__";
+    public static final String CMD_SHUTDOWN = "__shutdown__";
+
+    //main classes of the tools that keep no global state and can run
+    //concurrently in one JVM
+    private static final String PROP_REENTRANT_TOOLS = "toolserver.reentrant";
+    private static final String DEFAULT_REENTRANT_TOOLS = "";
+
+    private static final InheritableThreadLocal<OutputTarget> capture = new InheritableThreadLocal<OutputTarget>();
+
+    private final ServerSocket serverSocket;
+    private final byte[] token;
+    private final ExecutorService executor = Executors.newCachedThreadPool();
+    private final Map<String, ClassLoader> classLoaders = new HashMap<String, ClassLoader>();
+    private final Map<String, OutputTarget> exclusiveTargets = new HashMap<String, OutputTarget>();
+    private final Set<String> reentrantTools = new HashSet<String>();
+    private volatile boolean running = true;
+
+
+    public ToolServer(int port, String token, String reentrantToolsList) throws IOException {
+        serverSocket = new ServerSocket(port, 50, InetAddress.getByName("127.0.0.1"));
+        this.token = token.getBytes("UTF-8");
+        for (String tool : reentrantToolsList.split(",")) {
+            if (tool.trim().length() > 0) {
+                reentrantTools.add(tool.trim());
+            }
+        }
+    }
+
+    public int getPort() {
+        return serverSocket.getLocalPort();
+    }
+
+    public void serve() {
+        while (running) {
+            final Socket socket;
+            try {
+                socket = serverSocket.accept();
+            } catch (IOException e) {
+                if (running) {
+                    e.printStackTrace();
+                }
+                continue;
+            }
+            executor.execute(new Runnable() {
+                public void run() {
+                    handle(socket);
+                }
+            });
+        }
+        executor.shutdown();
+    }
+
+    private void handle(Socket socket) {
+        try {
+            DataInputStream in = new DataInputStream(new BufferedInputStream(socket.getInputStream()));
+            DataOutputStream out = new DataOutputStream(new BufferedOutputStream(socket.getOutputStream()));
+
+            String requestToken = in.readUTF();
+            if (!MessageDigest.isEqual(token, requestToken.getBytes("UTF-8"))) {
+                System.err.println("Rejected a request with an invalid token");
+                return;
+            }
+            String classpath = in.readUTF();
+            String mainClass = in.readUTF();
+            int argc = in.readInt();
+            String[] args = new String[argc];
+            for (int i = 0; i < argc; i++) {
+                args[i] = in.readUTF();
+            }
+
+            ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+            int returnCode = 0;
+            boolean shutdown = false;
+            if (CMD_SHUTDOWN.equals(mainClass)) {
+                shutdown = true;
+            } else if (!CMD_PING.equals(mainClass)) {
+                returnCode = runTool(classpath, mainClass, args, buffer);
+            }
+
+            Runtime runtime = Runtime.getRuntime();
+            byte[] output = buffer.toByteArray();
+            out.writeInt(returnCode);
+            out.writeLong(runtime.totalMemory() - runtime.freeMemory());
+            out.writeInt(output.length);
+            out.write(output);
+            out.flush();
+
+            if (shutdown) {
+                running = false;
+                serverSocket.close();
+            }
+        } catch (IOException e) {
+            e.printStackTrace();
+        } finally {
+            try {
+                socket.close();
+            } catch (IOException e) {
+                //nothing to do
+            }
+        }
+    }
+
+    private int runTool(String classpath, String mainClassName, String[] args, ByteArrayOutputStream buffer) {
+        PrintStream log = new PrintStream(buffer, true);
+        OutputTarget target = new OutputTarget(buffer);
+        capture.set(target);
+        ClassLoader previousLoader = Thread.currentThread().getContextClassLoader();
+        try {
+            ClassLoader loader = getClassLoader(classpath);
+            if (mainClassName.length() == 0) {
+                mainClassName = readMainClass(classpath);
+            }
+            Class<?> mainClass = Class.forName(mainClassName, true, loader);
+            Method main = mainClass.getMethod("main", String[].class);
+
+            Thread.currentThread().setContextClassLoader(loader);
+            if (reentrantTools.contains(mainClassName)) {
+                main.invoke(null, (Object) args);
+            } else {
+                //the target is shared by the runs of the tool, so the threads
+                //started in an earlier run write to the buffer of this one
+                OutputTarget toolTarget = getExclusiveTarget(mainClassName);
+                synchronized (toolTarget) {
+                    toolTarget.stream = buffer;
+                    capture.set(toolTarget);
+                    try {
+                        main.invoke(null, (Object) args);
+                    } finally {
+                        System.out.flush();
+                        System.err.flush();
+                        toolTarget.stream = null;
+                        capture.set(target);
+                    }
+                }
+            }
+            return 0;
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (cause instanceof ExitTrappedException) {
+                return ((ExitTrappedException) cause).status;
+            }
+            cause.printStackTrace(log);
+            return 1;
+        } catch (ExitTrappedException e) {
+            return e.status;
+        } catch (Throwable t) {
+            t.printStackTrace(log);
+            return 1;
+        } finally {
+            System.out.flush();
+            System.err.flush();
+            Thread.currentThread().setContextClassLoader(previousLoader);
+            target.stream = null;
+            capture.remove();
+        }
+    }
+
+    private synchronized ClassLoader getClassLoader(String classpath) throws IOException {
+        ClassLoader loader = classLoaders.get(classpath);
+        if (loader == null) {
+            String[] entries = classpath.split(File.pathSeparator);
+            URL[] urls = new URL[entries.length];
+            for (int i = 0; i < entries.length; i++) {
+                urls[i] = new File(entries[i]).toURI().toURL();
+            }
+            //tools must not see the classes of the server
+            loader = new URLClassLoader(urls, ClassLoader.getSystemClassLoader().getParent());
+            classLoaders.put(classpath, loader);
+        }
+        return loader;
+    }
+
+    private synchronized OutputTarget getExclusiveTarget(String mainClassName) {
+        OutputTarget target = exclusiveTargets.get(mainClassName);
+        if (target == null) {
+            target = new OutputTarget(null);
+            exclusiveTargets.put(mainClassName, target);
+        }
+        return target;
+    }
+
+    private static String readMainClass(String classpath) throws IOException {
+        String jar = classpath.split(File.pathSeparator)[0];
+        JarFile jarFile = new JarFile(jar);
+        try {
+            Manifest manifest = jarFile.getManifest();
+            String mainClass = (manifest != null) ? manifest.getMainAttributes().getValue("Main-Class") : null;
+            if (mainClass == null) {
+                throw new IOException("No Main-Class attribute in the manifest of " + jar);
+            }
+            return mainClass.trim();
+        } finally {
+            jarFile.close();
+        }
+    }
+
+
+    /**
+     * Buffer of the request a tool thread (and the threads created by it)
+     * writes to; null if there is no such request.
+     */
+    private static class OutputTarget {
+        volatile OutputStream stream;
+
+        OutputTarget(OutputStream stream) {
+            this.stream = stream;
+        }
+    }
+
+
+    /**
+     * Sends the output of a tool thread (and the threads created by it) to the
+     * buffer of the corresponding request. All other output goes to the
+     * original stream.
+     */
+    private static class DispatchingOutputStream extends OutputStream {
+        private final OutputStream fallback;
+
+        DispatchingOutputStream(OutputStream fallback) {
+            this.fallback = fallback;
+        }
+
+        private OutputStream current() {
+            OutputTarget target = capture.get();
+            OutputStream stream = (target != null) ? target.stream : null;
+            return (stream != null) ? stream : fallback;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            current().write(b);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            current().write(b, off, len);
+        }
+
+        @Override
+        public void flush() throws IOException {
+            current().flush();
+        }
+    }
+
+
+    private static class ExitTrappedException extends SecurityException {
+        private static final long serialVersionUID = 1L;
+        final int status;
+
+        ExitTrappedException(int status) {
+            super("System.exit(" + status + ") is trapped by ToolServer");
+            this.status = status;
+        }
+    }
+
+
+    /**
+     * Converts System.exit() calls made by tools into exceptions.
+     */
+    private static class ExitTrappingSecurityManager extends SecurityManager {
+        @Override
+        public void checkPermission(Permission perm) {
+            //everything is allowed
+        }
+
+        @Override
+        public void checkPermission(Permission perm, Object context) {
+            //everything is allowed
+        }
+
+        @Override
+        public void checkExit(int status) {
+            if (capture.get() != null) {
+                throw new ExitTrappedException(status);
+            }
+        }
+    }
+
+
+    public static void main(String[] args) throws IOException {
+        int port = (args.length > 0) ? Integer.parseInt(args[0]) : 0;
+        String token = new BufferedReader(new InputStreamReader(System.in, "UTF-8")).readLine();
+        if (token == null || token.trim().length() == 0) {
+            System.err.println("The token must be given on the first line of the standard input");
+            System.exit(2);
+        }
+        ToolServer server = new ToolServer(port, token.trim(), System.getProperty(PROP_REENTRANT_TOOLS, DEFAULT_REENTRANT_TOOLS));
+
+        PrintStream stdout = System.out;
+        stdout.println("PORT " + server.getPort());
+        stdout.flush();
+
+        System.setOut(new PrintStream(new DispatchingOutputStream(stdout), true));
+        System.setErr(new PrintStream(new DispatchingOutputStream(System.err), true));
+        System.setSecurityManager(new ExitTrappingSecurityManager());
+
+        server.serve();
+        System.exit(0);
+    }
+}